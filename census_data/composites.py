@@ -0,0 +1,119 @@
+"""
+Census values for composite geographies.
+
+Geographies that the census bureau doesn't publish data for (e.g. neighborhoods) are made up of census
+geographies listed in their `subregions`.  Rather than aggregating those subregions' values on every
+request, the sums (and their propagated MOEs) are computed once when a vintage is loaded and stored in
+`CensusValue` under the composite geog's uid, so they can be looked up like any other geography.
+
+The geog types handled are set in `settings.CENSUS_COMPOSITE_GEOG_TYPES`.  Vintages loaded without
+their composite values still work: requests fall back to aggregating the subregions (see `CensusVariable`).
+"""
+import logging
+from typing import Optional
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+
+from census_data.models import CensusValue, CensusTableRecord
+from geo.models import AdminRegion
+from indicators import moe
+from profiles.db import copy_upsert
+
+logger = logging.getLogger(__name__)
+
+# number of census table records aggregated at a time
+TABLE_BATCH_SIZE = 200
+
+
+def is_composite(geog: AdminRegion) -> bool:
+    return geog.geog_type_id in settings.CENSUS_COMPOSITE_GEOG_TYPES
+
+
+def get_composite_subgeogs(geog: AdminRegion) -> list[AdminRegion]:
+    """ Returns the census geogs that make up `geog`: the largest subgeogs available, like requests for it would use """
+    for subgeog_type_id in AdminRegion.SUBGEOG_TYPE_ORDER:
+        if geog.subregions.get(subgeog_type_id):
+            subgeog_model = AdminRegion.find_subclass(subgeog_type_id)
+            return list(subgeog_model.objects.filter(global_geoid__in=geog.subregions[subgeog_type_id]))
+    return []
+
+
+def get_composite_memberships() -> tuple[list[str], list[str], np.ndarray]:
+    """
+    Finds the census geogs that make up each composite geog.
+
+    :return: uids of the composite geogs, uids of their member geogs and a (composite × member) membership matrix
+    """
+    members: dict[str, list[str]] = {}
+    for geog_type_id in settings.CENSUS_COMPOSITE_GEOG_TYPES:
+        geog_model = AdminRegion.find_subclass(geog_type_id)
+        for geog in geog_model.objects.all():
+            subgeogs = get_composite_subgeogs(geog)
+            if subgeogs:
+                members[CensusValue.geog_uid_for(geog)] = [CensusValue.geog_uid_for(sg) for sg in subgeogs]
+
+    composite_uids = list(members.keys())
+    member_positions: dict[str, int] = {}
+    for member_uids in members.values():
+        for uid in member_uids:
+            member_positions.setdefault(uid, len(member_positions))
+
+    membership = np.zeros((len(composite_uids), len(member_positions)))
+    for i, composite_uid in enumerate(composite_uids):
+        for uid in members[composite_uid]:
+            membership[i, member_positions[uid]] = 1
+    return composite_uids, list(member_positions.keys()), membership
+
+
+def _read_values(table: str, dataset: str, year: int, geog_uids: list[str], table_uids: list[str]) -> np.ndarray:
+    """ Returns a (geog × table) array of the vintage's values in `table`, with NaN where there's no value. """
+    geog_positions = {uid: i for i, uid in enumerate(geog_uids)}
+    table_positions = {uid: i for i, uid in enumerate(table_uids)}
+    values = np.full((len(geog_uids), len(table_uids)), np.nan)
+    with connection.cursor() as cursor:
+        # filtering on the vintage lets postgres prune the partitions it doesn't need
+        cursor.execute(f'SELECT geog_uid, census_table_uid, value FROM "{table}" '
+                       f'WHERE dataset = %s AND year = %s '
+                       f'AND geog_uid = ANY(%s) AND census_table_uid = ANY(%s) AND value IS NOT NULL',
+                       [dataset, year, geog_uids, table_uids])
+        for geog_uid, table_uid, value in cursor.fetchall():
+            values[geog_positions[geog_uid], table_positions[table_uid]] = value
+    return values
+
+
+def materialize_composites(dataset: str, year: int, table: Optional[str] = None) -> int:
+    """
+    Sums the values of each composite geog's members for every table in the vintage and stores them in `table`.
+
+    :param table: table holding the vintage's values, and where the results are written;
+        defaults to `CensusValue`'s table
+    :return: number of values written
+    """
+    table = table or CensusValue._meta.db_table
+    composite_uids, member_uids, membership = get_composite_memberships()
+    if not composite_uids:
+        logger.warning('No composite geographies with subregions found.')
+        return 0
+
+    records = CensusTableRecord.objects.filter(dataset=dataset, year=year).order_by('table_id')
+    count = 0
+    for start in range(0, records.count(), TABLE_BATCH_SIZE):
+        value_uids, moe_uids = CensusTableRecord.get_table_uids(records[start:start + TABLE_BATCH_SIZE])
+        estimates = moe.aggregate_estimates(_read_values(table, dataset, year, member_uids, value_uids), membership)
+        moes = moe.aggregate_moes(_read_values(table, dataset, year, member_uids, moe_uids), membership)
+
+        rows = []
+        for table_uids, values in ((value_uids, estimates), (moe_uids, moes)):
+            for (i, j) in zip(*np.nonzero(~np.isnan(values))):
+                _, _, table_id = CensusValue.split_table_uid(table_uids[j])
+                rows.append((composite_uids[i], table_uids[j], dataset, year, table_id, float(values[i, j]), None))
+        count += copy_upsert(
+            table,
+            columns=('geog_uid', 'census_table_uid', 'dataset', 'year', 'table_id', 'value', 'raw_value'),
+            rows=rows,
+            conflict_columns=('dataset', 'year', 'geog_uid', 'census_table_uid'),
+        )
+    logger.info(f'Materialized {count} values for {len(composite_uids)} composite geogs in {dataset} {year}')
+    return count
@@ -0,0 +1,292 @@
+"""
+Pipelined loading of ACS sequence files.
+
+Sequences move through three stages that run at the same time:
+    1. download - sequence zips are fetched (over FTP or from a local mirror) and extracted, on a thread pool
+    2. parse - sequence files are converted to long-form CSVs of census values, on a process pool
+    3. load - parsed values are copied into the db, with a small, bounded number of concurrent loads
+
+Downloaded zips are kept in a mirror directory and each sequence's progress is recorded in a state file,
+so reruns skip any work that's already done.
+"""
+import csv
+import json
+import os
+import shutil
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from ftplib import FTP
+from typing import Optional, List
+
+import pandas as pd
+from django.db import connections
+
+from census_data.models import CensusTableRecord
+from census_data.partitions import ensure_partition
+from profiles.db import copy_upsert
+from . import _load_census as census_loader
+from ._geo_lookup import GeoLookup
+
+DOWNLOADED = 'downloaded'
+PARSED = 'parsed'
+LOADED = 'loaded'
+FAILED = 'failed'
+
+STAGE_ORDER = (DOWNLOADED, PARSED, LOADED)
+
+
+# Fetchers
+# -*-*-*-*-
+class FTPFetcher:
+    """ Fetches files from the census FTP server, reusing one session per thread. """
+
+    def __init__(self, host: str = census_loader.FTP_HOST):
+        self.host = host
+        self._local = threading.local()
+
+    @property
+    def ftp(self) -> FTP:
+        if getattr(self._local, 'ftp', None) is None:
+            self._local.ftp = FTP(self.host)
+            self._local.ftp.login()
+        return self._local.ftp
+
+    def list(self, remote_dir: str) -> List[str]:
+        return self.ftp.nlst(remote_dir)
+
+    def fetch(self, remote_path: str, local_path: str):
+        with open(local_path, 'wb') as f:
+            self.ftp.retrbinary(f'RETR {remote_path}', f.write)
+
+
+class LocalFetcher:
+    """ Offline stand-in for the FTP server that reads from a local directory laid out like the server. """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _local_path(self, remote_path: str) -> str:
+        return os.path.join(self.root, remote_path.lstrip('/'))
+
+    def list(self, remote_dir: str) -> List[str]:
+        return sorted(os.listdir(self._local_path(remote_dir)))
+
+    def fetch(self, remote_path: str, local_path: str):
+        shutil.copyfile(self._local_path(remote_path), local_path)
+
+
+# State
+# -*-*-
+class PipelineState:
+    """ Per-sequence progress, saved to a json file after every change. """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.sequences: dict[str, dict] = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.sequences = json.load(f)
+
+    def stage(self, seq_no: int) -> Optional[str]:
+        return self.sequences.get(str(seq_no), {}).get('stage')
+
+    def has_reached(self, seq_no: int, stage: str) -> bool:
+        current = self.stage(seq_no)
+        return current in STAGE_ORDER and STAGE_ORDER.index(current) >= STAGE_ORDER.index(stage)
+
+    def set(self, seq_no: int, stage: str, **details):
+        with self._lock:
+            self.sequences[str(seq_no)] = {'stage': stage, 'updated': time.time(), **details}
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.sequences, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+# Stages
+# -*-*-*-
+def get_pipeline_dirs(year: int) -> tuple[str, str]:
+    base_dir = census_loader.get_base_dl_dir(year)
+    mirror_dir = census_loader.ensure_path(os.path.join(base_dir, 'mirror'))
+    parsed_dir = census_loader.ensure_path(os.path.join(base_dir, 'parsed'))
+    return mirror_dir, parsed_dir
+
+
+def download_templates(fetcher, year: int):
+    template_dl_dir = census_loader.get_base_dl_dir(year)
+    template_dl_path = os.path.join(template_dl_dir, census_loader.TEMPLATE_FILENAME)
+    if not os.path.isfile(template_dl_path):
+        print('⬇️', 'Downloading template files')
+        fetcher.fetch(f'{census_loader.get_ftp_data_dir(year)}/{census_loader.TEMPLATE_FILENAME}', template_dl_path)
+        with zipfile.ZipFile(template_dl_path, 'r') as zf:
+            zf.extractall(template_dl_dir)
+
+
+def download_seq(fetcher, seq_no: int, year: int, listings: dict[str, List[str]]) -> int:
+    """ Fetches the zips for a sequence into the mirror, if they aren't there already, and extracts them. """
+    mirror_dir, _ = get_pipeline_dirs(year)
+    for ftp_dir, dl_dir in zip(census_loader.get_ftp_dirs(year), census_loader.get_dl_dirs(year)):
+        for data_file in listings[ftp_dir]:
+            data_file = os.path.basename(data_file)
+            if data_file[-3:] != 'zip' or not census_loader.is_file_for_seq_no(data_file, seq_no):
+                continue
+            mirror_path = os.path.join(mirror_dir, f'{os.path.basename(dl_dir)}-{data_file}')
+            if not os.path.isfile(mirror_path):
+                tmp_path = f'{mirror_path}.part'
+                fetcher.fetch(f'{ftp_dir}/{data_file}', tmp_path)
+                os.replace(tmp_path, mirror_path)
+            if not census_loader.already_exists(dl_dir, data_file):
+                with zipfile.ZipFile(mirror_path, 'r') as zf:
+                    zf.extractall(dl_dir)
+    return seq_no
+
+
+def parse_seq(seq_no: int, year: int) -> tuple[int, str, list[tuple[str, str]]]:
+    """
+    Converts a sequence's estimate and MOE files into a single long-form CSV of census values.
+
+    Runs in a worker process.
+    :return: the sequence number, path to the parsed CSV and the (table_id, description) of each table in it
+    """
+    _, parsed_dir = get_pipeline_dirs(year)
+    _, year_dir = census_loader.get_template_dirs(year)
+    geo_lookup = _get_worker_geo_lookup(year)
+
+    census_tables = census_loader.extract_table_details(seq_no, year, os.path.join(year_dir, f'seq{seq_no}.xlsx'))
+    table_uids_for_mode = {
+        'e': [table.value_table_uid for table in census_tables],
+        'm': [table.moe_table_uid for table in census_tables],
+    }
+
+    data_fname = f'{year}5{census_loader.ST}{int(seq_no):04}000.txt'
+    parsed_path = os.path.join(parsed_dir, f'seq{seq_no}.csv')
+    tmp_path = f'{parsed_path}.tmp'
+    with open(tmp_path, 'w', newline='') as out:
+        for dl_dir in census_loader.get_dl_dirs(year):
+            for mode, table_uids in table_uids_for_mode.items():
+                chunks = pd.read_csv(os.path.join(dl_dir, f'{mode}{data_fname}'), header=None, dtype=str,
+                                     keep_default_na=False, chunksize=census_loader.READ_CHUNK_SIZE)
+                for chunk in chunks:
+                    values = census_loader.census_values_from_chunk(chunk, table_uids, geo_lookup)
+                    values.to_csv(out, header=False, index=False, quoting=csv.QUOTE_NONNUMERIC)
+    os.replace(tmp_path, parsed_path)
+    return seq_no, parsed_path, [(table.table_id, table.description) for table in census_tables]
+
+
+_worker_geo_lookups: dict[int, GeoLookup] = {}
+
+
+def _get_worker_geo_lookup(year: int) -> GeoLookup:
+    if year not in _worker_geo_lookups:
+        _worker_geo_lookups[year] = census_loader.get_or_make_geo_lookup(year)
+    return _worker_geo_lookups[year]
+
+
+def load_seq(seq_no: int, year: int, parsed_path: str, tables: list[tuple[str, str]], table: str) -> tuple[int, int]:
+    """ Saves a parsed sequence's tables and values, writing the values to `table`. """
+    try:
+        CensusTableRecord.objects.bulk_create(
+            [CensusTableRecord(table_id=table_id, description=description, year=year, dataset='ACS5')
+             for table_id, description in tables],
+            ignore_conflicts=True
+        )
+        with open(parsed_path, newline='') as f:
+            rows = ((geog_uid, table_uid, dataset, int(value_year), table_id, float(value) if value else None, raw_value)
+                    for geog_uid, table_uid, dataset, value_year, table_id, value, raw_value in csv.reader(f))
+            count = copy_upsert(
+                table,
+                columns=census_loader.CENSUS_VALUE_COLUMNS,
+                rows=rows,
+                conflict_columns=census_loader.CENSUS_VALUE_CONFLICT_COLUMNS,
+            )
+        return seq_no, count
+    finally:
+        connections.close_all()
+
+
+# Scheduler
+# -*-*-*-*-
+def run(start: int, end: int, year: int = 2019, fetcher=None,
+        download_workers: int = 4, parse_workers: Optional[int] = None, load_workers: int = 2,
+        table: Optional[str] = None, restart: bool = False):
+    """
+    Downloads, parses and loads sequences `start` through `end` with all three stages running at once.
+
+    :param fetcher: where files come from; defaults to the census FTP server
+    :param table: table to write values to; defaults to the vintage's partition of `CensusValue`
+    :param restart: ignore the progress recorded by earlier runs
+    """
+    fetcher = fetcher or FTPFetcher()
+    table = table or ensure_partition('ACS5', year)
+    base_dir = census_loader.get_base_dl_dir(year)
+    state_path = os.path.join(base_dir, f'pipeline_state.{table}.json')
+    if restart and os.path.isfile(state_path):
+        os.remove(state_path)
+    state = PipelineState(state_path)
+
+    # make sure the lookup exists before workers start mapping it
+    census_loader.get_or_make_geo_lookup(year)
+    download_templates(fetcher, year)
+    listings = {ftp_dir: fetcher.list(ftp_dir) for ftp_dir in census_loader.get_ftp_dirs(year)}
+
+    seq_nos = [seq_no for seq_no in range(start, end + 1) if not state.has_reached(seq_no, LOADED)]
+    print('🚦', f'{len(seq_nos)} sequences to load; {end - start + 1 - len(seq_nos)} already done.')
+
+    start_time = time.monotonic()
+    failures: dict[int, str] = {}
+    loaded = 0
+
+    # forked parse workers can't share our connections
+    connections.close_all()
+    with ThreadPoolExecutor(download_workers) as downloader, \
+            ProcessPoolExecutor(parse_workers) as parser, \
+            ThreadPoolExecutor(load_workers) as loader:
+        running: dict[Future, tuple[str, int]] = {}
+
+        def submit_parse(seq_no):
+            running[parser.submit(parse_seq, seq_no, year)] = (PARSED, seq_no)
+
+        def submit_load(seq_no, parsed_path, tables):
+            running[loader.submit(load_seq, seq_no, year, parsed_path, tables, table)] = (LOADED, seq_no)
+
+        for seq_no in seq_nos:
+            details = state.sequences.get(str(seq_no), {})
+            if state.has_reached(seq_no, PARSED) and os.path.isfile(details.get('parsed_path', '')):
+                submit_load(seq_no, details['parsed_path'], details['tables'])
+            elif state.has_reached(seq_no, DOWNLOADED):
+                submit_parse(seq_no)
+            else:
+                running[downloader.submit(download_seq, fetcher, seq_no, year, listings)] = (DOWNLOADED, seq_no)
+
+        while running:
+            finished, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, seq_no = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    failures[seq_no] = f'{stage}: {type(e).__name__}: {e}'
+                    state.set(seq_no, FAILED, error=failures[seq_no])
+                    print('❌', f'({seq_no})', failures[seq_no])
+                    continue
+
+                if stage == DOWNLOADED:
+                    state.set(seq_no, DOWNLOADED)
+                    submit_parse(seq_no)
+                elif stage == PARSED:
+                    _, parsed_path, tables = result
+                    state.set(seq_no, PARSED, parsed_path=parsed_path, tables=tables)
+                    submit_load(seq_no, parsed_path, tables)
+                else:
+                    _, count = result
+                    state.set(seq_no, LOADED, count=count)
+                    loaded += 1
+                    elapsed = time.monotonic() - start_time
+                    print('🚛️', f'({seq_no})', f'{count} values loaded',
+                          f'[{loaded}/{len(seq_nos)}, {loaded / elapsed * 60:.1f} seq/min]')
+
+    print('✔️ Done', f'{loaded} sequences loaded, {len(failures)} failed.')
+    return failures
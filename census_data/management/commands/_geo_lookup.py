@@ -0,0 +1,75 @@
+"""
+Compact, memory-mapped lookups from logical record numbers to the affgeoids of their geographies.
+
+A lookup is stored as three `.npy` files:
+    - `logrecnos` - sorted logical record numbers
+    - `codes` - for each record number, the position of its affgeoid in `geoids`
+    - `geoids` - each distinct affgeoid once, as fixed-width bytes
+
+They're opened with `mmap_mode='r'`, so loading a lookup is instant and every worker process shares the same pages.
+"""
+import os
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+LOOKUP_PARTS = ('logrecnos', 'codes', 'geoids')
+
+
+class GeoLookup:
+    def __init__(self, logrecnos: np.ndarray, codes: np.ndarray, geoids: np.ndarray):
+        self.logrecnos = logrecnos
+        self.codes = codes
+        self.geoids = geoids
+        self._decoded_geoids: Optional[np.ndarray] = None
+
+    def __len__(self):
+        return len(self.logrecnos)
+
+    def __getitem__(self, logrecno) -> str:
+        affgeoid = self.get(logrecno)
+        if affgeoid is None:
+            raise KeyError(logrecno)
+        return affgeoid
+
+    def get(self, logrecno, default=None) -> Optional[str]:
+        i = np.searchsorted(self.logrecnos, int(logrecno))
+        if i < len(self.logrecnos) and self.logrecnos[i] == int(logrecno):
+            return self.geoids[self.codes[i]].decode()
+        return default
+
+    def map(self, logrecnos: pd.Series) -> pd.Series:
+        """ Maps a series of logical record numbers (as ints or zero-padded strings) to affgeoids; NaN if not found. """
+        numbers = pd.to_numeric(logrecnos, errors='coerce').fillna(-1).to_numpy(dtype=np.int64)
+        positions = np.searchsorted(self.logrecnos, numbers).clip(max=max(len(self.logrecnos) - 1, 0))
+        found = (self.logrecnos[positions] == numbers) if len(self.logrecnos) else np.zeros(len(numbers), bool)
+        if self._decoded_geoids is None:
+            self._decoded_geoids = np.char.decode(self.geoids).astype(object)
+        result = pd.Series(np.nan, index=logrecnos.index, dtype=object)
+        result[found] = self._decoded_geoids[self.codes[positions[found]]]
+        return result
+
+    @staticmethod
+    def build(logrecnos: pd.Series, affgeoids: pd.Series) -> 'GeoLookup':
+        """ Makes a lookup from parallel series of record numbers and affgeoids. """
+        logrecnos = pd.to_numeric(logrecnos).to_numpy(dtype=np.int64)
+        order = np.argsort(logrecnos, kind='stable')
+        codes, geoids = pd.factorize(affgeoids.to_numpy()[order])
+        return GeoLookup(logrecnos[order], codes.astype(np.int32), np.array(geoids, dtype=object).astype(bytes))
+
+    @staticmethod
+    def exists(base_path: str) -> bool:
+        return all(os.path.isfile(f'{base_path}.{part}.npy') for part in LOOKUP_PARTS)
+
+    @staticmethod
+    def load(base_path: str) -> 'GeoLookup':
+        return GeoLookup(*(np.load(f'{base_path}.{part}.npy', mmap_mode='r') for part in LOOKUP_PARTS))
+
+    def save(self, base_path: str):
+        # each file is swapped in once complete so readers never see a partial lookup
+        for part in LOOKUP_PARTS:
+            tmp_path = f'{base_path}.{part}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, getattr(self, part))
+            os.replace(tmp_path, f'{base_path}.{part}.npy')
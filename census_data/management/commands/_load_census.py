@@ -5,8 +5,6 @@ Some notes about the data formats and weirdness of it can be found here:
 https://www2.census.gov/programs-surveys/acs/summary_file/2019/documentation/tech_docs/ACS_SF_Excel_Import_Tool.pdf
 
 """
-import csv
-import json
 import os
 import zipfile
 from ftplib import FTP
@@ -21,7 +19,10 @@ from django.core.exceptions import ObjectDoesNotExist
 from openpyxl import load_workbook
 
 from census_data.models import CensusValue, CensusTableRecord
+from census_data.partitions import ensure_partition
 from geo.models import AdminRegion
+from profiles.db import copy_upsert
+from ._geo_lookup import GeoLookup
 
 COUNTIES = ('42073', '42003', '42007', '42125', '42059',
             '42051', '42129', '42063', '42005', '42019',)
@@ -44,6 +45,17 @@ FTP_HOST = 'ftp2.census.gov'
 SUMMARY_LEVELS = {'050', '060', '140', '150', '860', '970'}
 SUMMARY_LEVELS_SF1 = {'050', '060', '140', '150', '871', '970'}
 
+# sequence files have 6 columns of header info before the table data starts
+LOGRECNO_COL = 5
+DATA_START_COL = 6
+
+# number of sequence file rows read at a time
+READ_CHUNK_SIZE = 2000
+
+# columns written to `CensusValue`, in the order `census_values_from_chunk` returns them
+CENSUS_VALUE_COLUMNS = ('geog_uid', 'census_table_uid', 'dataset', 'year', 'table_id', 'value', 'raw_value')
+CENSUS_VALUE_CONFLICT_COLUMNS = ('dataset', 'year', 'geog_uid', 'census_table_uid')
+
 
 # Utilities
 # -*-*-*-*-
@@ -124,24 +136,26 @@ def get_geo(logrecno, geo_lookup):
 
 # Geo lookup
 # -*-*-*-*-*-
-def get_or_make_geo_lookup(year: int, redownload=False) -> dict:
-    """ Generate a lookup table that maps the geoids we use to the record numbers in the data """
+def get_lookup_base_path(name: str) -> str:
     data_dir = ensure_path(os.path.join(settings.BASE_DIR, 'data'))
     lookup_dir = ensure_path(os.path.join(data_dir, 'geo_lookups'))
-    file_name_base = os.path.join(lookup_dir, f'{year}{ST}')
+    return os.path.join(lookup_dir, name)
+
+
+def get_or_make_geo_lookup(year: int, redownload=False) -> GeoLookup:
+    """ Generate a lookup table that maps the record numbers in the data to the geoids we use """
+    file_name_base = get_lookup_base_path(f'{year}{ST}')
     dl_fname = f'{file_name_base}.xlsx'
-    lookup_fname = f'{file_name_base}.json'
     print('🌏', 'Generating geo lookup ')
     # first check if a cached lookup exists
-    if redownload or os.path.isfile(lookup_fname):
-        print('  ', '✅️', 'Cache hit.', f'Returning look found at {lookup_fname}')
-        with open(lookup_fname) as f:
-            return json.load(f)
+    if not redownload and GeoLookup.exists(file_name_base):
+        print('  ', '✅️', 'Cache hit.', f'Returning lookup found at {file_name_base}')
+        return GeoLookup.load(file_name_base)
     else:
         print('  ', '❌', 'Cache miss.', 'Preceding to generate lookup')
 
     # download geography file if necessary
-    if not os.path.isfile(dl_fname):
+    if redownload or not os.path.isfile(dl_fname):
         print('📡', 'Downloading geo file... ', end='')
         r = requests.get(
             f'https://www2.census.gov/programs-surveys/acs/summary_file/{year}/documentation/geography/5yr_year_geo/{ST}.xlsx'
@@ -153,90 +167,72 @@ def get_or_make_geo_lookup(year: int, redownload=False) -> dict:
         print('⤵️️', 'Skipping download.', 'Source file already exists.')
 
     print('⛏', 'Extracting data...')
-    df = pd.read_excel(dl_fname)
-
-    log_rec_df = pd.DataFrame()
-    log_rec_df['logrecno'] = df['Logical Record Number']
-    log_rec_df['affgeoid'] = df['Geography ID'].map(format_affgeoid)
-
-    # get array of data ([logrecno: str, affeoid][])
-    data: List[List[str]] = log_rec_df.to_dict(orient='split')['data']
+    df = pd.read_excel(dl_fname, usecols=['Logical Record Number', 'Geography ID'], dtype=str)
+
+    # e.g. '15000US420030101001' -> '1500000US420030101001'
+    parts = df['Geography ID'].str.split('US', n=1, expand=True)
+    summary_levels = pd.to_numeric(parts[0], errors='coerce')
+    affgeoids = df['Geography ID'].where(
+        summary_levels.isna(),
+        summary_levels.fillna(0).astype(int).astype(str).str.zfill(5) + '00US' + parts[1]
+    )
 
-    lookup = {f'{datum[0]:07}': datum[1] for datum in data}
-    print('🌎', 'Lookup generated!')
+    lookup = GeoLookup.build(df['Logical Record Number'], affgeoids)
+    lookup.save(file_name_base)
+    print('🌎', 'Lookup generated!', f'{len(lookup)} records.')
+    return GeoLookup.load(file_name_base)
 
-    # save cached version
-    with open(lookup_fname, 'w') as f:
-        json.dump(lookup, f)
 
-    return lookup
+# columns of the SF1 geographic header file, see fig 2-5 in the docs
+# http://www2.census.gov/programs-surveys/decennial/2010/technical-documentation/complete-tech-docs/summary-file/sf1.pdf
+SF1_GEO_COLSPECS = {
+    'summary_level': (8, 11),
+    'logrecno': (18, 25),
+    'state': (27, 29),
+    'county': (29, 32),
+    'countysub': (36, 41),
+    'tract': (54, 60),
+    'blockgrp': (60, 61),
+    'zcta': (171, 176),
+    'school_district_u': (194, 199),
+}
 
 
-def get_or_make_census_geo_lookup(year: int, redownload=False) -> dict:
-    data_dir = ensure_path(os.path.join(settings.BASE_DIR, 'data'))
-    lookup_dir = ensure_path(os.path.join(data_dir, 'geo_lookups'))
-    lookup_filename = os.path.join(lookup_dir, f'cen_{year}.json')
-    source_filename = os.path.join(lookup_dir, f'{ST}geo{year}.sf1')
+def get_or_make_census_geo_lookup(year: int, redownload=False) -> GeoLookup:
+    file_name_base = get_lookup_base_path(f'cen_{year}')
+    source_filename = get_lookup_base_path(f'{ST}geo{year}.sf1')
 
     # first check if a cached lookup exists
-    if os.path.isfile(lookup_filename):
-        print('  ', '✅️', 'Cache hit.', f'Returning look found at {lookup_filename}')
-        with open(lookup_filename) as f:
-            return json.load(f)
+    if not redownload and GeoLookup.exists(file_name_base):
+        print('  ', '✅️', 'Cache hit.', f'Returning lookup found at {file_name_base}')
+        return GeoLookup.load(file_name_base)
     else:
         print('  ', '❌', 'Cache miss.', 'Preceding to generate lookup')
-    lookup = {}
-    # read source file
-    with open(source_filename) as f:
-        for line in f.readlines():
-            summary_level = line[8:11]
-            # limit to select geographies
-            if summary_level not in SUMMARY_LEVELS_SF1:
-                continue
 
-            logrecno = line[18:25]
-            state = line[27:29]
-            county = line[29:32]
+    df = pd.read_fwf(source_filename, colspecs=list(SF1_GEO_COLSPECS.values()), names=list(SF1_GEO_COLSPECS),
+                     dtype=str, header=None, encoding='latin-1').fillna('')
 
-            # limit to the app's extent
-            if county not in settings.AVAILABLE_COUNTIES_IDS:
-                continue
+    # limit to select geographies in the app's extent
+    df = df[df['summary_level'].isin(SUMMARY_LEVELS_SF1)
+            & (df['state'] + df['county']).isin(settings.AVAILABLE_COUNTIES_IDS)]
+
+    county = df['state'] + df['county']
+    geoids = pd.Series('', index=df.index)
+    for summary_level, geoid in (
+            ('050', county),
+            ('060', county + df['countysub']),
+            ('140', county + df['tract']),
+            ('150', county + df['tract'] + df['blockgrp']),
+            ('871', df['zcta']),
+            ('970', df['school_district_u']),
+    ):
+        geoids = geoids.mask(df['summary_level'] == summary_level, geoid)
+    affgeoids = df['summary_level'] + '0000US' + geoids.str.strip()
 
-            # extract geo id parts from the data see fig 2-5 in the docs
-            # http://www2.census.gov/programs-surveys/decennial/2010/technical-documentation/complete-tech-docs/summary-file/sf1.pdf
-            countysub = line[36:41]
-            tract = line[54:60]
-            blockgrp = line[60:61]
-            # block = line[61:65]
-            zcta = line[171:176]
-            school_district_u = line[194:199]
-
-            name = line[226:316].strip()
-
-            geoid = ''
-            if summary_level == '050':  # county
-                geoid = state + county
-            if summary_level == '060':  # county subdivision
-                geoid = state + county + countysub
-            if summary_level == '140':  # tract
-                geoid = state + county + tract
-            if summary_level == '150':  # block group
-                geoid = state + county + tract + blockgrp
-            if summary_level == '871':  # zip code
-                geoid = zcta
-            if summary_level == '970':  # school district (unified)
-                geoid = school_district_u
-
-            geoid = geoid.strip()
-            affgeoid = summary_level + '0000US' + geoid
-
-            print(geoid, affgeoid, name)
-            lookup[logrecno] = affgeoid
-
-    # save lookup
-    with open(lookup_filename, 'w') as f:
-        json.dump(lookup, f)
-    return lookup
+    lookup = GeoLookup.build(df['logrecno'], affgeoids)
+    lookup.save(file_name_base)
+    print('🌎', 'Lookup generated!', f'{len(lookup)} records.')
+    return GeoLookup.load(file_name_base)
 
 
 # Downloading data
@@ -344,43 +340,36 @@ def extract_table_details(seq_no, year, fname) -> List['CensusTableRecord']:
 
 # Saving Data
 # -*-*-*-*-*-
-def census_values_from_row(row, census_tables, seq_no, mode, geo_lookup) -> List['CensusValue']:
-    census_values = []
-    logrecno = row[5]
-    affgeoid: str = geo_lookup[logrecno]
-
-    # Only use certain geos
-    if not affgeoid:
-        # print('❌ not found')
-        return []
-    if affgeoid.split('US')[1][:5] not in COUNTIES:
-        # print('⤵️', affgeoid, affgeoid, 'out of range')
-        return []
-    if affgeoid[:3] not in SUMMARY_LEVELS:
-        return []
-
-    # print('🏙', affgeoid, f'[{seq_no}{mode.upper()}]')
-
-    # for the cells that have data in them
-    for i in range(6, len(row)):
-        cell = row[i]
-        census_table = census_tables[i - 6]
-        # Get value
-        try:
-            value = float(cell)
-        except ValueError:
-            value = None
-
-        new_cv = {'geog_uid': affgeoid,
-                  'census_table_uid': census_table.uid,
-                  'value': value,
-                  'raw_value': cell}
-        census_values.append(new_cv)
-
-    return [CensusValue(**cv) for cv in census_values]
-
-
-def insert_seq_data(seq_no, year, geo_lookup):
+def census_values_from_chunk(chunk: pd.DataFrame, table_uids: List[str], geo_lookup: GeoLookup) -> pd.DataFrame:
+    """
+    Converts a chunk of rows from a sequence file into long-form rows with the columns in `CENSUS_VALUE_COLUMNS`.
+
+    Rows for geographies outside of `COUNTIES` and `SUMMARY_LEVELS` are dropped.
+    """
+    affgeoids: pd.Series = geo_lookup.map(chunk[LOGRECNO_COL])
+
+    # only use certain geos
+    affgeoids = affgeoids[affgeoids.notna()]
+    in_range = (affgeoids.str[:3].isin(SUMMARY_LEVELS)
+                & affgeoids.str.split('US', n=1).str[1].str[:5].isin(COUNTIES))
+    affgeoids = affgeoids[in_range]
+
+    # the cells that have data in them, one column per table
+    data = chunk.loc[affgeoids.index, DATA_START_COL:DATA_START_COL + len(table_uids) - 1]
+    data.columns = table_uids
+    data.insert(0, 'geog_uid', affgeoids)
+
+    values = data.melt(id_vars='geog_uid', var_name='census_table_uid', value_name='raw_value')
+    uid_parts = values['census_table_uid'].str.split(':', n=2, expand=True)
+    values.insert(2, 'dataset', uid_parts[0])
+    values.insert(3, 'year', uid_parts[1].astype(int))
+    values.insert(4, 'table_id', uid_parts[2])
+    numeric_values = pd.to_numeric(values['raw_value'], errors='coerce')
+    values.insert(5, 'value', numeric_values.astype(object).where(numeric_values.notna(), None))
+    return values
+
+
+def insert_seq_data(seq_no, year, geo_lookup, table=CensusValue._meta.db_table):
     # prepare geo_lookup connection
     template_file = f'seq{seq_no}.xlsx'
     data_fname = f'{year}5{ST}{int(seq_no):04}000.txt'
@@ -394,41 +383,52 @@ def insert_seq_data(seq_no, year, geo_lookup):
     )
     print('🚚', f'({seq_no})', 'Uploading tables')
     CensusTableRecord.objects.bulk_create(census_tables, ignore_conflicts=True)
-    return
-    # extract data from all the data files
-    census_values = []
-    for dl_dir in get_dl_dirs(year):  # for ACS this ends up being two directories
-        # estimates and margins of errors in are in separate files
-        for mode in ('e', 'm',):
-            data_file = os.path.join(dl_dir, f'{mode}{data_fname}')
-            # open data file and read rows
-            with open(data_file) as f:
-                print('📄', f'Extracting data from "{mode}{data_fname}"')
-                reader = csv.reader(f)
-                for row in reader:
-                    new_census_values = census_values_from_row(row, tables_for_mode, seq_no, mode, geo_lookup)
-                    census_values += new_census_values
 
-    # fixme: this is the bottleneck on a fast machine and can be further optimized
-    #   postgres and django probably each have some tips on what to do
-    print('🚛️', f'({seq_no})', 'Uploading values')
-    CensusValue.objects.bulk_create(census_values, ignore_conflicts=True)
+    # estimates and margins of errors in are in separate files
+    table_uids_for_mode = {
+        'e': [table.value_table_uid for table in census_tables],
+        'm': [table.moe_table_uid for table in census_tables],
+    }
 
-
-def run_for_seq_no(seq_no, year, lookup, redownload):
+    # extract data from all the data files, streaming it into the db a chunk at a time to keep memory bounded
+    count = 0
+    for dl_dir in get_dl_dirs(year):  # for ACS this ends up being two directories
+        for mode, table_uids in table_uids_for_mode.items():
+            data_file = os.path.join(dl_dir, f'{mode}{data_fname}')
+            print('📄', f'Extracting data from "{mode}{data_fname}"')
+            chunks = pd.read_csv(data_file, header=None, dtype=str, keep_default_na=False,
+                                 chunksize=READ_CHUNK_SIZE)
+            for chunk in chunks:
+                values = census_values_from_chunk(chunk, table_uids, geo_lookup)
+                count += copy_upsert(
+                    table,
+                    columns=CENSUS_VALUE_COLUMNS,
+                    rows=values.itertuples(index=False, name=None),
+                    conflict_columns=CENSUS_VALUE_CONFLICT_COLUMNS,
+                )
+    print('🚛️', f'({seq_no})', f'{count} values uploaded')
+
+
+def run_for_seq_no(seq_no, year, lookup, redownload, table=CensusValue._meta.db_table):
     print('🚦', f'Starting job for {seq_no}.')
     download_acs5_data(seq_no, year, redownload=redownload)
-    insert_seq_data(seq_no, year, lookup)
+    insert_seq_data(seq_no, year, lookup, table=table)
+
 
+def run(start, end, year=2019, redownload=False, delete=False, table=None):
+    """
+    Downloads and loads sequences `start` through `end`, one after another.
 
-def run(start, end, year=2019, redownload=False, delete=False):
+    :param table: table to write values to; defaults to the vintage's partition of `CensusValue`
+    """
     if delete:
         print("DELETING DISABLED")
         # print('🗑', 'Deleting old Census objects first...')
         # CensusValue.objects.all().delete()
         # CensusTable.objects.all().delete()
 
+    table = table or ensure_partition('ACS5', year)
     lookup = get_or_make_geo_lookup(year)
 
     for seq_no in range(start, end + 1):
-        run_for_seq_no(seq_no, year, lookup, redownload)
+        run_for_seq_no(seq_no, year, lookup, redownload, table=table)
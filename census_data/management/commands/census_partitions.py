@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from census_data import partitions
+from indicators.models import CensusVariableSource
+
+
+class Command(BaseCommand):
+    help = "List, attach, detach or swap the dataset-year partitions of CensusValue"
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=('list', 'create', 'attach', 'detach', 'swap'))
+        parser.add_argument('-d', '--dataset', default='ACS5')
+        parser.add_argument('-y', '--year', type=int)
+        parser.add_argument('-t', '--table', default=None,
+                            help='table to attach or swap in; defaults to the partition or staging table for the year')
+        parser.add_argument('--keep-old', action='store_true', help='keep the replaced partition as a detached table')
+
+    def handle(self, *args, **options):
+        action, dataset, year = options['action'], options['dataset'], options['year']
+        if action == 'list':
+            for name, bounds in partitions.list_partitions():
+                self.stdout.write(f'📦 {name}  {bounds}')
+            return
+
+        if year is None:
+            raise CommandError(f'A year is required to {action} a partition.')
+
+        if action == 'create':
+            self.stdout.write(f'✔️ Created {partitions.ensure_partition(dataset, year)}')
+        elif action == 'attach':
+            self.stdout.write(f"🔗 Attached {partitions.attach(dataset, year, options['table'])}")
+        elif action == 'detach':
+            self.stdout.write(f'✂️ Detached as {partitions.detach(dataset, year)}')
+        elif action == 'swap':
+            table = options['table'] or partitions.staging_name(dataset, year)
+            if not partitions.table_exists(table):
+                raise CommandError(f'{table} does not exist.')
+            old_table = partitions.swap(dataset, year, table, keep_old=options['keep_old'])
+            self.stdout.write(f'🔀 Swapped {table} in for {partitions.partition_name(dataset, year)}')
+            if old_table:
+                self.stdout.write(f'   Old partition kept as {old_table}')
+
+        if action in ('attach', 'detach', 'swap'):
+            # data cached from the partition's old values is superseded
+            CensusVariableSource.invalidate_vintage(dataset, year)
@@ -1,4 +1,11 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand
+
+from census_data import partitions
+from census_data.composites import materialize_composites
+from census_data.matrix import CensusMatrix
+from indicators.models import CensusVariableSource
+from . import _census_pipeline as census_pipeline
 from . import _load_census as census_loader
 
 
@@ -10,7 +17,60 @@ class Command(BaseCommand):
         parser.add_argument('-e', '--end', type=int, default=141)
         parser.add_argument('-y', '--year', type=int, default=2019)
         parser.add_argument('-D', '--delete', action='store_true')
+        parser.add_argument('-M', '--materialize', action='store_true',
+                            help="rebuild the year's census value matrix; always done with the 'matrix' engine")
+        parser.add_argument('-p', '--parallel', action='store_true',
+                            help='download, parse and load sequences concurrently, resuming any earlier run')
+        parser.add_argument('-R', '--reload', action='store_true',
+                            help="load the year into a staging table and swap it in for the current partition")
+        parser.add_argument('--skip-composites', action='store_true',
+                            help="don't sum values for the geog types in CENSUS_COMPOSITE_GEOG_TYPES")
+        parser.add_argument('--download-workers', type=int, default=4)
+        parser.add_argument('--parse-workers', type=int, default=None)
+        parser.add_argument('--load-workers', type=int, default=2)
+        parser.add_argument('--source-dir', default=None,
+                            help='read files from this copy of the census FTP server instead of the server itself')
 
     def handle(self, *args, **options):
         year = options.get('year', 2019)
-        census_loader.run(options['start'], options['end'], year=year, delete=options['delete'])
+        table = partitions.create_staging('ACS5', year) if options['reload'] else None
+
+        failures = {}
+        if options['parallel']:
+            fetcher = census_pipeline.LocalFetcher(options['source_dir']) if options['source_dir'] else None
+            failures = census_pipeline.run(options['start'], options['end'], year=year, fetcher=fetcher,
+                                           download_workers=options['download_workers'],
+                                           parse_workers=options['parse_workers'],
+                                           load_workers=options['load_workers'],
+                                           table=table, restart=options['reload'])
+        else:
+            census_loader.run(options['start'], options['end'], year=year, delete=options['delete'], table=table)
+
+        if table and failures:
+            print('⚠️', f'Not swapping in {table} since {len(failures)} sequences failed.')
+            return
+
+        if not options['skip_composites']:
+            print('🧩', 'Summing values for composite geographies')
+            count = materialize_composites('ACS5', year, table=table)
+            print('✔️ Done', f'{count} values saved')
+
+        # the sums behind compound census variables need to be redone with the new values
+        print('🧮', 'Compiling virtual tables')
+        count = CensusVariableSource.compile_vintage('ACS5', year, table=table)
+        print('✔️ Done', f'{count} values compiled')
+
+        if table:
+            print('🔀', f'Swapping {table} in for the {year} partition')
+            partitions.swap('ACS5', year, table)
+
+        # data cached from the old values is superseded
+        CensusVariableSource.invalidate_vintage('ACS5', year)
+
+        if options['materialize'] or settings.CENSUS_VALUE_ENGINE == 'matrix':
+            print('🧮', f'Materializing census value matrix for {year}')
+            matrix = CensusMatrix.materialize('ACS5', year)
+            if matrix is None:
+                print('⚠️', 'No values to materialize.')
+            else:
+                print('✔️ Done', f'{matrix.values.shape[0]} geogs x {matrix.values.shape[1]} tables')
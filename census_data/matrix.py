@@ -0,0 +1,160 @@
+"""
+Dense, memory-mapped copies of the values in `CensusValue`.
+
+Each dataset-year is materialized into a float matrix file (geography × table, NaN where there's no value)
+along with a small index file that maps geog and table uids to their positions.  Matrices are opened with
+`numpy.memmap`, so every worker process on a machine shares the same pages and lookups are plain fancy indexing.
+
+Enabled with `settings.CENSUS_VALUE_ENGINE = 'matrix'`.  Tables that aren't in a materialized matrix,
+including virtual tables (see `census_data.virtual_tables`), are still read from the database.
+"""
+import itertools
+import json
+import logging
+import os
+from functools import lru_cache
+from typing import Iterable, Optional
+
+import numpy as np
+from django.conf import settings
+
+from census_data.models import CensusValue
+from census_data.virtual_tables import VIRTUAL_TABLE_PREFIX
+
+logger = logging.getLogger(__name__)
+
+MATRIX_DTYPE = np.float64
+
+MATERIALIZE_CHUNK_SIZE = 100000
+
+
+def _matrix_paths(dataset: str, year: int) -> tuple[str, str]:
+    base = os.path.join(settings.CENSUS_MATRIX_DIR, f'{dataset}-{year}')
+    return f'{base}.values.f8', f'{base}.index.json'
+
+
+def dataset_year_from_uid(census_table_uid: str) -> tuple[str, int]:
+    """ Extracts the dataset and year from a table uid like 'ACS5:2019:B01001_001E' """
+    dataset, year, _ = CensusValue.split_table_uid(census_table_uid)
+    return dataset, year
+
+
+class CensusMatrix:
+    def __init__(self, dataset: str, year: int, values: np.ndarray, geog_uids: list[str], table_uids: list[str]):
+        self.dataset = dataset
+        self.year = year
+        self.values = values
+        self.geog_positions: dict[str, int] = {uid: i for i, uid in enumerate(geog_uids)}
+        self.table_positions: dict[str, int] = {uid: i for i, uid in enumerate(table_uids)}
+
+    @staticmethod
+    def load(dataset: str, year: int) -> Optional['CensusMatrix']:
+        """ Returns the matrix for the dataset-year, or `None` if it hasn't been materialized. """
+        values_path, index_path = _matrix_paths(dataset, year)
+        try:
+            modified = os.stat(index_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        # rematerializing replaces the files, so the modification time keeps us from reading stale maps
+        return CensusMatrix._load(dataset, year, modified)
+
+    @staticmethod
+    @lru_cache(maxsize=32)
+    def _load(dataset: str, year: int, _modified: int) -> 'CensusMatrix':
+        values_path, index_path = _matrix_paths(dataset, year)
+        with open(index_path) as f:
+            index = json.load(f)
+        values = np.memmap(values_path, dtype=MATRIX_DTYPE, mode='r', shape=tuple(index['shape']))
+        return CensusMatrix(dataset, year, values, index['geogs'], index['tables'])
+
+    def take(self, geog_uids: list[str], table_uids: list[str]) -> np.ndarray:
+        """ Returns a (geog × table) array of values with NaN for anything not in the matrix. """
+        geog_idx = np.array([self.geog_positions.get(uid, -1) for uid in geog_uids], dtype=np.int64)
+        table_idx = np.array([self.table_positions.get(uid, -1) for uid in table_uids], dtype=np.int64)
+        results = np.full((len(geog_idx), len(table_idx)), np.nan)
+        found_geogs, found_tables = geog_idx >= 0, table_idx >= 0
+        if found_geogs.any() and found_tables.any():
+            results[np.ix_(found_geogs, found_tables)] = self.values[np.ix_(geog_idx[found_geogs],
+                                                                            table_idx[found_tables])]
+        return results
+
+    def get_value_lookup(self, geog_uids: Iterable[str],
+                         table_uids: Iterable[str]) -> dict[tuple[str, str], float]:
+        """ Same as `CensusValue.get_value_lookup` but read from the matrix. """
+        geog_uids, table_uids = list(geog_uids), list(table_uids)
+        values = self.take(geog_uids, table_uids)
+        geog_idx, table_idx = np.nonzero(~np.isnan(values))
+        return {(geog_uids[g], table_uids[t]): float(values[g, t]) for g, t in zip(geog_idx, table_idx)}
+
+    @staticmethod
+    def materialize(dataset: str, year: int) -> Optional['CensusMatrix']:
+        """
+        Writes the values in `CensusValue` for the dataset-year to its matrix and index files.
+
+        :return: the new matrix; `None` if there are no values for the dataset-year
+        """
+        os.makedirs(settings.CENSUS_MATRIX_DIR, exist_ok=True)
+        values_path, index_path = _matrix_paths(dataset, year)
+        # virtual tables are recompiled whenever their variables' tables change, so they're always read from the db
+        census_values = CensusValue.objects.filter(dataset=dataset, year=year) \
+            .exclude(table_id__startswith=VIRTUAL_TABLE_PREFIX)
+
+        geog_uids = sorted(census_values.values_list('geog_uid', flat=True).distinct())
+        table_uids = sorted(census_values.values_list('census_table_uid', flat=True).distinct())
+        geog_positions = {uid: i for i, uid in enumerate(geog_uids)}
+        table_positions = {uid: i for i, uid in enumerate(table_uids)}
+        shape = (len(geog_uids), len(table_uids))
+        if not all(shape):
+            logger.warning(f'No census values found for {dataset} {year}')
+            return None
+        logger.info(f'Materializing {dataset} {year} into a {shape[0]}x{shape[1]} matrix')
+
+        # write next to the current files and swap them in once complete
+        tmp_values_path, tmp_index_path = f'{values_path}.tmp', f'{index_path}.tmp'
+        values = np.memmap(tmp_values_path, dtype=MATRIX_DTYPE, mode='w+', shape=shape)
+        values[:] = np.nan
+        rows = census_values.values_list('geog_uid', 'census_table_uid', 'value').iterator(
+            chunk_size=MATERIALIZE_CHUNK_SIZE)
+        while True:
+            chunk = list(itertools.islice(rows, MATERIALIZE_CHUNK_SIZE))
+            if not chunk:
+                break
+            geog_idx = np.fromiter((geog_positions[row[0]] for row in chunk), dtype=np.int64, count=len(chunk))
+            table_idx = np.fromiter((table_positions[row[1]] for row in chunk), dtype=np.int64, count=len(chunk))
+            values[geog_idx, table_idx] = np.array([row[2] for row in chunk], dtype=MATRIX_DTYPE)
+        values.flush()
+        del values
+
+        with open(tmp_index_path, 'w') as f:
+            json.dump({'shape': shape, 'geogs': geog_uids, 'tables': table_uids}, f)
+        os.replace(tmp_values_path, values_path)
+        os.replace(tmp_index_path, index_path)
+        return CensusMatrix.load(dataset, year)
+
+
+def get_value_lookup(geog_uids: Iterable[str],
+                     census_table_uids: Iterable[str]) -> dict[tuple[str, str], float]:
+    """
+    Reads values from the matrices of the tables' dataset-years, falling back to the database
+    for any tables that haven't been materialized.
+    """
+    geog_uids = list(geog_uids)
+    tables_by_dataset_year: dict[tuple[str, int], list[str]] = {}
+    for uid in census_table_uids:
+        tables_by_dataset_year.setdefault(dataset_year_from_uid(uid), []).append(uid)
+
+    results: dict[tuple[str, str], float] = {}
+    db_table_uids: list[str] = []
+    for (dataset, year), table_uids in tables_by_dataset_year.items():
+        matrix = CensusMatrix.load(dataset, year)
+        if matrix is None:
+            db_table_uids += table_uids
+        else:
+            # tables added since the matrix was made (e.g. virtual tables) are only in the database
+            in_matrix = [uid for uid in table_uids if uid in matrix.table_positions]
+            db_table_uids += [uid for uid in table_uids if uid not in matrix.table_positions]
+            results.update(matrix.get_value_lookup(geog_uids, in_matrix))
+
+    if db_table_uids:
+        results.update(CensusValue.get_db_value_lookup(geog_uids, db_table_uids))
+    return results
@@ -0,0 +1,132 @@
+from django.db import migrations, models
+
+TABLE = 'census_data_censusvalue'
+UNPARTITIONED = f'{TABLE}_unpartitioned'
+
+# moves every value into a table that's range-partitioned on (dataset, year), with one partition per vintage
+PARTITION_SQL = f"""
+ALTER TABLE "{TABLE}" RENAME TO "{UNPARTITIONED}";
+
+CREATE TABLE "{TABLE}" (
+    "id" serial NOT NULL,
+    "geog_uid" varchar(100) NOT NULL,
+    "census_table_uid" varchar(100) NOT NULL,
+    "dataset" varchar(4) NOT NULL,
+    "year" integer NOT NULL,
+    "table_id" varchar(20) NOT NULL,
+    "value" double precision NULL,
+    "raw_value" varchar(20) NULL,
+    CONSTRAINT "census_value_pkey" PRIMARY KEY ("id", "dataset", "year"),
+    CONSTRAINT "census_value_uniq" UNIQUE ("dataset", "year", "geog_uid", "census_table_uid")
+) PARTITION BY RANGE ("dataset", "year");
+
+CREATE INDEX "census_value_table_idx" ON "{TABLE}" ("dataset", "year", "census_table_uid");
+
+DO $$
+DECLARE
+    vintage record;
+BEGIN
+    FOR vintage IN
+        SELECT DISTINCT split_part(census_table_uid, ':', 1) AS dataset,
+                        split_part(census_table_uid, ':', 2)::int AS year
+        FROM "{UNPARTITIONED}"
+    LOOP
+        EXECUTE format('CREATE TABLE %I PARTITION OF "{TABLE}" FOR VALUES FROM (%L, %s) TO (%L, %s)',
+                       '{TABLE}_' || lower(vintage.dataset) || '_' || vintage.year,
+                       vintage.dataset, vintage.year, vintage.dataset, vintage.year + 1);
+    END LOOP;
+END $$;
+
+INSERT INTO "{TABLE}" ("geog_uid", "census_table_uid", "dataset", "year", "table_id", "value", "raw_value")
+SELECT "geog_uid",
+       "census_table_uid",
+       split_part("census_table_uid", ':', 1),
+       split_part("census_table_uid", ':', 2)::int,
+       split_part("census_table_uid", ':', 3),
+       "value",
+       "raw_value"
+FROM "{UNPARTITIONED}";
+
+DROP TABLE "{UNPARTITIONED}";
+"""
+
+UNPARTITION_SQL = f"""
+ALTER TABLE "{TABLE}" RENAME TO "{TABLE}_partitioned";
+
+CREATE TABLE "{TABLE}" (
+    "id" serial NOT NULL PRIMARY KEY,
+    "geog_uid" varchar(100) NOT NULL,
+    "census_table_uid" varchar(100) NOT NULL,
+    "value" double precision NULL,
+    "raw_value" varchar(20) NULL,
+    UNIQUE ("geog_uid", "census_table_uid")
+);
+CREATE INDEX ON "{TABLE}" ("geog_uid");
+CREATE INDEX ON "{TABLE}" ("census_table_uid");
+
+INSERT INTO "{TABLE}" ("geog_uid", "census_table_uid", "value", "raw_value")
+SELECT "geog_uid", "census_table_uid", "value", "raw_value"
+FROM "{TABLE}_partitioned";
+
+DROP TABLE "{TABLE}_partitioned";
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('census_data', '0005_alter_censustablerecord_year'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(PARTITION_SQL, reverse_sql=UNPARTITION_SQL),
+            ],
+            state_operations=[
+                migrations.AlterUniqueTogether(
+                    name='censusvalue',
+                    unique_together=set(),
+                ),
+                migrations.AlterIndexTogether(
+                    name='censusvalue',
+                    index_together=set(),
+                ),
+                migrations.AlterField(
+                    model_name='censusvalue',
+                    name='census_table_uid',
+                    field=models.CharField(max_length=100),
+                ),
+                migrations.AlterField(
+                    model_name='censusvalue',
+                    name='geog_uid',
+                    field=models.CharField(max_length=100),
+                ),
+                migrations.AddField(
+                    model_name='censusvalue',
+                    name='dataset',
+                    field=models.CharField(choices=[('CEN', 'Decennial Census'), ('ACS5', 'ACS 5-year'), ('ACS1', 'ACS 1-year')], default='ACS5', max_length=4),
+                    preserve_default=False,
+                ),
+                migrations.AddField(
+                    model_name='censusvalue',
+                    name='year',
+                    field=models.IntegerField(default=2019),
+                    preserve_default=False,
+                ),
+                migrations.AddField(
+                    model_name='censusvalue',
+                    name='table_id',
+                    field=models.CharField(default='', max_length=20),
+                    preserve_default=False,
+                ),
+                migrations.AddConstraint(
+                    model_name='censusvalue',
+                    constraint=models.UniqueConstraint(fields=('dataset', 'year', 'geog_uid', 'census_table_uid'), name='census_value_uniq'),
+                ),
+                migrations.AddIndex(
+                    model_name='censusvalue',
+                    index=models.Index(fields=['dataset', 'year', 'census_table_uid'], name='census_value_table_idx'),
+                ),
+            ],
+        ),
+    ]
@@ -1,5 +1,6 @@
-from typing import Optional, TYPE_CHECKING, Tuple, List
+from typing import Optional, TYPE_CHECKING, Tuple, List, Iterable
 
+from django.conf import settings
 from django.core import validators
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
@@ -87,17 +88,74 @@ class CensusTableRecord(models.Model):
 class CensusValue(models.Model):
     """
     Stores a single (geography, table, value) tuple
+
+    The table is partitioned by dataset and year (see `census_data.partitions`), so queries
+    should filter on `dataset` and `year` to only hit the partitions they need.
     """
     # unique IDs generated by models. decouples the relationship between geographies
-    geog_uid = models.CharField(max_length=100, db_index=True)
-    census_table_uid = models.CharField(max_length=100, db_index=True)
+    geog_uid = models.CharField(max_length=100)
+    census_table_uid = models.CharField(max_length=100)
+
+    # the parts of `census_table_uid`, stored separately to partition on
+    dataset = models.CharField(max_length=4, choices=DATASET_CHOICES)
+    year = models.IntegerField()
+    table_id = models.CharField(max_length=20)
 
     value = models.FloatField(null=True, blank=True)
     raw_value = models.CharField(max_length=20, null=True, blank=True)
 
     class Meta:
-        index_together = ('geog_uid', 'census_table_uid',)
-        unique_together = ('geog_uid', 'census_table_uid',)
+        constraints = [
+            models.UniqueConstraint(fields=('dataset', 'year', 'geog_uid', 'census_table_uid'),
+                                    name='census_value_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=('dataset', 'year', 'census_table_uid'), name='census_value_table_idx'),
+        ]
+
+    @staticmethod
+    def geog_uid_for(geog: 'AdminRegion') -> str:
+        """ The `geog_uid` values for `geog` are stored under: its affgeoid for census geogs, its uid otherwise """
+        return getattr(geog, 'affgeoid', None) or geog.uid
+
+    @staticmethod
+    def split_table_uid(census_table_uid: str) -> Tuple[str, int, str]:
+        """ Splits a table uid like 'ACS5:2019:B01001_001E' into its dataset, year and table id """
+        dataset, year, table_id = census_table_uid.split(':', 2)
+        return dataset, int(year), table_id
+
+    @staticmethod
+    def get_value_lookup(geog_uids: Iterable[str],
+                         census_table_uids: Iterable[str]) -> dict[Tuple[str, str], float]:
+        """
+        Returns a dict mapping (geog_uid, census_table_uid) to value for every combination that has a value.
+        Null (e.g. suppressed) values are left out, as if they weren't stored.
+
+        Values are read using the engine set in `settings.CENSUS_VALUE_ENGINE`.
+        """
+        if settings.CENSUS_VALUE_ENGINE == 'matrix':
+            from census_data import matrix
+            return matrix.get_value_lookup(geog_uids, census_table_uids)
+        return CensusValue.get_db_value_lookup(geog_uids, census_table_uids)
+
+    @staticmethod
+    def get_db_value_lookup(geog_uids: Iterable[str],
+                            census_table_uids: Iterable[str]) -> dict[Tuple[str, str], float]:
+        """ `get_value_lookup` read directly from the database """
+        # filtering on each vintage lets postgres prune the partitions it doesn't need
+        tables_by_vintage: dict[Tuple[str, int], List[str]] = {}
+        for uid in census_table_uids:
+            dataset, year, _ = CensusValue.split_table_uid(uid)
+            tables_by_vintage.setdefault((dataset, year), []).append(uid)
+        if not tables_by_vintage:
+            return {}
+
+        vintage_filter = models.Q()
+        for (dataset, year), table_uids in tables_by_vintage.items():
+            vintage_filter |= models.Q(dataset=dataset, year=year, census_table_uid__in=table_uids)
+        return {(geog_uid, census_table_uid): value for geog_uid, census_table_uid, value in
+                CensusValue.objects.filter(vintage_filter, geog_uid__in=list(geog_uids), value__isnull=False)
+                .values_list('geog_uid', 'census_table_uid', 'value')}
 
     def __str__(self):
         return f'{self.census_table_uid}/{self.geog_uid} [{self.value}]'
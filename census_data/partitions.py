@@ -0,0 +1,133 @@
+"""
+Management of the partitions of `CensusValue`.
+
+`census_data_censusvalue` is range-partitioned on (dataset, year), with one partition per vintage,
+e.g. `census_data_censusvalue_acs5_2019` holds everything from ('ACS5', 2019) up to ('ACS5', 2020).
+Filtering on `dataset` and `year` lets Postgres prune lookups to a single partition.
+
+A vintage can be reloaded without touching the live data by loading it into a staging table
+(`create_staging`) and then swapping that in for the current partition (`swap`) in one transaction.
+"""
+import logging
+from typing import Optional
+
+from django.db import connection, transaction
+
+from census_data.models import CensusValue
+
+logger = logging.getLogger(__name__)
+
+PARENT_TABLE = CensusValue._meta.db_table
+
+
+def partition_name(dataset: str, year: int) -> str:
+    return f'{PARENT_TABLE}_{dataset.lower()}_{int(year)}'
+
+
+def staging_name(dataset: str, year: int) -> str:
+    return f'{partition_name(dataset, year)}_next'
+
+
+def _bounds(dataset: str, year: int) -> str:
+    return f"FROM ('{dataset}', {int(year)}) TO ('{dataset}', {int(year) + 1})"
+
+
+def _check_dataset(dataset: str):
+    if not dataset.isalnum():
+        raise ValueError(f'Invalid dataset "{dataset}"')
+
+
+def list_partitions() -> list[tuple[str, str]]:
+    """ Returns the name and bounds of every partition currently attached to `CensusValue`'s table. """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+            FROM pg_inherits
+                JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+                JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+            WHERE parent.relname = %s
+            ORDER BY child.relname
+        """, [PARENT_TABLE])
+        return cursor.fetchall()
+
+
+def table_exists(table: str) -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT to_regclass(%s) IS NOT NULL', [table])
+        return cursor.fetchone()[0]
+
+
+def ensure_partition(dataset: str, year: int) -> str:
+    """ Creates the partition for a vintage if it doesn't exist yet. """
+    _check_dataset(dataset)
+    name = partition_name(dataset, year)
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{PARENT_TABLE}" '
+                       f'FOR VALUES {_bounds(dataset, year)}')
+    return name
+
+
+def create_staging(dataset: str, year: int) -> str:
+    """
+    Creates an empty, detached table for loading a new copy of a vintage into.
+
+    It has the same columns, defaults and indexes as the partitions, plus a check constraint
+    that lets it be attached without Postgres having to scan it.
+    """
+    _check_dataset(dataset)
+    name = staging_name(dataset, year)
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS "{name}"')
+        cursor.execute(f'CREATE TABLE "{name}" (LIKE "{PARENT_TABLE}" INCLUDING DEFAULTS INCLUDING INDEXES)')
+        cursor.execute(f'ALTER TABLE "{name}" ADD CONSTRAINT "{name}_vintage" '
+                       f"CHECK (dataset = '{dataset}' AND year = {int(year)})")
+    return name
+
+
+def attach(dataset: str, year: int, table: Optional[str] = None) -> str:
+    """ Attaches `table` (by default a detached partition with the vintage's name) as the vintage's partition. """
+    _check_dataset(dataset)
+    name = partition_name(dataset, year)
+    table = table or name
+    with transaction.atomic(), connection.cursor() as cursor:
+        if table != name:
+            cursor.execute(f'ALTER TABLE "{table}" RENAME TO "{name}"')
+        cursor.execute(f'ALTER TABLE "{PARENT_TABLE}" ATTACH PARTITION "{name}" FOR VALUES {_bounds(dataset, year)}')
+    logger.info(f'Attached {name}')
+    return name
+
+
+def detach(dataset: str, year: int, rename_to: Optional[str] = None) -> str:
+    """
+    Detaches a vintage's partition, leaving it as a standalone table.
+
+    :return: the name of the detached table
+    """
+    name = partition_name(dataset, year)
+    rename_to = rename_to or f'{name}_detached'
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE "{PARENT_TABLE}" DETACH PARTITION "{name}"')
+        cursor.execute(f'DROP TABLE IF EXISTS "{rename_to}"')
+        cursor.execute(f'ALTER TABLE "{name}" RENAME TO "{rename_to}"')
+    logger.info(f'Detached {name} as {rename_to}')
+    return rename_to
+
+
+def swap(dataset: str, year: int, table: str, keep_old: bool = False) -> Optional[str]:
+    """
+    Replaces a vintage's partition with `table` in a single transaction.
+
+    :param keep_old: keep the old partition around as a detached table instead of dropping it
+    :return: the name of the old partition's table if it was kept
+    """
+    name = partition_name(dataset, year)
+    old_table = None
+    with transaction.atomic():
+        if table_exists(name):
+            old_table = detach(dataset, year, rename_to=f'{name}_old')
+        attach(dataset, year, table)
+        if old_table and not keep_old:
+            with connection.cursor() as cursor:
+                cursor.execute(f'DROP TABLE "{old_table}"')
+            old_table = None
+    return old_table
@@ -1,3 +1,297 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+import zipfile
 
-# Create your tests here.
+import pandas as pd
+from django.contrib.gis.geos import GEOSGeometry
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from openpyxl import Workbook
+
+from census_data import matrix
+from census_data.composites import materialize_composites
+from census_data.management.commands import _census_pipeline as census_pipeline, _load_census as census_loader
+from census_data.management.commands._census_pipeline import LocalFetcher, PipelineState, DOWNLOADED, PARSED, \
+    LOADED, FAILED
+from census_data.management.commands._geo_lookup import GeoLookup
+from census_data.management.commands._load_census import census_values_from_chunk, CENSUS_VALUE_COLUMNS, \
+    CENSUS_VALUE_CONFLICT_COLUMNS
+from census_data.models import CensusValue, CensusTableRecord
+from census_data.partitions import ensure_partition
+from census_data.virtual_tables import virtual_table_uid, compile_virtual_table
+from geo.models import Tract, Neighborhood
+from profiles.db import copy_upsert
+
+TABLE_UIDS = ['ACS5:2019:B01001_001E', 'ACS5:2019:B01001_002E']
+
+SQUARE = 'SRID=4326;MULTIPOLYGON(((-80 40, -80 40.1, -79.9 40.1, -79.9 40, -80 40)))'
+
+
+def make_tract(geoid: str) -> Tract:
+    return Tract.objects.create(
+        name=geoid, global_geoid=geoid, geoid=geoid, affgeoid=f'1400000US{geoid}', lsad='CT', aland=1, awater=0,
+        statefp=geoid[:2], countyfp=geoid[2:5], tractce=geoid[5:], geom=GEOSGeometry(SQUARE),
+    )
+
+
+def make_neighborhood(name: str, tracts: list[Tract]) -> Neighborhood:
+    return Neighborhood.objects.create(name=name, global_geoid=name.lower(), geom=GEOSGeometry(SQUARE),
+                                       subregions={Tract.geog_type_id: [tract.global_geoid for tract in tracts]})
+
+
+def sample_geo_lookup() -> GeoLookup:
+    return GeoLookup.build(
+        pd.Series([1, 2, 3]),
+        pd.Series(['1400000US42003010300', '1400000US42003010400', '1400000US36001000100']),
+    )
+
+
+def sample_chunk() -> pd.DataFrame:
+    """ Three rows of a sequence file, with a suppressed ('.') and a blank value. """
+    return pd.DataFrame([
+        ['ACSSF', '2019e5', 'pa', '000', '0003', '0000001', '100', '.'],
+        ['ACSSF', '2019e5', 'pa', '000', '0003', '0000002', '', '25'],
+        ['ACSSF', '2019e5', 'pa', '000', '0003', '0000003', '7', '8'],  # outside of COUNTIES
+    ])
+
+
+class CensusValuesFromChunkTests(SimpleTestCase):
+    def setUp(self):
+        self.values = census_values_from_chunk(sample_chunk(), TABLE_UIDS, sample_geo_lookup())
+
+    def _value(self, geog_uid, table_uid) -> dict:
+        row = self.values[(self.values['geog_uid'] == geog_uid) & (self.values['census_table_uid'] == table_uid)]
+        return row.iloc[0].to_dict()
+
+    def test_columns(self):
+        self.assertEqual(tuple(self.values.columns), CENSUS_VALUE_COLUMNS)
+
+    def test_drops_geogs_outside_counties(self):
+        self.assertEqual(set(self.values['geog_uid']), {'1400000US42003010300', '1400000US42003010400'})
+        self.assertEqual(len(self.values), 4)
+
+    def test_non_numeric_values_are_none(self):
+        suppressed = self._value('1400000US42003010300', 'ACS5:2019:B01001_002E')
+        self.assertIsNone(suppressed['value'])
+        self.assertEqual(suppressed['raw_value'], '.')
+        blank = self._value('1400000US42003010400', 'ACS5:2019:B01001_001E')
+        self.assertIsNone(blank['value'])
+
+    def test_numeric_values(self):
+        value = self._value('1400000US42003010300', 'ACS5:2019:B01001_001E')
+        self.assertEqual(value['value'], 100)
+        self.assertEqual((value['dataset'], value['year'], value['table_id']), ('ACS5', 2019, 'B01001_001E'))
+
+
+class InsertCensusValuesTests(TestCase):
+    def test_suppressed_values_are_stored_as_null(self):
+        values = census_values_from_chunk(sample_chunk(), TABLE_UIDS, sample_geo_lookup())
+        count = copy_upsert(ensure_partition('ACS5', 2019), columns=CENSUS_VALUE_COLUMNS,
+                            rows=values.itertuples(index=False, name=None),
+                            conflict_columns=CENSUS_VALUE_CONFLICT_COLUMNS)
+        self.assertEqual(count, 4)
+        suppressed = CensusValue.objects.get(geog_uid='1400000US42003010300',
+                                             census_table_uid='ACS5:2019:B01001_002E')
+        self.assertIsNone(suppressed.value)
+        self.assertEqual(suppressed.raw_value, '.')
+        self.assertEqual(CensusValue.objects.filter(dataset='ACS5', year=2019, value__isnull=True).count(), 2)
+
+
+class PipelineStateTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'state.json')
+
+    def test_stages_are_ordered(self):
+        state = PipelineState(self.path)
+        state.set(1, PARSED)
+        self.assertTrue(state.has_reached(1, DOWNLOADED))
+        self.assertTrue(state.has_reached(1, PARSED))
+        self.assertFalse(state.has_reached(1, LOADED))
+        self.assertFalse(state.has_reached(2, DOWNLOADED))
+
+    def test_failed_sequences_start_over(self):
+        state = PipelineState(self.path)
+        state.set(1, FAILED, error='boom')
+        self.assertFalse(state.has_reached(1, DOWNLOADED))
+
+    def test_progress_is_persisted(self):
+        PipelineState(self.path).set(3, PARSED, parsed_path='seq3.csv', tables=[['B01001', 'Sex by Age']])
+        resumed = PipelineState(self.path)
+        self.assertEqual(resumed.stage(3), PARSED)
+        self.assertEqual(resumed.sequences['3']['tables'], [['B01001', 'Sex by Age']])
+
+
+class SequenceFetcher(LocalFetcher):
+    """ Fails to fetch sequence files, so tests can tell whether the pipeline tried to download them. """
+
+    def fetch(self, remote_path: str, local_path: str):
+        if census_loader.FIVE_YEAR_DIRNAME in remote_path:
+            raise ConnectionError(f'Fetched {remote_path}')
+        super().fetch(remote_path, local_path)
+
+
+class CensusPipelineTests(TransactionTestCase):
+    """ Runs the pipeline for a single small sequence served from a local directory laid out like the FTP server. """
+    year = 2019
+    tables = [['B01001_001', 'Total'], ['B01001_002', 'Male']]
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        override = self.settings(BASE_DIR=self.tmp)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.root = os.path.join(self.tmp, 'ftp')
+        self._make_templates()
+        # tracts and block groups are in one file, other geographies in another
+        self._make_sequence(census_loader.get_ftp_dirs(self.year)[0], '0000001', ['100', '.'])
+        self._make_sequence(census_loader.get_ftp_dirs(self.year)[1], '0000002', ['2000', '1000'])
+        GeoLookup.build(
+            pd.Series([1, 2]), pd.Series(['1400000US42003010300', '0500000US42003'])
+        ).save(census_loader.get_lookup_base_path(f'{self.year}{census_loader.ST}'))
+
+    def _remote_dir(self, remote_dir: str) -> str:
+        path = os.path.join(self.root, remote_dir.lstrip('/'))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _make_templates(self):
+        wb = Workbook()
+        sheet = wb.active
+        sheet.title = 'e'
+        sheet.append(['FILEID', 'FILETYPE', 'STUSAB', 'CHARITER', 'SEQUENCE', 'LOGRECNO']
+                     + [table_id for table_id, _ in self.tables])
+        sheet.append([''] * 6 + [description for _, description in self.tables])
+        xlsx_path = os.path.join(self.tmp, 'seq1.xlsx')
+        wb.save(xlsx_path)
+        data_dir = self._remote_dir(census_loader.get_ftp_data_dir(self.year))
+        with zipfile.ZipFile(os.path.join(data_dir, census_loader.TEMPLATE_FILENAME), 'w') as zf:
+            zf.write(xlsx_path, 'seq1.xlsx')
+
+    def _make_sequence(self, remote_dir: str, logrecno: str, values: list[str]):
+        data_fname = f'{self.year}5{census_loader.ST}0001000'
+        with zipfile.ZipFile(os.path.join(self._remote_dir(remote_dir), f'{data_fname}.zip'), 'w') as zf:
+            for mode in ('e', 'm'):
+                row = ['ACSSF', f'{self.year}{mode}5', census_loader.ST, '000', '0001', logrecno] + values
+                zf.writestr(f'{mode}{data_fname}.txt', ','.join(row) + '\n')
+
+    def _run(self, fetcher=None, **kwargs) -> dict[int, str]:
+        return census_pipeline.run(1, 1, year=self.year, fetcher=fetcher or LocalFetcher(self.root),
+                                   parse_workers=1, load_workers=1, **kwargs)
+
+    def _values(self):
+        return CensusValue.objects.filter(dataset='ACS5', year=self.year)
+
+    def _state(self) -> PipelineState:
+        table = ensure_partition('ACS5', self.year)
+        return PipelineState(os.path.join(census_loader.get_base_dl_dir(self.year), f'pipeline_state.{table}.json'))
+
+    def test_loads_sequence_offline(self):
+        self.assertEqual(self._run(), {})
+        self.assertEqual(self._state().stage(1), LOADED)
+        # 2 geogs × 2 tables × estimates and MOEs
+        self.assertEqual(self._values().count(), 8)
+        self.assertEqual(self._values().get(geog_uid='0500000US42003', census_table_uid='ACS5:2019:B01001_001E').value,
+                         2000)
+        suppressed = self._values().get(geog_uid='1400000US42003010300', census_table_uid='ACS5:2019:B01001_002E')
+        self.assertIsNone(suppressed.value)
+        self.assertEqual(suppressed.raw_value, '.')
+
+    def test_skips_loaded_sequences(self):
+        self._run()
+        self._values().delete()
+        self.assertEqual(self._run(fetcher=SequenceFetcher(self.root)), {})
+        self.assertEqual(self._values().count(), 0)
+
+    def test_retries_failed_sequences(self):
+        failures = self._run(fetcher=SequenceFetcher(self.root))
+        self.assertIn(1, failures)
+        self.assertEqual(self._state().stage(1), FAILED)
+        self.assertEqual(self._run(), {})
+        self.assertEqual(self._values().count(), 8)
+
+    def test_resumes_parsed_sequences_without_downloading(self):
+        self._run()
+        self._values().delete()
+        parsed_path = os.path.join(census_pipeline.get_pipeline_dirs(self.year)[1], 'seq1.csv')
+        self._state().set(1, PARSED, parsed_path=parsed_path, tables=self.tables)
+        self.assertEqual(self._run(fetcher=SequenceFetcher(self.root)), {})
+        self.assertEqual(self._values().count(), 8)
+
+
+class MaterializeCompositesTests(TestCase):
+    def setUp(self):
+        self.tracts = [make_tract('42003010300'), make_tract('42003010400')]
+        self.neighborhood = make_neighborhood('Downtown', self.tracts)
+        CensusTableRecord.objects.create(table_id='B01001_001', description='Total', dataset='ACS5', year=2019)
+        self.table = ensure_partition('ACS5', 2019)
+        rows = []
+        for tract, (value, margin) in zip(self.tracts, ((100, 3), (50, 4))):
+            rows += [(tract.affgeoid, 'ACS5:2019:B01001_001E', 'ACS5', 2019, 'B01001_001E', value, str(value)),
+                     (tract.affgeoid, 'ACS5:2019:B01001_001M', 'ACS5', 2019, 'B01001_001M', margin, str(margin))]
+        copy_upsert(self.table, CENSUS_VALUE_COLUMNS, rows, CENSUS_VALUE_CONFLICT_COLUMNS)
+
+    def _composite_value(self, table_uid: str) -> CensusValue:
+        return CensusValue.objects.get(dataset='ACS5', year=2019, census_table_uid=table_uid,
+                                       geog_uid=CensusValue.geog_uid_for(self.neighborhood))
+
+    def test_sums_estimates_and_propagates_moes(self):
+        self.assertEqual(materialize_composites('ACS5', 2019, table=self.table), 2)
+        self.assertEqual(self._composite_value('ACS5:2019:B01001_001E').value, 150)
+        self.assertAlmostEqual(self._composite_value('ACS5:2019:B01001_001M').value, 5)
+
+    def test_raw_values_are_null(self):
+        materialize_composites('ACS5', 2019, table=self.table)
+        self.assertIsNone(self._composite_value('ACS5:2019:B01001_001E').raw_value)
+
+    def test_only_reads_the_vintage(self):
+        other_table = ensure_partition('ACS5', 2018)
+        copy_upsert(other_table, CENSUS_VALUE_COLUMNS,
+                    [(self.tracts[0].affgeoid, 'ACS5:2019:B01001_001E', 'ACS5', 2018, 'B01001_001E', 1000, '1000')],
+                    CENSUS_VALUE_CONFLICT_COLUMNS)
+        # read through the parent table, where other vintages are visible
+        materialize_composites('ACS5', 2019)
+        self.assertEqual(self._composite_value('ACS5:2019:B01001_001E').value, 150)
+
+
+class CensusMatrixTests(TestCase):
+    geog_uid = '1400000US42003010300'
+
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        override = self.settings(CENSUS_MATRIX_DIR=tmp)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.table = ensure_partition('ACS5', 2019)
+        self._add_values([('ACS5:2019:B01001_002E', 60), ('ACS5:2019:B01001_026E', 40)])
+        matrix.CensusMatrix.materialize('ACS5', 2019)
+
+    def _add_values(self, values: list[tuple[str, float]]):
+        copy_upsert(self.table, CENSUS_VALUE_COLUMNS,
+                    [(self.geog_uid, uid, *CensusValue.split_table_uid(uid), value, str(value)) for uid, value in values],
+                    CENSUS_VALUE_CONFLICT_COLUMNS)
+
+    def test_reads_tables_added_after_materializing_from_db(self):
+        self._add_values([('ACS5:2019:B01001_001E', 100)])
+        lookup = matrix.get_value_lookup([self.geog_uid], ['ACS5:2019:B01001_001E', 'ACS5:2019:B01001_002E'])
+        self.assertEqual(lookup, {(self.geog_uid, 'ACS5:2019:B01001_001E'): 100,
+                                  (self.geog_uid, 'ACS5:2019:B01001_002E'): 60})
+
+    def test_reads_recompiled_virtual_tables_from_db(self):
+        uid = virtual_table_uid('ACS5', 2019, 1)
+        compile_virtual_table(uid, ['ACS5:2019:B01001_002E', 'ACS5:2019:B01001_026E'], [])
+        matrix.CensusMatrix.materialize('ACS5', 2019)
+        compile_virtual_table(uid, ['ACS5:2019:B01001_002E'], [])
+        self.assertEqual(matrix.get_value_lookup([self.geog_uid], [f'{uid}E']), {(self.geog_uid, f'{uid}E'): 60})
+
+    def test_engines_leave_out_null_values(self):
+        self._add_values([('ACS5:2019:B01001_001E', None)])
+        matrix.CensusMatrix.materialize('ACS5', 2019)
+        table_uids = ['ACS5:2019:B01001_001E', 'ACS5:2019:B01001_002E']
+        expected = {(self.geog_uid, 'ACS5:2019:B01001_002E'): 60}
+        self.assertEqual(matrix.get_value_lookup([self.geog_uid], table_uids), expected)
+        self.assertEqual(CensusValue.get_db_value_lookup([self.geog_uid], table_uids), expected)
@@ -0,0 +1,62 @@
+"""
+Virtual tables: census tables whose values are precomputed sums of other tables.
+
+Variables made from several census tables (e.g. age brackets or income bands) would otherwise have to
+sum those tables for every geography on every request.  Instead, the sums are compiled ahead of time and
+stored in `CensusValue` under a single table uid, so looking them up costs the same as any other table.
+
+Sums match the ones made at request time: missing values are skipped and the sum is NULL if
+they're all missing, while MOEs are combined with root-sum-of-squares.
+"""
+import logging
+from typing import Optional
+
+from django.db import connection, transaction
+
+from census_data.models import CensusValue
+
+logger = logging.getLogger(__name__)
+
+VIRTUAL_TABLE_PREFIX = '_VT'
+
+
+def virtual_table_uid(dataset: str, year: int, key) -> str:
+    """ The uid for a virtual table, without the E/M suffix used for its value and MOE tables. """
+    return f'{dataset}:{int(year)}:{VIRTUAL_TABLE_PREFIX}{key}'
+
+
+def compile_virtual_table(uid: str, value_uids: list[str], moe_uids: list[str], table: Optional[str] = None) -> int:
+    """
+    Replaces the values of the virtual table `uid` with the sums of the tables in `value_uids` and `moe_uids`.
+
+    :param uid: the virtual table's uid from `virtual_table_uid`
+    :param table: table the values are read from and written to; defaults to `CensusValue`'s table
+    :return: number of values written
+    """
+    table = table or CensusValue._meta.db_table
+    dataset, year, table_id = CensusValue.split_table_uid(uid)
+    count = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM "{table}" WHERE dataset = %s AND year = %s AND census_table_uid = ANY(%s)',
+                       [dataset, year, [f'{uid}E', f'{uid}M']])
+        for suffix, source_uids, aggregate in (('E', value_uids, 'sum(value)'),
+                                               ('M', moe_uids, 'sqrt(sum(value * value))')):
+            if not source_uids:
+                continue
+            cursor.execute(f"""
+                INSERT INTO "{table}" (geog_uid, census_table_uid, dataset, year, table_id, value, raw_value)
+                SELECT geog_uid, %(uid)s, %(dataset)s, %(year)s, %(table_id)s, {aggregate}, NULL
+                FROM "{table}"
+                WHERE dataset = %(dataset)s AND year = %(year)s AND census_table_uid = ANY(%(source_uids)s)
+                GROUP BY geog_uid
+            """, {'uid': f'{uid}{suffix}', 'dataset': dataset, 'year': year,
+                  'table_id': f'{table_id}{suffix}', 'source_uids': source_uids})
+            count += cursor.rowcount
+    logger.info(f'Compiled {count} values for {uid}')
+    return count
+
+
+def drop_virtual_table(uid: str):
+    """ Deletes the values of the virtual table `uid`. """
+    dataset, year, _ = CensusValue.split_table_uid(uid)
+    CensusValue.objects.filter(dataset=dataset, year=year, census_table_uid__in=[f'{uid}E', f'{uid}M']).delete()
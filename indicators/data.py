@@ -1,11 +1,10 @@
 from dataclasses import dataclass, field, replace
-from typing import Type, List, Optional, TYPE_CHECKING, Collection, Iterable, Union
+from typing import Type, List, Optional, TYPE_CHECKING, Iterable, Iterator, Union
 
 from django.db.models import QuerySet, TextChoices
 from django.utils.translation import gettext_lazy as _
 
 from geo.models import AdminRegion
-from indicators.errors import AggregationError
 from profiles.settings import DENOM_DKEY, VALUE_DKEY, GEOG_DKEY, TIME_DKEY
 
 if TYPE_CHECKING:
@@ -23,15 +22,6 @@ class AggregationMethod(TextChoices):
     MIN = 'MIN', _('Minimum'),
 
 
-def aggregate_data(data: Collection[int or float], method: 'AggregationMethod'):
-    if method == AggregationMethod.SUM:
-        return sum(data)
-    if method == AggregationMethod.MEAN:
-        return sum(data) / len(data)
-    else:
-        raise AggregationError(f'{method} not available on ACS or Census values.')
-
-
 @dataclass
 class GeogCollection:
     """
@@ -54,11 +44,22 @@ class GeogCollection:
         return AdminRegion.objects.filter(global_geoid__in=self.records.keys())
 
     @property
-    def all_subgeogs(self) -> QuerySet['AdminRegion']:
+    def global_geoids(self) -> list[str]:
+        """ The geoids of the geogs in `all_geogs`; avoids the spatial query when there's no extent to check. """
+        if self.geographic_extent:
+            return list(self.all_geogs.values_list('global_geoid', flat=True))
+        return list(self.records.keys())
+
+    @property
+    def subgeog_global_geoids(self) -> list[str]:
         all_subgeog_geoids = []
         for geog_record in self.records.values():
             all_subgeog_geoids += [sg.global_geoid for sg in geog_record.subgeogs]
-        return AdminRegion.objects.filter(global_geoid__in=all_subgeog_geoids)
+        return all_subgeog_geoids
+
+    @property
+    def all_subgeogs(self) -> QuerySet['AdminRegion']:
+        return AdminRegion.objects.filter(global_geoid__in=self.subgeog_global_geoids)
 
     @property
     def is_divided(self):
@@ -71,6 +72,16 @@ class GeogCollection:
 
         return self._divided
 
+    def subset(self, global_geoids: Iterable[str]) -> 'GeogCollection':
+        """ Returns a new collection with only the records for geogs in `global_geoids` """
+        geoids = set(global_geoids)
+        return GeogCollection(
+            geog_type=self.geog_type,
+            primary_geog=self.primary_geog,
+            geographic_extent=self.geographic_extent,
+            records={geoid: record for (geoid, record) in self.records.items() if geoid in geoids},
+        )
+
     def filter_records_by_subgeog_ownership(self, subgeogs: set['AdminRegion']) -> dict[str, 'GeogRecord']:
         """ Returns `self.records` filtered to those records with at least one subgeog in `subgeogs` """
         record: 'GeogRecord'
@@ -125,38 +136,6 @@ class GeogRecord:
     def is_divided(self) -> bool:
         return self.geog_class != self.subgeog_class
 
-    def get_aggregate_data(
-            self,
-            variable: 'Variable',
-            time_part_lookup: dict[str, 'TimeAxis.TimePart'],
-            use_denom: bool
-    ) -> dict[str, 'Datum']:
-        """
-        Generates a representation of the data in this record aggregated across geography so that
-        it describes the primary geography `geog` across whatever TimeParts were used to find data for this record.
-
-        :returns: a dict mapping TimePart slugs to Datum for this instance's `geog` at the time.
-        """
-        # if this is a direct record, then we don't need to perform any aggregation
-        if not self.is_divided:
-            return self.data_by_subgeog[self.geog.global_geoid]
-
-        # if we need to perform agg_method
-        agg_method: AggregationMethod = variable.aggregation_method
-        results: dict[str, 'Datum'] = {}
-        for time_part_hash, subgeog_record in self.data_by_time_part.items():
-            # aggregate values and save them
-            data = subgeog_record.values()
-            results[time_part_hash] = Datum(
-                variable=variable,
-                geog=self.geog,
-                time=time_part_lookup[time_part_hash],
-                value=aggregate_data([datum.value for datum in data], agg_method),
-                # todo: figure out margin of error
-                denom=aggregate_data([datum.denom for datum in data], agg_method) if use_denom else None,
-            )
-        return results
-
     def add_time_part_records(self, subgeog: 'AdminRegion', records: dict[str, 'Datum']) -> int:
         """
         Generates and adds TimePart records a dict mapping time_part slugs to data.
@@ -194,6 +173,7 @@ class Datum:
 
     denom: Optional[float] = None
     percent: Optional[float] = None
+    percent_moe: Optional[float] = None
 
     def __post_init__(self):
         if self.denom and self.value:
@@ -201,7 +181,8 @@ class Datum:
 
     @property
     def data(self):
-        return {'value': self.value, 'moe': self.moe, 'percent': self.percent, 'denom': self.denom}
+        return {'value': self.value, 'moe': self.moe, 'percent': self.percent, 'percent_moe': self.percent_moe,
+                'denom': self.denom}
 
     @staticmethod
     def from_ckan_response_datum(
@@ -230,6 +211,30 @@ class Datum:
     ) -> List['Datum']:
         return [Datum.from_ckan_response_datum(variable, ckan_datum, time_part_lookup) for ckan_datum in ckan_data]
 
+    @staticmethod
+    def from_ckan_response_batches(
+            variable: 'CKANVariable',
+            batches: Iterable[tuple[tuple[str, ...], list[tuple]]],
+            time_part_lookup: dict[str, 'TimeAxis.TimePart']
+    ) -> Iterator['Datum']:
+        """
+        Builds Datums as batches of rows are streamed from the datastore (see `DatastorePool.stream`),
+        looking up the geogs for each batch at once.
+        """
+        for columns, rows in batches:
+            geog_i, time_i, value_i = columns.index(GEOG_DKEY), columns.index(TIME_DKEY), columns.index(VALUE_DKEY)
+            denom_i = columns.index(DENOM_DKEY) if DENOM_DKEY in columns else None
+            geogs = AdminRegion.objects.in_bulk({row[geog_i] for row in rows}, field_name='global_geoid')
+            for row in rows:
+                value = row[value_i]
+                denom = row[denom_i] if denom_i is not None else None
+                yield Datum(variable=variable,
+                            geog=geogs[row[geog_i]],
+                            time=time_part_lookup[row[time_i]],
+                            value=value,
+                            denom=denom,
+                            percent=(value / denom) if value is not None and denom else None)
+
     def update(self, **kwargs):
         """ Creates new Datum similar to the instance with new values from kwargs """
         return Datum(**{**self.as_dict(), **kwargs})
@@ -240,9 +245,11 @@ class Datum:
 
     def as_dict(self) -> dict:
         return {'variable': self.variable, 'geog': self.geog, 'time': self.time,
-                'value': self.value, 'moe': self.moe, 'percent': self.percent, 'denom': self.denom}
+                'value': self.value, 'moe': self.moe, 'percent': self.percent, 'percent_moe': self.percent_moe,
+                'denom': self.denom}
 
     def as_json_dict(self) -> dict:
         """ Same as `as_dict` but with complex datatypes represented by slug """
         return {'variable': self.variable.slug, 'geog': self.geog.slug, 'time': self.time.slug,
-                'value': self.value, 'moe': self.moe, 'percent': self.percent, 'denom': self.denom}
+                'value': self.value, 'moe': self.moe, 'percent': self.percent, 'percent_moe': self.percent_moe,
+                'denom': self.denom}
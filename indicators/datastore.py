@@ -0,0 +1,130 @@
+"""
+Concurrent execution of datastore queries.
+
+Queries to CKAN sources are independent of each other, so rather than running them one after another,
+they're dispatched to a bounded pool of worker threads.  Django connections are per-thread, so each worker
+keeps its own connection to the datastore.  To keep one slow or popular source from hogging the pool
+(and the datastore), only `DATASTORE_QUERIES_PER_SOURCE` queries run against a source at once.
+
+Variables can also be collected concurrently with `fan_out`, which runs on a separate pool so variables
+waiting on their queries never starve the query workers.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import closing
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, TypeVar, Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+
+if TYPE_CHECKING:
+    from indicators.models.source import CKANSource
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+_lock = threading.Lock()
+_query_executor: Optional[ThreadPoolExecutor] = None
+_fan_out_executor: Optional[ThreadPoolExecutor] = None
+_source_slots: dict[int, threading.BoundedSemaphore] = {}
+
+
+def _get_query_executor() -> ThreadPoolExecutor:
+    global _query_executor
+    with _lock:
+        if _query_executor is None:
+            _query_executor = ThreadPoolExecutor(
+                max_workers=settings.DATASTORE_QUERY_WORKERS,
+                thread_name_prefix='datastore-query',
+            )
+        return _query_executor
+
+
+def _get_fan_out_executor() -> ThreadPoolExecutor:
+    global _fan_out_executor
+    with _lock:
+        if _fan_out_executor is None:
+            _fan_out_executor = ThreadPoolExecutor(
+                max_workers=settings.INDICATOR_VARIABLE_WORKERS,
+                thread_name_prefix='indicator-variables',
+            )
+        return _fan_out_executor
+
+
+def _get_source_slots(source: 'CKANSource') -> threading.BoundedSemaphore:
+    with _lock:
+        if source.pk not in _source_slots:
+            _source_slots[source.pk] = threading.BoundedSemaphore(settings.DATASTORE_QUERIES_PER_SOURCE)
+        return _source_slots[source.pk]
+
+
+def _run_query(source: 'CKANSource', query: str) -> list[dict]:
+    with _get_source_slots(source):
+        return source.query_datastore(query)
+
+
+def submit_query(source: 'CKANSource', query: str) -> Future:
+    """ Starts running `query` against `source` and returns a future for its rows. """
+    return _get_query_executor().submit(_run_query, source, query)
+
+
+def stream_query(source: 'CKANSource', query: str) -> Iterator[tuple[tuple[str, ...], list[tuple]]]:
+    """
+    Runs `query` against `source` in the calling thread, yielding its rows in batches as they're fetched
+    (see `DatastorePool.stream`).  Nothing is run until the generator is first advanced.
+
+    The source's slot is held while the cursor is open: it's given back as soon as the last batch has been
+    fetched (before that batch is yielded), or when the generator is closed.
+    """
+    slots = _get_source_slots(source)
+    slots.acquire()
+    holding = True
+    try:
+        with closing(source.stream_datastore(query)) as batches:
+            batch = next(batches, None)
+            while batch is not None:
+                # look ahead so the slot isn't held while the last batch is being processed
+                following = next(batches, None)
+                if following is None:
+                    slots.release()
+                    holding = False
+                yield batch
+                batch = following
+    finally:
+        if holding:
+            slots.release()
+
+
+def run_queries(jobs: Iterable[tuple['CKANSource', str]]) -> list[list[dict]]:
+    """ Runs each (source, query) in `jobs` concurrently and returns their rows in the same order. """
+    futures = [submit_query(source, query) for source, query in jobs]
+    return [future.result() for future in futures]
+
+
+def _run_in_worker(fn: Callable[[T], R], item: T) -> R:
+    try:
+        return fn(item)
+    finally:
+        # workers keep their connections between items, like request threads, until they go bad or get too old
+        close_old_connections()
+
+
+def fan_out(fn: Callable[[T], R], items: Iterable[T]) -> list[R]:
+    """
+    Calls `fn` on each item concurrently and returns the results in the same order.
+
+    The first exception raised by `fn` is re-raised once every call has finished.
+    """
+    futures = [_get_fan_out_executor().submit(_run_in_worker, fn, item) for item in items]
+    results, error = [], None
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            error = error or e
+    if error:
+        raise error
+    return results
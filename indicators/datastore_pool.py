@@ -0,0 +1,245 @@
+"""
+A pool of persistent connections to the CKAN datastore.
+
+Rather than going through Django's per-thread `datastore` connection, datastore queries check a connection
+out of a process-wide pool of at most `DATASTORE_POOL_SIZE` connections, waiting for one to be returned if
+they're all in use.  Connections are read-only and are kept open between queries: ones that have sat idle
+for longer than `DATASTORE_CONNECTION_HEALTH_CHECK_AGE` seconds are pinged before they're handed out, and
+ones that have served `DATASTORE_CONNECTION_MAX_USES` queries are closed when they're returned.  Waiting more
+than `DATASTORE_CHECKOUT_TIMEOUT` seconds for a connection raises `DatastoreTimeoutError`.
+
+Every query runs under a `statement_timeout` (`DATASTORE_STATEMENT_TIMEOUT` milliseconds unless one is
+given), so postgres cancels runaway queries instead of letting them pin a worker.  Time spent waiting for
+a connection is recorded in `CheckoutStats`.
+
+Large results can be streamed from a server-side cursor with `DatastorePool.stream` instead of being
+fetched all at once.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+import weakref
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional, Iterator
+
+import psycopg2
+from django.conf import settings
+from psycopg2 import errors as pg_errors
+from psycopg2.extensions import connection as PGConnection
+from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+from indicators.errors import DatastoreTimeoutError
+
+logger = logging.getLogger(__name__)
+
+# checkouts that wait longer than this (in seconds) are logged as warnings
+SLOW_CHECKOUT = 1.0
+
+
+@dataclass
+class CheckoutStats:
+    """ Running totals of the time spent waiting to check out connections. """
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class DatastorePool:
+    def __init__(self, db: dict, min_size: int, max_size: int, max_uses: int, health_check_age: float,
+                 statement_timeout: int, itersize: int, checkout_timeout: Optional[float] = None):
+        """
+        :param db: django database settings for the datastore
+        :param statement_timeout: default time limit for queries, in milliseconds
+        :param itersize: default number of rows fetched at a time when streaming results
+        :param checkout_timeout: seconds to wait for a connection before giving up; `None` waits forever
+        """
+        self.itersize = itersize
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.max_uses = max_uses
+        self.health_check_age = health_check_age
+        self.statement_timeout = statement_timeout
+        self.stats = CheckoutStats()
+        self._lock = threading.Lock()
+        # `ThreadedConnectionPool` raises rather than blocks when it's exhausted, so wait for a slot first
+        self._slots = threading.BoundedSemaphore(max_size)
+        # keyed by the connections themselves, so a new connection can't inherit a closed one's counts
+        self._uses: weakref.WeakKeyDictionary[PGConnection, int] = weakref.WeakKeyDictionary()
+        self._last_used: weakref.WeakKeyDictionary[PGConnection, float] = weakref.WeakKeyDictionary()
+        self._pool = ThreadedConnectionPool(
+            min_size, max_size,
+            host=db.get('HOST'),
+            port=db.get('PORT'),
+            dbname=db.get('NAME'),
+            user=db.get('USER'),
+            password=db.get('PASSWORD'),
+            application_name='profiles-datastore',
+            options=f'-c statement_timeout={int(statement_timeout)}',
+        )
+
+    def _is_healthy(self, conn: PGConnection) -> bool:
+        if conn.closed:
+            return False
+        with self._lock:
+            last_used = self._last_used.get(conn)
+        if last_used is None or time.monotonic() - last_used < self.health_check_age:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn: PGConnection):
+        with self._lock:
+            self._uses.pop(conn, None)
+            self._last_used.pop(conn, None)
+        self._pool.putconn(conn, close=True)
+
+    def _get_connection(self) -> PGConnection:
+        # every idle connection may have gone bad, after which the pool opens a new one
+        for _ in range(self.max_size + 1):
+            conn = self._pool.getconn()
+            if self._is_healthy(conn):
+                break
+            logger.info('Replacing broken datastore connection.')
+            self._discard(conn)
+        else:
+            raise psycopg2.OperationalError('Could not get a working datastore connection.')
+        if conn.readonly is not True:
+            conn.set_session(readonly=True)
+        return conn
+
+    def _release(self, conn: PGConnection):
+        with self._lock:
+            uses = self._uses[conn] = self._uses.get(conn, 0) + 1
+            self._last_used[conn] = time.monotonic()
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        if conn.closed or uses >= self.max_uses:
+            self._discard(conn)
+        else:
+            self._pool.putconn(conn)
+
+    @contextmanager
+    def checkout(self):
+        """
+        Lends out a connection until the block exits, waiting for one if the pool is exhausted.
+
+        :raises DatastoreTimeoutError: if no connection is free within the pool's `checkout_timeout`
+        """
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise DatastoreTimeoutError(f'Waited more than {self.checkout_timeout}s for a datastore connection.')
+        try:
+            conn = self._get_connection()
+        except Exception:
+            self._slots.release()
+            raise
+        waited = time.monotonic() - start
+        with self._lock:
+            self.stats.record(waited)
+        if waited > SLOW_CHECKOUT:
+            logger.warning(f'Waited {waited:.2f}s for a datastore connection.')
+        else:
+            logger.debug(f'Waited {waited * 1000:.1f}ms for a datastore connection.')
+
+        try:
+            yield conn
+        finally:
+            try:
+                self._release(conn)
+            finally:
+                self._slots.release()
+
+    @contextmanager
+    def _time_limit(self, conn: PGConnection, timeout: Optional[int]):
+        """ Runs the block's statements under `timeout`, raising `DatastoreTimeoutError` if they're cancelled. """
+        if timeout is not None:
+            with conn.cursor() as cursor:
+                cursor.execute('SET LOCAL statement_timeout = %s', [int(timeout)])
+        try:
+            yield
+        except pg_errors.QueryCanceled:
+            raise DatastoreTimeoutError(
+                f'Datastore query ran longer than {timeout or self.statement_timeout}ms and was cancelled.')
+
+    def query(self, query: str, timeout: Optional[int] = None) -> list[dict]:
+        """
+        Runs `query` and returns its rows as dicts.
+
+        :param timeout: time limit in milliseconds, if not the pool's default
+        :raises DatastoreTimeoutError: if the query is cancelled for running too long
+        """
+        with self.checkout() as conn, self._time_limit(conn, timeout):
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute(query)
+                return cursor.fetchall()
+
+    def stream(self, query: str, itersize: Optional[int] = None,
+               timeout: Optional[int] = None) -> Iterator[tuple[tuple[str, ...], list[tuple]]]:
+        """
+        Runs `query` on a server-side cursor and yields its rows in batches of tuples, along with the names of
+        their columns, so only one batch is held in memory at a time.
+
+        The connection is held until the generator is exhausted or closed.
+
+        :param itersize: number of rows fetched per batch, if not the pool's default
+        :param timeout: time limit in milliseconds for each fetch, if not the pool's default
+        :raises DatastoreTimeoutError: if the query is cancelled for running too long
+        """
+        itersize = itersize or self.itersize
+        with self.checkout() as conn, self._time_limit(conn, timeout):
+            with conn.cursor(name=f'datastore_stream_{uuid.uuid4().hex}') as cursor:
+                cursor.itersize = itersize
+                cursor.execute(query)
+                while True:
+                    rows = cursor.fetchmany(itersize)
+                    if not rows:
+                        break
+                    yield tuple(column.name for column in cursor.description), rows
+
+    def close(self):
+        self._pool.closeall()
+
+
+_lock = threading.Lock()
+_pool: Optional[DatastorePool] = None
+_pool_pid: Optional[int] = None
+
+
+def get_pool() -> DatastorePool:
+    """ Returns this process's pool, making it on first use (and again after a fork). """
+    global _pool, _pool_pid
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = DatastorePool(
+                settings.DATABASES['datastore'],
+                min_size=settings.DATASTORE_POOL_MIN_SIZE,
+                max_size=settings.DATASTORE_POOL_SIZE,
+                max_uses=settings.DATASTORE_CONNECTION_MAX_USES,
+                health_check_age=settings.DATASTORE_CONNECTION_HEALTH_CHECK_AGE,
+                statement_timeout=settings.DATASTORE_STATEMENT_TIMEOUT,
+                itersize=settings.DATASTORE_CURSOR_ITERSIZE,
+                checkout_timeout=settings.DATASTORE_CHECKOUT_TIMEOUT,
+            )
+            _pool_pid = os.getpid()
+        return _pool
@@ -29,3 +29,7 @@ class EmptyResultsError(DataRetrievalError):
 
 class NotAvailableForGeogError(DataRetrievalError):
     level = ErrorLevel.EMPTY
+
+
+class DatastoreTimeoutError(DataRetrievalError):
+    level = ErrorLevel.ERROR
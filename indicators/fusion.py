@@ -0,0 +1,92 @@
+"""
+Fused datastore queries for CKAN variables that share a source.
+
+Indicators often have several `CKANVariable`s that aggregate different fields of the same source.  While
+an indicator's data is being collected (inside `fused_ckan_queries`), the first of those variables to
+query a source fetches every sibling's aggregate as an extra column of the same query.  The siblings
+are handed a future for their share of the rows, so the source is only scanned once even when the
+variables are collected on different threads.
+
+Fused queries are only shared for the duration of the block, by the threads it's `activate`d in.
+"""
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterable, Optional, Type
+
+from profiles.settings import GEOG_DKEY, TIME_DKEY, VALUE_DKEY
+
+if TYPE_CHECKING:
+    from geo.models import AdminRegion
+    from indicators.models.source import CKANSource
+    from indicators.models.time import TimeAxis
+    from indicators.models.variable import Variable
+
+FetchKey = tuple
+
+_local = threading.local()
+
+
+class FusedQueries:
+    def __init__(self, variables: Iterable['Variable']):
+        self.variables: list['Variable'] = list(variables)
+        self._lock = threading.Lock()
+        self._pending: dict[tuple[int, FetchKey], Future] = {}
+
+    def claim(self, variable: 'Variable', key: FetchKey,
+              partners: list['Variable']) -> tuple[Optional[Future], dict[int, Future]]:
+        """
+        Either finds the future for `variable`'s rows from a fused query another variable already started,
+        or claims the fetch for `variable` and `partners`.
+
+        :return: the existing future, or `None` along with a future to resolve for each partner (by pk)
+        """
+        with self._lock:
+            existing = self._pending.pop((variable.pk, key), None)
+            if existing is not None:
+                return existing, {}
+            futures: dict[int, Future] = {}
+            for partner in partners:
+                if partner.pk != variable.pk and (partner.pk, key) not in self._pending:
+                    futures[partner.pk] = self._pending[(partner.pk, key)] = Future()
+            return None, futures
+
+
+def fetch_key(source: 'CKANSource', global_geoids: Iterable[str], time_parts: list['TimeAxis.TimePart'],
+              parent_geog_lvl: Optional[Type['AdminRegion']]) -> FetchKey:
+    """ Identifies a fetch so siblings only reuse fused rows that were queried the same way. """
+    return (
+        source.pk,
+        tuple(sorted(set(global_geoids))),
+        tuple(time_part.storage_hash for time_part in time_parts),
+        parent_geog_lvl.geog_type_id if parent_geog_lvl else None,
+    )
+
+
+def split_rows(rows: Iterable[dict], value_keys: dict[int, str]) -> dict[int, list[dict]]:
+    """ Splits the rows of a fused query into each variable's rows (by pk), using its column in `value_keys`. """
+    rows = list(rows)
+    return {pk: [{GEOG_DKEY: row[GEOG_DKEY], TIME_DKEY: row[TIME_DKEY], VALUE_DKEY: row[value_key]} for row in rows]
+            for pk, value_key in value_keys.items()}
+
+
+def current() -> Optional[FusedQueries]:
+    return getattr(_local, 'fused', None)
+
+
+@contextmanager
+def activate(fused: Optional[FusedQueries]):
+    """ Shares `fused` with the current thread until the block exits. """
+    previous = current()
+    _local.fused = fused
+    try:
+        yield fused
+    finally:
+        _local.fused = previous
+
+
+@contextmanager
+def fused_ckan_queries(variables: Iterable['Variable']):
+    """ Lets the CKAN variables in `variables` share source queries until the block exits. """
+    with activate(FusedQueries(variables)) as fused:
+        yield fused
@@ -4,7 +4,7 @@ from django.core.cache import cache
 from django.core.management.base import BaseCommand
 from django.db import connection
 
-from indicators.models.data import CachedIndicatorData
+from indicators.models.data import CachedIndicatorData, IndicatorDataBlock
 
 if typing.TYPE_CHECKING:
     from psycopg2.extensions import cursor as _cursor
@@ -20,5 +20,6 @@ class Command(BaseCommand):
         with connection.cursor() as cursor:
             cursor: _cursor
             cursor.execute(f"TRUNCATE {CachedIndicatorData._meta.db_table}")
+            cursor.execute(f"TRUNCATE {IndicatorDataBlock._meta.db_table}")
         cache.clear()
         print('✔️ Done')
@@ -0,0 +1,47 @@
+import typing
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from indicators.models.data import CachedIndicatorData
+
+if typing.TYPE_CHECKING:
+    from psycopg2.extensions import cursor as _cursor
+
+
+class Command(BaseCommand):
+    help = "Delete records in the Indicator Data Store that expired longer ago than the grace period."
+
+    def add_arguments(self, parser):
+        parser.add_argument('-g', '--grace-hours', type=float, default=None,
+                            help='keep expired records for this long; defaults to INDICATOR_STORE_SWEEP_GRACE')
+        parser.add_argument('-b', '--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        if options['grace_hours'] is not None:
+            grace = timedelta(hours=options['grace_hours'])
+        else:
+            grace = settings.INDICATOR_STORE_SWEEP_GRACE
+        cutoff = timezone.now() - grace
+        table = CachedIndicatorData._meta.db_table
+
+        print('🧹', f'Sweeping records that expired before {cutoff.isoformat()}')
+        total = 0
+        with connection.cursor() as cursor:
+            cursor: _cursor
+            while True:
+                # small batches that use the expiration index keep locks short
+                cursor.execute(
+                    f"""
+                    DELETE FROM {table}
+                    WHERE id IN (SELECT id FROM {table} WHERE expiration < %s LIMIT %s)
+                    """,
+                    [cutoff, options['batch_size']]
+                )
+                total += cursor.rowcount
+                if cursor.rowcount < options['batch_size']:
+                    break
+        print('✔️ Done', f'{total} records deleted.')
@@ -0,0 +1,167 @@
+import json
+import os
+import time
+import typing
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from geo.models import AdminRegion
+from indicators.models import Indicator
+from indicators.utils import ErrorLevel
+
+DEFAULT_CHECKPOINT = 'warm_indicator_store.checkpoint.jsonl'
+
+
+@dataclass(frozen=True)
+class WarmTask:
+    indicator_slug: str
+    global_geoid: str
+    across_geogs: bool
+    sources: frozenset[str]
+
+    @property
+    def key(self) -> str:
+        return f'{self.indicator_slug}|{self.global_geoid}|{"map" if self.across_geogs else "geog"}'
+
+
+def _init_worker():
+    # connections inherited from the parent process can't be shared
+    connections.close_all()
+
+
+def _warm(task: WarmTask) -> tuple[str, typing.Optional[str]]:
+    """
+    Collects data for `task` the same way a visitor's request would, filling the indicator data store along
+    the way.  The response cache is skipped, since a cached response wouldn't touch the data store.
+
+    :return: the task's key and an error message if it failed
+    """
+    try:
+        indicator = Indicator.objects.get(slug=task.indicator_slug)
+        geog = AdminRegion.objects.get(global_geoid=task.global_geoid)
+        response = indicator._get_data(geog, across_geogs=task.across_geogs)
+        if response.error.level not in (ErrorLevel.OK, ErrorLevel.EMPTY):
+            return task.key, response.error.message
+        return task.key, None
+    except Exception as e:
+        return task.key, f'{type(e).__name__}: {e}'
+
+
+class Command(BaseCommand):
+    help = "Fill the Indicator Data Store by requesting every indicator at every available geography."
+
+    def add_arguments(self, parser):
+        parser.add_argument('-w', '--workers', type=int, default=os.cpu_count())
+        parser.add_argument('-s', '--per-source', type=int, default=2,
+                            help='max number of tasks using the same source that can run at once')
+        parser.add_argument('-i', '--indicator', action='append', default=None,
+                            help='only warm these indicators (by slug); can be repeated')
+        parser.add_argument('-g', '--geog-type', action='append', default=None,
+                            help='only warm these geog types; defaults to AVAILABLE_GEOG_TYPES')
+        parser.add_argument('--maps-only', action='store_true',
+                            help='only warm the map-level collections of mappable indicators')
+        parser.add_argument('-c', '--checkpoint', default=DEFAULT_CHECKPOINT,
+                            help='file that the keys of finished tasks are appended to so interrupted runs can resume')
+        parser.add_argument('--restart', action='store_true', help='ignore any existing checkpoint')
+
+    def handle(self, *args, **options):
+        checkpoint_path = options['checkpoint']
+        done: set[str] = set()
+        if not options['restart'] and os.path.exists(checkpoint_path):
+            done = self.load_checkpoint(checkpoint_path)
+            print('📌', f'Resuming from {checkpoint_path}; {len(done)} tasks already done.')
+
+        tasks = [task for task in self.make_tasks(options) if task.key not in done]
+        print('🔥', f'Warming {len(tasks)} tasks with {options["workers"]} workers.')
+
+        # tasks are queued by the set of sources they use, so finding one that can start only looks at the heads
+        pending: dict[frozenset[str], deque[WarmTask]] = {}
+        for task in tasks:
+            pending.setdefault(task.sources, deque()).append(task)
+
+        failures: dict[str, str] = {}
+        in_flight: Counter[str] = Counter()
+        running: dict[Future, WarmTask] = {}
+        start = time.monotonic()
+        completed = 0
+
+        # workers are forked, so they can't share our connections
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=_init_worker) as executor, \
+                open(checkpoint_path, 'w' if options['restart'] else 'a') as checkpoint:
+            while pending or running:
+                # start tasks from any queue whose sources all have room
+                for sources, queue in list(pending.items()):
+                    while (queue and len(running) < options['workers']
+                           and all(in_flight[source] < options['per_source'] for source in sources)):
+                        task = queue.popleft()
+                        in_flight.update(task.sources)
+                        running[executor.submit(_warm, task)] = task
+                    if not queue:
+                        del pending[sources]
+
+                finished, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    in_flight.subtract(task.sources)
+                    key, error = future.result()
+                    completed += 1
+                    if error:
+                        failures[key] = error
+                        print('❌', key, error)
+                    else:
+                        checkpoint.write(json.dumps(key) + '\n')
+                        checkpoint.flush()
+
+                    elapsed = time.monotonic() - start
+                    print('⏱', f'{completed}/{len(tasks)} ({completed / elapsed:.2f} tasks/s)', key)
+
+        elapsed = time.monotonic() - start
+        print('✔️ Done', f'{completed - len(failures)} warmed, {len(failures)} failed in {elapsed:.1f}s.')
+        for key, error in failures.items():
+            print('  ❌', key, error)
+
+    @staticmethod
+    def make_tasks(options) -> list[WarmTask]:
+        """ Lists a task for every indicator at every geog (or the map of each geog type) it can handle. """
+        indicators = Indicator.objects.all()
+        if options['indicator']:
+            indicators = indicators.filter(slug__in=options['indicator'])
+        geog_type_ids = options['geog_type'] or settings.AVAILABLE_GEOG_TYPES
+
+        tasks: list[WarmTask] = []
+        indicator: Indicator
+        for indicator in indicators:
+            sources = frozenset(source.slug for source in indicator.sources)
+            for geog_type_id in geog_type_ids:
+                geogs = (AdminRegion.find_subclass(geog_type_id).objects
+                         .filter(in_extent=True, global_geoid__isnull=False).order_by('slug'))
+                if not geogs.exists():
+                    continue
+
+                # one request for the map collects the data for every geog of the type
+                if indicator.is_mappable:
+                    tasks.append(WarmTask(indicator.slug, geogs[0].global_geoid, True, sources))
+                if options['maps_only']:
+                    continue
+
+                for global_geoid in geogs.values_list('global_geoid', flat=True):
+                    tasks.append(WarmTask(indicator.slug, global_geoid, False, sources))
+        return tasks
+
+    @staticmethod
+    def load_checkpoint(path: str) -> set[str]:
+        """ Reads the keys of finished tasks, skipping a last line that was cut off by a crash. """
+        done: set[str] = set()
+        with open(path) as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        return done
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('indicators', '0036_indicatorvariable_color_scale'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='source',
+            name='data_ttl',
+            field=models.DurationField(blank=True, help_text='How long values from this source are kept in the indicator data store before being refreshed. Leave blank to use the default for this type of source.', null=True, verbose_name='Data TTL'),
+        ),
+    ]
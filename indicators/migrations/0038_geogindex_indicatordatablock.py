@@ -0,0 +1,37 @@
+# Generated by Django 3.2.16 on 2026-10-17 12:00
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('indicators', '0037_source_data_ttl'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeogIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('geog_type', models.CharField(max_length=200, unique=True)),
+                ('geoids', django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=21), default=list, size=None)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='IndicatorDataBlock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('variable', models.CharField(max_length=128)),
+                ('time_part_hash', models.CharField(max_length=128)),
+                ('geog_type', models.CharField(max_length=200)),
+                ('values', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(null=True), default=list, size=None)),
+                ('moes', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(null=True), default=list, size=None)),
+                ('denoms', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(null=True), default=list, size=None)),
+            ],
+            options={
+                'unique_together': {('variable', 'time_part_hash', 'geog_type')},
+            },
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.2.16 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('indicators', '0038_geogindex_indicatordatablock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='variable',
+            name='generation',
+            field=models.IntegerField(default=0, editable=False, help_text="Incremented whenever a change is made that affects this variable's data. Cached data from older generations is ignored."),
+        ),
+        migrations.AddField(
+            model_name='cachedindicatordata',
+            name='generation',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='indicatordatablock',
+            name='generation',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterUniqueTogether(
+            name='cachedindicatordata',
+            unique_together={('geog', 'variable', 'generation', 'time_part_hash')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='indicatordatablock',
+            unique_together={('variable', 'generation', 'time_part_hash', 'geog_type')},
+        ),
+        migrations.RemoveIndex(
+            model_name='cachedindicatordata',
+            name='indicators__variabl_750a26_idx',
+        ),
+        migrations.AddIndex(
+            model_name='cachedindicatordata',
+            index=models.Index(fields=['variable', 'generation', 'time_part_hash', 'geog'], name='indicators__variabl_676939_idx'),
+        ),
+    ]
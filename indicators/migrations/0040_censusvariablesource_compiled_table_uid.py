@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('indicators', '0039_data_generations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='censusvariablesource',
+            name='compiled_table_uid',
+            field=models.CharField(blank=True, editable=False, help_text="Virtual table holding the precomputed sum of this link's tables when it has more than one.", max_length=100, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-17 18:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('indicators', '0040_censusvariablesource_compiled_table_uid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachedindicatordata',
+            name='percent_moe',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
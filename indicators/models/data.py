@@ -1,9 +1,19 @@
-from typing import Iterable, TYPE_CHECKING
+import logging
+from typing import Iterable, TYPE_CHECKING, Optional
 
+import numpy as np
+from django.conf import settings
 from django.contrib.gis.db import models
+from django.contrib.postgres.fields import ArrayField
+from django.db import connection, transaction
+
+from profiles.db import copy_upsert
 
 if TYPE_CHECKING:
     from indicators.data import Datum
+    from indicators.store import CellRecord
+
+logger = logging.getLogger(__name__)
 
 
 class CachedIndicatorData(models.Model):
@@ -11,30 +21,233 @@ class CachedIndicatorData(models.Model):
     This table will store generated indicators for future reuse.
     """
     variable = models.CharField(max_length=128)
+    generation = models.IntegerField(default=0)
     geog = models.CharField(max_length=128)
     time_part_hash = models.CharField(max_length=128)
     value = models.FloatField(null=True, blank=True)
     moe = models.FloatField(null=True, blank=True)
     denom = models.FloatField(null=True, blank=True)
+    percent_moe = models.FloatField(null=True, blank=True)
     expiration = models.DateTimeField(null=True, blank=True)
 
     class Meta:
-        unique_together = ('geog', 'variable', 'time_part_hash')
+        unique_together = ('geog', 'variable', 'generation', 'time_part_hash')
         indexes = [
-            models.Index(fields=['variable', 'time_part_hash', 'geog']),
+            models.Index(fields=['variable', 'generation', 'time_part_hash', 'geog']),
             models.Index(fields=['expiration'])
         ]
 
     @staticmethod
-    def save_records(records: Iterable['Datum'], expiration=None) -> list['CachedIndicatorData']:
-        print(records)
-        new_records = [CachedIndicatorData(
-            geog=datum.geog.global_geoid,
-            variable=datum.variable.slug,
-            time_part_hash=datum.time.storage_hash,
-            value=datum.value,
-            denom=datum.denom,
-            moe=datum.moe,
-            expiration=expiration,
-        ) for datum in records]
-        return CachedIndicatorData.objects.bulk_create(new_records)
+    def get_cell_records(variable_slug: str, generation: int, global_geoids: Iterable[str],
+                         time_part_hashes: Iterable[str]) -> list['CellRecord']:
+        """ Returns (geog, time_part_hash, value, moe, denom, percent_moe, expiration) tuples for the requested cells. """
+        return list(CachedIndicatorData.objects.filter(
+            variable=variable_slug,
+            generation=generation,
+            geog__in=list(global_geoids),
+            time_part_hash__in=list(time_part_hashes),
+        ).values_list('geog', 'time_part_hash', 'value', 'moe', 'denom', 'percent_moe', 'expiration'))
+
+    @staticmethod
+    def save_records(records: Iterable['Datum'], expiration=None) -> int:
+        """
+        Upserts `records`, which all belong to one variable, into the store.
+
+        Rows are streamed in with `COPY` and merged on the (geog, variable, generation, time_part_hash) constraint,
+        so workers filling the same cells at the same time won't trip over each other.
+        Records are stored under the generation their variable had when they were collected.  If that generation
+        has since been bumped, the records are discarded instead, since its purge may already have run.
+
+        :return: number of records written
+        """
+        records = list(records)
+        if not records:
+            return 0
+        variable = records[0].variable
+        # generations live on the base table of the polymorphic variable models
+        variable_table = variable._meta.get_field('generation').model._meta.db_table
+        rows = ((datum.geog.global_geoid, datum.variable.slug, datum.variable.generation, datum.time.storage_hash,
+                 datum.value, datum.moe, datum.denom, datum.percent_moe, expiration) for datum in records)
+
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                # share-locking the variable's row makes a bump wait for these records, so its purge clears them
+                cursor.execute(f'SELECT 1 FROM {variable_table} WHERE id = %s AND generation = %s FOR SHARE',
+                               [variable.pk, variable.generation])
+                if cursor.fetchone() is None:
+                    logger.info(f'Discarding {len(records)} records for {variable.slug}; '
+                                f'generation {variable.generation} was superseded.')
+                    return 0
+            return copy_upsert(
+                CachedIndicatorData._meta.db_table,
+                columns=('geog', 'variable', 'generation', 'time_part_hash', 'value', 'moe', 'denom', 'percent_moe',
+                         'expiration'),
+                rows=rows,
+                conflict_columns=('geog', 'variable', 'generation', 'time_part_hash'),
+                batch_size=settings.INDICATOR_STORE_BATCH_SIZE,
+            )
+
+
+class GeogIndex(models.Model):
+    """
+    Stable ordering of all the geographies of one type.
+
+    Columnar indicator data is aligned to this ordering.  Geogs are only ever appended so
+    positions in existing `IndicatorDataBlock`s stay valid.
+    """
+    geog_type = models.CharField(max_length=200, unique=True)
+    geoids = ArrayField(models.CharField(max_length=21), default=list)
+
+    _positions: Optional[dict[str, int]] = None
+
+    @property
+    def positions(self) -> dict[str, int]:
+        if self._positions is None:
+            self._positions = {geoid: i for i, geoid in enumerate(self.geoids)}
+        return self._positions
+
+    @staticmethod
+    def for_geog_type(geog_type_id: str) -> 'GeogIndex':
+        """ Returns the index for `geog_type_id`, adding any geogs that aren't in it yet. """
+        from geo.models import AdminRegion
+        with transaction.atomic():
+            index, _ = GeogIndex.objects.select_for_update().get_or_create(geog_type=geog_type_id)
+            known = set(index.geoids)
+            new_geoids = [geoid for geoid in AdminRegion.objects.filter(geog_type=geog_type_id)
+                          .order_by('global_geoid').values_list('global_geoid', flat=True)
+                          if geoid not in known]
+            if new_geoids:
+                index.geoids = index.geoids + new_geoids
+                index.save()
+                index._positions = None
+        return index
+
+    def take(self, geoids: Iterable[str]) -> np.ndarray:
+        """ Returns the positions of `geoids` in the index; -1 for those not in it. """
+        return np.array([self.positions.get(geoid, -1) for geoid in geoids], dtype=np.int64)
+
+    def __str__(self):
+        return f'{self.geog_type} ({len(self.geoids)})'
+
+
+class IndicatorDataBlock(models.Model):
+    """
+    Columnar copy of the indicator data store.
+
+    Holds the values, MOEs and denominators of a variable for every geog of a type at one time part,
+    aligned to that type's `GeogIndex`, so a whole map layer can be read as one row.
+    """
+    variable = models.CharField(max_length=128)
+    generation = models.IntegerField(default=0)
+    time_part_hash = models.CharField(max_length=128)
+    geog_type = models.CharField(max_length=200)
+    values = ArrayField(models.FloatField(null=True), default=list)
+    moes = ArrayField(models.FloatField(null=True), default=list)
+    denoms = ArrayField(models.FloatField(null=True), default=list)
+
+    class Meta:
+        unique_together = ('variable', 'generation', 'time_part_hash', 'geog_type')
+
+    def as_arrays(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Returns (values, moes, denoms) as float arrays with NaN for missing data. """
+        return (np.array(self.values, dtype=float),
+                np.array(self.moes, dtype=float),
+                np.array(self.denoms, dtype=float))
+
+    def get_map_values(self, geoids: Iterable[str], use_percent=False) -> np.ndarray:
+        """ Returns the values (or percents) for `geoids`, in order, with NaN where there's no data. """
+        values, _, denoms = self.as_arrays()
+        if use_percent:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = values / denoms
+        positions = GeogIndex.objects.get(geog_type=self.geog_type).take(geoids)
+        # blocks may be shorter than the index if geogs were added after they were built
+        found = (positions >= 0) & (positions < len(values))
+        results = np.full(len(positions), np.nan)
+        results[found] = values[positions[found]]
+        return results
+
+    @staticmethod
+    def build(variable_slug: str, generation: int, time_part_hash: str, geog_type_id: str) -> 'IndicatorDataBlock':
+        """ (Re)builds a block from the rows in the indicator data store. """
+        GeogIndex.for_geog_type(geog_type_id)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {IndicatorDataBlock._meta.db_table}
+                    (variable, generation, time_part_hash, geog_type, values, moes, denoms)
+                SELECT %(variable)s,
+                       %(generation)s,
+                       %(time_part_hash)s,
+                       %(geog_type)s,
+                       coalesce(array_agg(cid.value ORDER BY idx.pos), '{{}}'),
+                       coalesce(array_agg(cid.moe ORDER BY idx.pos), '{{}}'),
+                       coalesce(array_agg(cid.denom ORDER BY idx.pos), '{{}}')
+                FROM {GeogIndex._meta.db_table} gi
+                         CROSS JOIN unnest(gi.geoids) WITH ORDINALITY AS idx(geoid, pos)
+                         LEFT JOIN {CachedIndicatorData._meta.db_table} cid
+                                   ON cid.geog = idx.geoid
+                                       AND cid.variable = %(variable)s
+                                       AND cid.generation = %(generation)s
+                                       AND cid.time_part_hash = %(time_part_hash)s
+                WHERE gi.geog_type = %(geog_type)s
+                ON CONFLICT (variable, generation, time_part_hash, geog_type) DO UPDATE
+                    SET values = EXCLUDED.values,
+                        moes   = EXCLUDED.moes,
+                        denoms = EXCLUDED.denoms
+                """,
+                {'variable': variable_slug, 'generation': generation,
+                 'time_part_hash': time_part_hash, 'geog_type': geog_type_id}
+            )
+        return IndicatorDataBlock.objects.get(variable=variable_slug, generation=generation,
+                                              time_part_hash=time_part_hash, geog_type=geog_type_id)
+
+    @staticmethod
+    def write_records(variable_slug: str, generation: int, geog_type_id: str,
+                      records: Iterable['CellRecord']) -> int:
+        """
+        Merges `records` into any existing blocks they belong to.
+
+        Blocks are only built on demand (e.g. for maps), so records for blocks that don't exist are skipped.
+        :return: number of blocks updated
+        """
+        records_by_time_part: dict[str, list['CellRecord']] = {}
+        for record in records:
+            records_by_time_part.setdefault(record[1], []).append(record)
+        if not records_by_time_part:
+            return 0
+
+        count = 0
+        with transaction.atomic():
+            blocks = IndicatorDataBlock.objects.select_for_update().filter(
+                variable=variable_slug,
+                generation=generation,
+                geog_type=geog_type_id,
+                time_part_hash__in=records_by_time_part.keys()
+            )
+            if not blocks:
+                return 0
+
+            index = GeogIndex.objects.get(geog_type=geog_type_id)
+            if any(record[0] not in index.positions
+                   for time_part_records in records_by_time_part.values() for record in time_part_records):
+                index = GeogIndex.for_geog_type(geog_type_id)
+
+            block: IndicatorDataBlock
+            for block in blocks:
+                block_records = records_by_time_part[block.time_part_hash]
+                positions = index.take(record[0] for record in block_records)
+                columns = []
+                for column, field_idx in ((block.values, 2), (block.moes, 3), (block.denoms, 4)):
+                    column = column + [None] * (len(index.geoids) - len(column))
+                    for position, record in zip(positions, block_records):
+                        if position >= 0:
+                            column[position] = record[field_idx]
+                    columns.append(column)
+                block.values, block.moes, block.denoms = columns
+                block.save()
+                count += 1
+        return count
+
+    def __str__(self):
+        return f'{self.variable}@{self.generation}/{self.time_part_hash}/{self.geog_type}'
@@ -1,14 +1,19 @@
 import dataclasses
+import hashlib
 import logging
 from typing import Optional, TYPE_CHECKING, List, TypedDict
 
 from colorama import Fore, Style
 from django.conf import settings
+from django.contrib.postgres.aggregates import JSONBAgg
+from django.core.cache import caches
 from django.core.exceptions import ValidationError
 from django.db import models
 from django.db.models import QuerySet
+from django.db.models.functions import JSONObject
 from django.db.models.signals import m2m_changed
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.text import slugify
 from markdownx.models import MarkdownxField
 
@@ -16,8 +21,9 @@ from context.models import WithContext, WithTags
 from geo.models import AdminRegion
 from indicators.data import Datum, GeogCollection, GeogRecord
 from indicators.errors import AggregationError, DataRetrievalError
+from indicators import datastore, fusion
 from indicators.models.source import Source
-from indicators.utils import ErrorRecord, DataResponse, ErrorLevel
+from indicators.utils import ErrorRecord, DataResponse, DataPayload, ErrorLevel
 from maps.models import IndicatorLayer, random_color_scale
 from maps.util import make_menu_view_name
 from profiles.abstract_models import Described
@@ -259,9 +265,62 @@ class Indicator(WithTags, WithContext, Described):
         # if it required aggregation but no suitable subgeogs were found
         raise AggregationError(f'{self.title} not available for {type(geogs)}.')
 
-    def get_data(self, geog: 'AdminRegion', across_geogs=False) -> DataResponse:
+    @property
+    def data_version(self) -> str:
         """
-        Returns a `DataResponse` object with the viz's data at `geog`.
+        Identifies the state of all the data behind this indicator.
+
+        Changes whenever the generation of one of its variables changes (which includes changes to their
+        denominators and reloads of their census data), or when the indicator's own settings, its variables
+        or time parts change.  The variables and their links are read in a single aggregate query; the rest
+        comes from the indicator and its time axis, which are already loaded when serving it.
+        """
+        links_state = IndicatorVariable.objects.filter(indicator_id=self.pk).aggregate(
+            state=JSONBAgg(
+                JSONObject(
+                    variable='variable__slug',
+                    generation='variable__generation',
+                    order='order',
+                    total='total',
+                    color_scale='color_scale',
+                ),
+                ordering=('order', 'variable_id'),
+            )
+        )['state']
+        time_part_hashes = [tp.storage_hash for tp in self.time_axis.time_parts]
+        settings_state = [(field.attname, getattr(self, field.attname)) for field in self._meta.concrete_fields]
+        version_source = repr((links_state, time_part_hashes, settings_state))
+        return hashlib.md5(version_source.encode()).hexdigest()
+
+    def get_data_cache_key(self, geog: 'AdminRegion', across_geogs=False) -> str:
+        return f'indicator-response:{self.slug}:{geog.uid}:{int(bool(across_geogs))}:{self.data_version}'
+
+    def get_data(self, geog: 'AdminRegion', across_geogs=False) -> DataPayload:
+        """
+        Returns the serialized `DataResponse` with the viz's data at `geog`.
+
+        Complete responses are cached by the indicator's `data_version` so they're reused until
+        any of the underlying data changes, and for no longer than the data in them is fresh; responses
+        served from expired data aren't cached at all, so the refreshed data is picked up.
+        """
+        cache = caches[settings.INDICATOR_RESPONSE_CACHE]
+        cache_key = self.get_data_cache_key(geog, across_geogs)
+        payload: Optional[DataPayload] = cache.get(cache_key)
+        if payload is not None:
+            return payload
+
+        response = self._get_data(geog, across_geogs)
+        payload = response.as_payload()
+        timeout = settings.INDICATOR_RESPONSE_CACHE_TTL
+        if response.expiration is not None:
+            timeout = min(timeout, (response.expiration - timezone.now()).total_seconds())
+        if response.error.level == ErrorLevel.OK and timeout > 0:
+            cache.set(cache_key, payload, timeout=timeout)
+        return payload
+
+    def _get_data(self, geog: 'AdminRegion', across_geogs=False) -> DataResponse:
+        """
+        Collects a `DataResponse` object with the viz's data at `geog`.
 
         This method is the primary interface to request data.
         Generalized solution
@@ -284,6 +343,7 @@ class Indicator(WithTags, WithContext, Described):
         map_options: Optional[dict] = None
         error = ErrorRecord(level=ErrorLevel.OK, message='')
         warnings: Optional[list[ErrorRecord]] = None
+        expiration: Optional[timezone.datetime] = None
         making_map = self.is_mappable and across_geogs
 
         # todo: limit this based on possible geographic domain
@@ -318,17 +378,23 @@ class Indicator(WithTags, WithContext, Described):
                 warnings: list[ErrorRecord] = []
                 message_dupes = set()
 
-                # get the data for each variable
-                for variable in self.variables:
-                    var_data, var_warnings = variable.get_values(geog_collection, self.time_axis)
+                # get the data for each variable, letting variables (and denominators) on the same source share queries
+                variables = list(self.variables)
+                denominators = [variable.primary_denominator for variable in variables]
+                with fusion.fused_ckan_queries(variables + [denom for denom in denominators if denom]) as fused:
+                    def get_variable_values(variable: 'Variable'):
+                        with fusion.activate(fused):
+                            return variable.get_values(geog_collection, self.time_axis)
 
-                    for item in var_data:
-                        temp_data[f'{item.geog.global_geoid}:{item.time.storage_hash}:{item.variable.slug}'] = item
+                    # variables are collected concurrently, so a cold request takes about as long as its slowest query
+                    for var_data, var_warnings in datastore.fan_out(get_variable_values, variables):
+                        for item in var_data:
+                            temp_data[f'{item.geog.global_geoid}:{item.time.storage_hash}:{item.variable.slug}'] = item
 
-                    for warning in var_warnings:
-                        if warning.message not in message_dupes:
-                            message_dupes.add(warning.message)
-                            warnings.append(warning)
+                        for warning in var_warnings:
+                            if warning.message not in message_dupes:
+                                message_dupes.add(warning.message)
+                                warnings.append(warning)
 
                 # place results in a 3d array following the order in `dimensions`
                 for geog in dimensions.geog:
@@ -345,13 +411,15 @@ class Indicator(WithTags, WithContext, Described):
                         g_list.append(t_list)
                     data.append(g_list)
 
+                expiration = min(filter(None, (variable.served_expiration for variable in variables)), default=None)
+
                 if making_map:
                     map_options = self._get_map_options(geog_collection)
             else:
                 error = ErrorRecord(level=ErrorLevel.EMPTY,
                                     message=f'This visualization is not available for {geog.name}.')
             print('👋 returning data response', data, dimensions, map_options, error, warnings)
-            return DataResponse(data, dimensions, map_options, error, warnings=warnings)
+            return DataResponse(data, dimensions, map_options, error, warnings=warnings, expiration=expiration)
 
         except DataRetrievalError as e:
             logger.error(str(e))
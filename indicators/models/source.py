@@ -4,19 +4,21 @@ from dataclasses import dataclass
 from typing import Union, Type, Optional, TYPE_CHECKING
 
 import psycopg2
+from django.conf import settings
 from django.contrib.gis.db.models import Union as GeoUnion
-from django.db import models, connections
+from django.db import models
 from django.db.models import QuerySet
 from polymorphic.models import PolymorphicModel
-from psycopg2.extras import RealDictCursor, RealDictConnection
+from psycopg2.extras import RealDictConnection
 
 from context.models import WithTags, WithContext
 from geo.models import AdminRegion, Tract, County, BlockGroup, CountySubdivision, SchoolDistrict
+from indicators import datastore_pool
 from indicators.models.time import TimeAxis
 from profiles.abstract_models import Described
-from profiles.settings import SQ_ALIAS, GEO_ALIAS
+from profiles.settings import SQ_ALIAS, GEO_ALIAS, TIME_ALIAS, TIME_KEY_ALIAS
 
-from profiles.settings import DENOM_DKEY, VALUE_DKEY, GEOG_DKEY, TIME_DKEY
+from profiles.settings import VALUE_DKEY, GEOG_DKEY, TIME_DKEY
 
 logger = logging.getLogger(__name__)
 
@@ -40,11 +42,30 @@ class Source(PolymorphicModel, Described, WithTags, WithContext):
 
     geographic_extent = models.ForeignKey('geo.AdminRegion', on_delete=models.PROTECT, null=True, blank=True)
 
+    data_ttl = models.DurationField(
+        verbose_name='Data TTL',
+        help_text='How long values from this source are kept in the indicator data store before being refreshed. '
+                  'Leave blank to use the default for this type of source.',
+        null=True,
+        blank=True,
+    )
+
+    # used when `data_ttl` isn't set; `None` means data from the source never expires
+    DEFAULT_DATA_TTL: Optional[datetime.timedelta] = None
+
+    # fields that change the data the source provides; changing them invalidates cached data for its variables
+    DATA_FIELDS: tuple[str, ...] = ('time_coverage_start', 'time_coverage_end')
+
     @property
     def info_link(self):
         """ Link to external resource where user can find info on data source and/or the source itself."""
         raise NotImplementedError
 
+    @property
+    def cache_ttl(self) -> Optional[datetime.timedelta]:
+        """ How long data from this source can be stored before it's considered stale. """
+        return self.data_ttl if self.data_ttl is not None else self.DEFAULT_DATA_TTL
+
     @property
     def static_date(self) -> Optional[str]:
         time_dict = {'year': 0, 'month': 1, 'day': 1, 'hour': 0, 'minute': 0}
@@ -72,6 +93,8 @@ class CensusSource(Source):
         default='CEN'
     )
 
+    DATA_FIELDS = Source.DATA_FIELDS + ('dataset',)
+
     class Meta:
         verbose_name = 'Census/ACS Source'
         verbose_name_plural = 'Census/ACS Sources'
@@ -88,6 +111,10 @@ class CensusSource(Source):
     def can_handle_geography(self, geog: AdminRegion):
         if type(geog) in (Tract, County, BlockGroup, SchoolDistrict, CountySubdivision):
             return True
+        # values for composite geogs are summed from their subregions when census data is loaded,
+        # or when they're requested for vintages loaded without them
+        if geog.geog_type_id in settings.CENSUS_COMPOSITE_GEOG_TYPES:
+            return True
         return False
 
 
@@ -108,6 +135,10 @@ class CKANSource(Source, PolymorphicModel):
 
     standardization_query = models.TextField(null=True, blank=True)
 
+    DEFAULT_DATA_TTL = settings.CKAN_DATA_TTL
+
+    DATA_FIELDS = Source.DATA_FIELDS + ('resource_id', 'time_field', 'time_field_format', 'standardization_query')
+
     class Meta:
         verbose_name = 'CKAN Source'
         verbose_name_plural = 'CKAN Sources'
@@ -133,35 +164,65 @@ class CKANSource(Source, PolymorphicModel):
     def can_handle_geography(self, geog: AdminRegion):
         raise NotImplementedError
 
-    def get_data_query(self, variable: 'CKANVariable', geogs: QuerySet['AdminRegion'],
-                       time_part: 'TimeAxis.TimePart', denom_select: str = None,
-                       parent_geog_lvl: Optional[Type[AdminRegion]] = None) -> str:
+    def get_time_series_query(self, variable: 'CKANVariable', geogs: QuerySet['AdminRegion'],
+                              time_parts: list['TimeAxis.TimePart'],
+                              parent_geog_lvl: Optional[Type[AdminRegion]] = None) -> str:
+        """
+        Returns a query for the data at every time part in `time_parts` in one scan of the source.
+
+        Source rows are joined to the time part whose window they fall in, and the hash of that time part
+        is returned as the time key so results can be split back out by time part.
+        """
+        value_select = f'{variable.agg_str}({SQ_ALIAS}."{variable.field}")'
+        return self._get_time_series_query([(value_select, VALUE_DKEY)], bool(variable.agg_str), geogs, time_parts,
+                                           parent_geog_lvl=parent_geog_lvl)
+
+    def get_fused_time_series_query(self, variables: list['CKANVariable'], geogs: QuerySet['AdminRegion'],
+                                    time_parts: list['TimeAxis.TimePart'],
+                                    parent_geog_lvl: Optional[Type[AdminRegion]] = None) -> str:
+        """
+        Same as `get_time_series_query` but with a value column for each variable in `variables`,
+        named with `fused_value_key`.
 
+        The variables must all be aggregated or all be unaggregated.
+        """
+        value_selects = [(f'{variable.agg_str}({SQ_ALIAS}."{variable.field}")', self.fused_value_key(i))
+                         for i, variable in enumerate(variables)]
+        return self._get_time_series_query(value_selects, bool(variables[0].agg_str), geogs, time_parts,
+                                           parent_geog_lvl=parent_geog_lvl)
+
+    @staticmethod
+    def fused_value_key(index: int) -> str:
+        return f'{VALUE_DKEY}{index}'
+
+    def _get_time_series_query(self, value_selects: list[tuple[str, str]], aggregated: bool,
+                               geogs: QuerySet['AdminRegion'], time_parts: list['TimeAxis.TimePart'],
+                               parent_geog_lvl: Optional[Type[AdminRegion]] = None) -> str:
         # get fields from source to select
         geog_select = self._get_geog_select(geogs, parent_geog_lvl)
         time_select = self._get_time_select_sql()
-        value_select = f'{SQ_ALIAS}."{variable.field}"'
-        agg_str = variable.agg_str
+        values_select = ',\n            '.join(f'{select} as {alias}' for select, alias in value_selects)
 
-        # get space and time filteget_data_queryrs
+        # get space and time filters
         geog_filter = self._get_geog_filter_sql(geogs)
-        time_filter = self._get_time_filter_sql(time_part, time_select)
+        time_keys = self._get_time_keys_sql(time_select, time_parts)
+        time_windows = self._get_time_windows_sql(time_parts)
 
         geog_type = geogs.all()[0].__class__
         from_subq = self._get_from_subquery(geog_type, parent_geog_lvl=parent_geog_lvl)
 
-        denom_select_and_alias = f', {denom_select} as {DENOM_DKEY}' if denom_select else ''
-
         query = f"""
         SELECT 
             {geog_select}                   as {GEOG_DKEY}, 
-            '{time_part.storage_hash}'      as {TIME_DKEY},
-            {agg_str}({value_select})       as {VALUE_DKEY}
-            {denom_select_and_alias}
+            {TIME_ALIAS}.hash               as {TIME_DKEY},
+            {values_select}
         FROM {from_subq} AS {SQ_ALIAS}
-        WHERE {geog_filter} AND {time_filter} 
+        CROSS JOIN LATERAL {time_keys}
+        JOIN {time_windows}
+            ON {TIME_KEY_ALIAS}.unit = {TIME_ALIAS}.unit AND {TIME_KEY_ALIAS}.key = {TIME_ALIAS}.key
+        WHERE {geog_filter} 
         """
-        query += f"GROUP BY __geog__ " if agg_str else ''
+        query += f"GROUP BY {GEOG_DKEY}, {TIME_DKEY} " if aggregated else ''
         return query
 
     def clean(self):
@@ -170,12 +231,12 @@ class CKANSource(Source, PolymorphicModel):
             pass
 
     @staticmethod
-    def query_datastore(query: str):
-        conn = connections['datastore']
-        conn.ensure_connection()
-        with conn.connection.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(query)
-            return cursor.fetchall()
+    def query_datastore(query: str, timeout: Optional[int] = None):
+        return datastore_pool.get_pool().query(query, timeout=timeout)
+
+    @staticmethod
+    def stream_datastore(query: str, itersize: Optional[int] = None, timeout: Optional[int] = None):
+        return datastore_pool.get_pool().stream(query, itersize=itersize, timeout=timeout)
 
     # SQL Generators
     def _get_geog_filter_sql(self, geogs: QuerySet['AdminRegion']) -> str:
@@ -186,21 +247,24 @@ class CKANSource(Source, PolymorphicModel):
         """
         raise NotImplementedError
 
-    def _get_time_filter_sql(self, time_part: 'TimeAxis.TimePart', time_select: str):
+    @staticmethod
+    def _get_time_keys_sql(time_select: str, time_parts: list['TimeAxis.TimePart']) -> str:
         """
-        Creates a chunk of SQL that will go in the WHERE clause that filters the dataset described by `source` to
-        only have data within specific time frame.
-
-        Said SQL chunk will compare the source data's 'time' field truncated to `time_unit`
-         against `time_point` truncated to `time_unit`
-
-        https://www.postgresql.org/docs/8.4/functions-datetime.html#FUNCTIONS-DATETIME-TRUNC
+        Creates a chunk of SQL for the FROM clause that truncates each source row's time to every unit
+        used by `time_parts`, so it can be joined to the time windows on plain columns.
         """
-        time_unit = time_part.unit_str
+        units = sorted({tp.unit_str for tp in time_parts})
+        rows = ', '.join(f"('{unit}', date_trunc('{unit}', {time_select}::timestamp))" for unit in units)
+        return f'(VALUES {rows}) AS {TIME_KEY_ALIAS} (unit, key)'
 
-        return f"""
-        date_trunc('{time_unit}',{time_select}::timestamp) = {time_part.trunc_sql_str}
+    @staticmethod
+    def _get_time_windows_sql(time_parts: list['TimeAxis.TimePart']) -> str:
         """
+        Creates a chunk of SQL for the FROM clause with a row for each time part: its hash,
+        the unit it covers and its time point truncated to that unit.
+        """
+        rows = ', '.join(f"('{tp.storage_hash}', '{tp.unit_str}', {tp.trunc_sql_str.strip()})" for tp in time_parts)
+        return f'(VALUES {rows}) AS {TIME_ALIAS} (hash, unit, key)'
 
     def _get_time_select_sql(self) -> str:
         """ Returns the source's time field, or a string representing the sole time unit covered by the source"""
@@ -231,6 +295,8 @@ class CKANGeomSource(CKANSource):
         blank=True
     )
 
+    DATA_FIELDS = CKANSource.DATA_FIELDS + ('geom_field',)
+
     def can_handle_geography(self, geog: AdminRegion):
         # while there may be no data in a geog, geocoded datasets can work with any geog
         return True
@@ -323,6 +389,13 @@ class CKANRegionalSource(CKANSource):
     neighborhood_field = models.CharField(max_length=100, null=True, blank=True)
     neighborhood_field_is_sql = models.BooleanField(default=False)
 
+    DATA_FIELDS = CKANSource.DATA_FIELDS + tuple(
+        f'{geog}_field{suffix}'
+        for geog in ('blockgroup', 'tract', 'countysubdivision', 'county', 'place', 'schooldistrict', 'zipcode',
+                     'neighborhood')
+        for suffix in ('', '_is_sql')
+    )
+
     def can_handle_geography(self, geog: Union[AdminRegion, Type[AdminRegion]]):
         return bool(self._get_source_geog_field(geog))
 
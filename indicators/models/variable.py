@@ -1,62 +1,46 @@
 import itertools
 import logging
-import math
 import statistics
+from concurrent.futures import Future
+from contextlib import closing
 from datetime import MINYEAR, MAXYEAR
-from typing import Dict, Optional, Type, List, Union
-
-from django.db import models
-from django.db.models import QuerySet, Sum, Manager, F, OuterRef, Subquery
+from functools import partial
+from typing import Dict, Optional, Type, List, Iterable, Iterator, Union
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.db import models, transaction
+from django.db.models import QuerySet, Manager, F, OuterRef, Subquery
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
 from django.utils import timezone
 from polymorphic.models import PolymorphicModel
 
+from census_data.composites import is_composite, get_composite_subgeogs
 from census_data.models import CensusValue, CensusTableRecord
+from census_data.virtual_tables import virtual_table_uid, compile_virtual_table, drop_virtual_table
 from context.models import WithContext, WithTags
 from geo.models import AdminRegion
 from indicators.data import Datum, GeogRecord, GeogCollection, AggregationMethod
-from indicators.errors import AggregationError, MissingSourceError, EmptyResultsError
-from indicators.models.data import CachedIndicatorData
-from indicators.models.source import Source, CensusSource, CKANSource, CKANRegionalSource
+from indicators import datastore, fusion, moe
+from indicators.errors import AggregationError, MissingSourceError, EmptyResultsError, DataRetrievalError
+from indicators.models.data import CachedIndicatorData, IndicatorDataBlock
+from indicators.models.source import Source, CensusSource, CKANSource, CKANGeomSource, CKANRegionalSource
 from indicators.models.time import TimeAxis
+from indicators.store import Cell, CellFetch, CellRecord, find_missing_cells, plan_cell_fetches, queue_refresh, \
+    queue_purge, read_hot_cells, write_hot_cells, cell_records_from_data
 from indicators.utils import ErrorLevel, ErrorRecord
 from profiles.abstract_models import Described
 
 logger = logging.getLogger(__name__)
 
 
-def find_missing_geogs_and_time_parts(
-        records: Union[QuerySet['CachedIndicatorData'], list['Datum']],
-        geog_collection: GeogCollection,
-        time_axis: TimeAxis,
-) -> ['AdminRegion', 'TimeAxis.TimePart']:
-    cached_combos: dict[str, dict[str, bool]] = {}
-    missing_geogs: set['AdminRegion'] = set()
-    missing_time_parts: set['TimeAxis.TimePart'] = set()
-
-    using_datum = type(records) == list
-
-    for record in records:
-        g_key = record.geog.global_geoid if using_datum else record.geog
-        t_key = record.time.storage_hash if using_datum else record.time_part_hash
-        if g_key not in cached_combos:
-            cached_combos[g_key] = {t_key: True}
-        else:
-            cached_combos[g_key][t_key] = True
-
-    # enumerate possible combinations and check status in trie
-    for combo in itertools.product(geog_collection.all_geogs, time_axis.time_parts):
-        g: 'AdminRegion' = combo[0]
-        t: 'TimeAxis.TimePart' = combo[1]
-        if g.global_geoid not in cached_combos or not cached_combos[g.global_geoid][t.storage_hash]:
-            missing_geogs.add(g)
-            missing_time_parts.add(t)
-
-    return missing_geogs, missing_time_parts
-
-
 class Variable(PolymorphicModel, Described, WithTags, WithContext):
     _agg_methods: dict
     _warnings: list[ErrorRecord] = []
+    # when the data last served by `get_values` needs refreshing; `None` if it never does
+    served_expiration: Optional[timezone.datetime] = None
 
     sources: Manager['Source']
     short_name = models.CharField(max_length=26, null=True, blank=True)
@@ -98,6 +82,16 @@ class Variable(PolymorphicModel, Described, WithTags, WithContext):
         default=0
     )
 
+    generation = models.IntegerField(
+        help_text='Incremented whenever a change is made that affects this variable\'s data. '
+                  'Cached data from older generations is ignored.',
+        default=0,
+        editable=False,
+    )
+
+    # fields that change the data collected for the variable
+    DATA_FIELDS: tuple[str, ...] = ('aggregation_method',)
+
     @property
     def display_name(self):
         return self.name
@@ -142,11 +136,37 @@ class Variable(PolymorphicModel, Described, WithTags, WithContext):
         """ Uses instances subclass's `_agg_methods` to determine what to return. """
         return self._agg_methods[self.aggregation_method]
 
+    @property
+    def cache_expiration(self) -> Optional[timezone.datetime]:
+        """ When data collected now for this variable should be refreshed; `None` if it never needs to be. """
+        ttls = [source.cache_ttl for source in self.sources.all() if source.cache_ttl is not None]
+        return timezone.now() + min(ttls) if ttls else None
+
     @property
     def primary_denominator(self) -> Optional['Variable']:
         denoms = self.denominators.all()
         return denoms[0] if len(denoms) else None
 
+    def bump_generation(self, _bumped: Optional[set[int]] = None):
+        """
+        Supersedes all the cached data for this variable and for any variables that use it as a denominator.
+
+        Old generations are purged in the background once the current transaction commits.
+        """
+        bumped = _bumped if _bumped is not None else set()
+        if self.pk in bumped:
+            return
+        bumped.add(self.pk)
+
+        if not Variable.objects.filter(pk=self.pk).update(generation=F('generation') + 1):
+            # the variable is being deleted
+            return
+        self.generation = Variable.objects.values_list('generation', flat=True).get(pk=self.pk)
+        transaction.on_commit(partial(queue_purge, self.slug, self.generation))
+
+        for dependent in Variable.objects.filter(denominators=self):
+            dependent.bump_generation(bumped)
+
     def get_values(
             self,
             geog_collection: GeogCollection,
@@ -168,61 +188,159 @@ class Variable(PolymorphicModel, Described, WithTags, WithContext):
         time_part_hash_lookup: dict[str, 'TimeAxis.TimePart'] = {tp.storage_hash: tp for tp in time_axis.time_parts}
         time_part_hashes = list(time_part_hash_lookup.keys())
 
-        # query indicator datastore for any cached results
-        cached_data = CachedIndicatorData.objects.filter(
-            variable=self.slug,
-            geog__in=[sg.global_geoid for sg in geog_collection.all_geogs],
-            time_part_hash__in=time_part_hashes,
-        )
-        result_data: list[Datum] = Variable._datums_from_indicator_caches(cached_data, time_part_hash_lookup)
+        # the spatial filter on `all_geogs` is expensive, so only evaluate it once
+        global_geoids: list[str] = geog_collection.global_geoids
+        geog_type_id: str = geog_collection.geog_type.geog_type_id
+
+        # check the hot tier first, then the indicator data store for whatever it doesn't have
+        cell_records: list[CellRecord] = read_hot_cells(self.slug, self.generation, geog_type_id,
+                                                        global_geoids, time_part_hashes)
+        hot_cells: set[Cell] = {(record[0], record[1]) for record in cell_records}
+        missing_cells: set[Cell] = set()
+        if len(hot_cells) < len(global_geoids) * len(time_part_hashes):
+            store_records = [record for record in
+                             CachedIndicatorData.get_cell_records(self.slug, self.generation,
+                                                                  global_geoids, time_part_hashes)
+                             if (record[0], record[1]) not in hot_cells]
+            # repopulate the hot tier with what we found
+            write_hot_cells(self.slug, self.generation, geog_type_id, store_records)
+            cell_records += store_records
+            # whatever isn't in either tier needs to be collected from the source
+            missing_cells = find_missing_cells(global_geoids, time_part_hashes, cell_records)
+
+        result_data: list[Datum] = self._datums_from_cell_records(cell_records, geog_collection, time_part_hash_lookup)
+
+        # expired data is still served, but is queued to be refreshed in the background
+        now = timezone.now()
+        stale_cells: set[Cell] = {(geoid, time_part_hash) for (geoid, time_part_hash, *_, expiration) in cell_records
+                                  if expiration and expiration <= now}
+        if stale_cells:
+            queue_refresh(self, geog_collection, time_axis.time_parts, stale_cells, use_denom=using_denom)
+        expirations = [expiration for (*_, expiration) in cell_records if expiration]
+
+        # collect the cells that we're missing from the source
+        if missing_cells:
+            filled_data, fill_expiration = self._fill_cells(geog_collection, time_axis.time_parts, missing_cells,
+                                                            use_denom=using_denom)
+            result_data += filled_data
+            if fill_expiration:
+                expirations.append(fill_expiration)
+        self.served_expiration = min(expirations, default=None)
 
-        # find out if any of the geogs we need data for
-        missing_geogs, missing_time_parts = find_missing_geogs_and_time_parts(
-            cached_data,
-            geog_collection,
-            time_axis,
-        )
+        # check data will raise any exception if there are any errors
+        warnings = self._check_values(result_data) + self._warnings
+        return result_data, warnings
+
+    def fill_cells(
+            self,
+            geog_collection: GeogCollection,
+            time_parts: list['TimeAxis.TimePart'],
+            cells: Iterable[Cell],
+            use_denom=True,
+    ) -> list['Datum']:
+        """
+        Collects data for `cells` from this variable's sources and saves it to the indicator data store.
 
-        if missing_geogs and len(missing_geogs) > (len(geog_collection.all_geogs) / 2):
-            print('👋 apparently missing data for', missing_geogs)
-            # generate temporary geog_collection and time_axis for the missing data
-            # to send to source-specific value getter
-            temp_geog_collection = GeogCollection(
-                geog_type=geog_collection.geog_type,
-                primary_geog=geog_collection.primary_geog,
-                geographic_extent=geog_collection.geographic_extent
-            )
-            # add records to geog collection by finding subgeogs
-            temp_geog_collection.records = geog_collection.filter_records_by_subgeog_ownership(missing_geogs)
-
-            temp_time_axis = TimeAxis.from_time_parts(list(missing_time_parts))
-
-            # get missing data using source specific queries
-            found_data: list[Datum] = self._get_values(
-                temp_geog_collection,
-                temp_time_axis,
-                use_denom=using_denom,
+        The cells are grouped into as few source queries as possible.  Denominators are joined in from
+        the denominator variable's own cells rather than queried alongside the values.
+
+        :returns: the Datums for `cells` that were found
+        """
+        return self._fill_cells(geog_collection, time_parts, cells, use_denom=use_denom)[0]
+
+    def _fill_cells(
+            self,
+            geog_collection: GeogCollection,
+            time_parts: list['TimeAxis.TimePart'],
+            cells: Iterable[Cell],
+            use_denom=True,
+    ) -> tuple[list['Datum'], Optional[timezone.datetime]]:
+        """ `fill_cells`, also returning when the earliest of the saved cells expires. """
+        cells = set(cells)
+        results: list[Datum] = []
+        expirations: list[timezone.datetime] = []
+        cell_fetches = plan_cell_fetches(geog_collection, {geoid for geoid, _ in cells}, time_parts, cells)
+
+        cell_fetch: CellFetch
+        for cell_fetch in cell_fetches:
+            logger.debug(f'Collecting {cell_fetch.size} cells for {self.slug}')
+            fetch_geog_collection = cell_fetch.geog_collection(geog_collection)
+            fetch_time_axis = cell_fetch.time_axis()
+            # get data using source specific queries
+            found_data: list[Datum] = cell_fetch.filter_data(self._get_values(
+                fetch_geog_collection,
+                fetch_time_axis,
                 agg_method=self.source_agg_method,
-            )
+            ))
+            denom_expiration = None
+            if use_denom:
+                found_data, denom_expiration = self._join_denominators(found_data, fetch_geog_collection,
+                                                                       fetch_time_axis)
+
+            # load the data into the store for future reuse, refreshing it no later than the denominators it used
+            expiration = min(filter(None, (self.cache_expiration, denom_expiration)), default=None)
+            results += found_data
+            if expiration:
+                expirations.append(expiration)
+            if not CachedIndicatorData.save_records(found_data, expiration=expiration):
+                # nothing found, or the variable's generation was bumped while we were collecting it
+                continue
+            found_records = cell_records_from_data(found_data, expiration)
+            geog_type_id = geog_collection.geog_type.geog_type_id
+            write_hot_cells(self.slug, self.generation, geog_type_id, found_records)
+            IndicatorDataBlock.write_records(self.slug, self.generation, geog_type_id, found_records)
+        return results, min(expirations, default=None)
+
+    def _join_denominators(
+            self,
+            data: list['Datum'],
+            geog_collection: GeogCollection,
+            time_axis: 'TimeAxis',
+    ) -> tuple[list['Datum'], Optional[timezone.datetime]]:
+        """
+        Adds the values of the primary denominator to `data`.
 
-            # load the missing data into the store for future reuse
-            CachedIndicatorData.save_records(found_data)
-            # combine cached and recently-collected data to final result
-            result_data += found_data
+        The denominator's values are read through its own `get_values`, so they come from the cell cache when
+        possible, and variables that share a denominator only fetch it from its source once.  Percents get
+        MOEs from the values' and denominators' MOEs, treating the values as a subset of their denominators.
 
-        # check data will raise any exception if there are any errors
-        warnings = self._check_values(result_data) + self._warnings
-        return result_data, warnings
+        :returns: the joined data and when the denominator values used need refreshing
+        """
+        denom_var: Optional[Variable] = self.primary_denominator
+        if not denom_var or not data:
+            return data, None
+        try:
+            denom_data, _ = denom_var.get_values(geog_collection, time_axis, use_denom=False)
+        except DataRetrievalError as e:
+            self._add_warning(ErrorRecord(
+                level=ErrorLevel.WARNING,
+                message=f'Denominator {denom_var.slug} is not available: {e}'
+            ))
+            return data, None
+
+        denom_lookup: dict[Cell, Datum] = {
+            (datum.geog.global_geoid, datum.time.storage_hash): datum for datum in denom_data
+        }
+        denoms = [denom_lookup.get((datum.geog.global_geoid, datum.time.storage_hash)) for datum in data]
+
+        def as_array(items: Iterable[Optional[float]]) -> np.ndarray:
+            return np.array([np.nan if item is None else item for item in items], dtype=float)
+
+        percent_moes = moe.proportion_moe(
+            as_array(datum.value for datum in data), as_array(datum.moe for datum in data),
+            as_array(denom and denom.value for denom in denoms), as_array(denom and denom.moe for denom in denoms),
+        )
+        return [datum.update(denom=denom.value if denom else None, percent_moe=moe.to_optional(percent_moe))
+                for datum, denom, percent_moe in zip(data, denoms, percent_moes)], denom_var.served_expiration
 
     def _get_values(
             self,
             geog_collection: GeogCollection,
             time_axis: 'TimeAxis',
-            use_denom=True,
             agg_method=None,
     ) -> list['Datum']:
         """
-        Implemented by source-specific subclasses
+        Implemented by source-specific subclasses. Denominators are joined in afterwards by `fill_cells`.
 
         :returns a flat list of Datums of length len(time_axis) * len(geog_collection)
         """
@@ -252,27 +370,21 @@ class Variable(PolymorphicModel, Described, WithTags, WithContext):
 
         return warnings
 
-    @staticmethod
-    def _datums_from_indicator_caches(
-            cache_items: QuerySet['CachedIndicatorData'],
+    def _datums_from_cell_records(
+            self,
+            cell_records: list['CellRecord'],
+            geog_collection: GeogCollection,
             time_part_lookup: dict[str, 'TimeAxis.TimePart']
     ) -> list['Datum']:
-        variable_slugs: list[str] = []
-        geog_global_geoids: list[str] = []
-        for item in cache_items:
-            variable_slugs.append(item.variable)
-            geog_global_geoids.append(item.geog)
-
-        variable_lookup = {v.slug: v for v in Variable.objects.filter(slug__in=variable_slugs)}
-        geog_lookup = {g.global_geoid: g for g in AdminRegion.objects.filter(global_geoid__in=geog_global_geoids)}
         return [Datum(
-            variable=variable_lookup[item.variable],
-            geog=geog_lookup[item.geog],
-            time=time_part_lookup[item.time_part_hash],
-            value=item.value,
-            moe=item.moe,
-            denom=item.denom,
-        ) for item in cache_items]
+            variable=self,
+            geog=geog_collection.records[geoid].geog,
+            time=time_part_lookup[time_part_hash],
+            value=value,
+            moe=moe,
+            denom=denom,
+            percent_moe=percent_moe,
+        ) for (geoid, time_part_hash, value, moe, denom, percent_moe, _) in cell_records]
 
     def _generate_cache_key(self, geogs: QuerySet['AdminRegion'], time_axis: 'TimeAxis', use_denom=True,
                             agg_method=None, parent_geog_lvl: Optional[Type['AdminRegion']] = None):
@@ -335,97 +447,109 @@ class CensusVariable(Variable):
     def _get_values(self,
                     geog_collection: GeogCollection,
                     time_axis: TimeAxis,
-                    use_denom=True,
                     agg_method=None) -> list[Datum]:
         """
         Goes across each geography in the collection and finds its subgeographies and then returns
         values, an aggregate of their subgeogs' values if necessary, for each geog in GeogCollection geogs
 
+        The values for every subgeog at every time part are pulled from `CensusValue` in a single query.
+        Estimates and MOEs are then summed across tables and aggregated up to each geog as arrays,
+        with MOEs propagated using root-sum-of-squares.
+
+        Composite geogs (e.g. neighborhoods) use the sums stored for them when their vintage was loaded.
+        Where there aren't any, or the variable isn't summed, they're aggregated from their subregions instead.
+
         :returns a flat list of Datums of length len(time_axis) * len(geog_collection)
         """
-        # 2a. get values for full set of subgeogs
+        table_uids_by_time_part = self.get_table_uids_for_time_axis(time_axis)
+        geog_records: list[GeogRecord] = list(geog_collection.records.values())
+        all_table_uids = {uid for value_uids, moe_uids in table_uids_by_time_part.values()
+                          for uid in value_uids + moe_uids}
+
+        # 1. get values for full set of subgeogs across all tables at once
+        members: list[list[str]] = [[CensusValue.geog_uid_for(subgeog) for subgeog in geog_record.subgeogs]
+                                    for geog_record in geog_records]
+        census_values = CensusValue.get_value_lookup({uid for uids in members for uid in uids}, all_table_uids)
+
+        # composites without stored values need their subregions' values too
+        fallbacks = self._get_composite_fallbacks(geog_records, members, census_values, table_uids_by_time_part)
+        fallback_uids = {uid for by_record in fallbacks.values() for uids in by_record.values() for uid in uids}
+        if fallback_uids:
+            census_values.update(CensusValue.get_value_lookup(fallback_uids, all_table_uids))
+
+        divided = any(geog_record.is_divided for geog_record in geog_records) \
+            or any(by_record for by_record in fallbacks.values())
+        if divided and self.aggregation_method not in (AggregationMethod.SUM, AggregationMethod.MEAN):
+            raise AggregationError(f'{self.aggregation_method} not available on ACS or Census values.')
+
+        subgeog_positions: dict[str, int] = {}
+        for uid in itertools.chain(itertools.chain.from_iterable(members), sorted(fallback_uids)):
+            subgeog_positions.setdefault(uid, len(subgeog_positions))
+        subgeog_uids = list(subgeog_positions.keys())
+
         results: list[Datum] = []
-        geog_record: GeogRecord
-        for geog_record in geog_collection.records.values():
-            geog_record.data = []
-            for subgeog in geog_record.subgeogs:
-                geog_record.add_time_part_records(
-                    subgeog,
-                    self._get_values_for_geog(subgeog, time_axis, use_denom)
-                )
+        for time_part_hash, (value_ids, moe_ids) in table_uids_by_time_part.items():
+            # (geog × subgeog) matrix used to aggregate subgeog values up to their geogs
+            membership = np.zeros((len(geog_records), len(subgeog_uids)))
+            for i, uids in enumerate(members):
+                for uid in fallbacks[time_part_hash].get(i, uids):
+                    membership[i, subgeog_positions[uid]] = 1
+            member_counts = membership.sum(axis=1)
+
+            # 2a. combine the tables for each subgeog
+            subgeog_values = moe.sum_estimates(self._census_value_array(census_values, subgeog_uids, value_ids))
+            subgeog_moes = moe.rss(self._census_value_array(census_values, subgeog_uids, moe_ids))
+
             # 2b. aggregate those values up to the set of neighbor geogs
-            # and add the Datums to the final flat list of results
-            results += list(geog_record.get_aggregate_data(self, time_axis, use_denom).values())
+            values = moe.aggregate_estimates(subgeog_values, membership)
+            moes = moe.aggregate_moes(subgeog_moes, membership)
+            if self.aggregation_method == AggregationMethod.MEAN:
+                values, moes = values / member_counts, moes / member_counts
+
+            time_part = time_axis.time_part_lookup[time_part_hash]
+            results += [Datum(variable=self, geog=geog_record.geog, time=time_part,
+                              value=moe.to_optional(value), moe=moe.to_optional(margin))
+                        for geog_record, value, margin in zip(geog_records, values, moes)]
 
         return results
 
-    def _get_values_for_geog(self,
-                             geog: AdminRegion,
-                             time_axis: TimeAxis,
-                             use_denom=True) -> dict[str, Datum]:
-        """
-        Retrieves data for the variable instance at the geography `geog_record.geog`
-        :returns dict that maps time_part slugs to the data at that time
-        """
-        # get the census/acs tables for the points in time_axis
-        census_table_records_by_year: Dict[
-            str, QuerySet[CensusTableRecord]] = self.get_census_table_records_for_time_axis(time_axis)
-        denom_census_table_records_by_year: Dict[str, QuerySet[CensusTableRecord]] = {}
-
-        if use_denom:
-            denoms = self.denominators.all()
-            denom_census_table_records_by_year = denoms[0].get_census_table_records_for_time_axis(
-                time_axis) if denoms else {}
-
-        # extract and compute the values at each point in time_axis
-        results: dict[str, Datum] = {}
-        time_part_hash: str
-        for time_part_hash, records in census_table_records_by_year.items():
-            # extract IDs
-            value_ids, moe_ids = CensusTableRecord.get_table_uids(records)
-            val = CensusValue.objects.filter(
-                geog_uid=geog.affgeoid,
-                census_table_uid__in=value_ids
-            ).values('geog_uid').annotate(val=Sum('value')).values('val')[0]['val']
-
-            if len(moe_ids) == 1:
-                # https://www.census.gov/content/dam/Census/library/publications/2018/acs/acs_general_handbook_2018_ch08.pdf
-                moe_results = CensusValue.objects.filter(
-                    geog_uid=geog.affgeoid,
-                    census_table_uid__in=moe_ids
-                ).annotate(
-                    moe=(F('value') ** 2.0)
-                ).values('moe').values('moe')
-                moe: Optional[float] = None
-                # filter out null values
-                all_moes = [result['moe'] for result in moe_results if result['moe'] is not None]
-                if all_moes:
-                    moe = math.sqrt(sum(all_moes))
+    def _get_composite_fallbacks(
+            self,
+            geog_records: list[GeogRecord],
+            members: list[list[str]],
+            census_values: dict[tuple[str, str], Optional[float]],
+            table_uids_by_time_part: dict[str, tuple[list[str], list[str]]]
+    ) -> dict[str, dict[int, list[str]]]:
+        """
+        Finds the composite geogs in `geog_records` that have to be aggregated from their subregions.
 
-            else:
-                self._add_warning(
-                    ErrorRecord(
-                        level=ErrorLevel.WARNING,
-                        message='Margins of Error for compound variables cannot be accurately reported at this time.'))
-                moe = None
-
-            # if denom is being used, look up the corresponding record and get its value
-            denom, percent = None, None
-            if use_denom and time_part_hash in denom_census_table_records_by_year:
-                denom_record = denom_census_table_records_by_year[time_part_hash]
-                denom_ids, _ = CensusTableRecord.get_table_uids(denom_record)
-                denom = CensusValue.objects.filter(
-                    geog_uid=geog.affgeoid,
-                    census_table_uid__in=denom_ids
-                ).values('geog_uid').annotate(denom=Sum('value')).values('denom')[0]['denom']
-                if denom and denom > 0:
-                    percent = val / denom
-
-            results[time_part_hash] = Datum(variable=self, time=time_axis.time_part_lookup[time_part_hash], geog=geog,
-                                            value=val, moe=moe, denom=denom, percent=percent)
-
-        # return dict that maps time_part hashes to the data at that time
-        return results
+        Stored composite values are sums, so they're only used for summed variables, and only for
+        vintages where they were stored.
+
+        :return: for each time part hash, the uids of the subregions to use for those records, by position
+        """
+        fallbacks: dict[str, dict[int, list[str]]] = {time_part_hash: {} for time_part_hash in table_uids_by_time_part}
+        for i, geog_record in enumerate(geog_records):
+            if geog_record.is_divided or not is_composite(geog_record.geog):
+                continue
+            subregion_uids: Optional[list[str]] = None
+            for time_part_hash, (value_ids, _) in table_uids_by_time_part.items():
+                stored = self.aggregation_method == AggregationMethod.SUM \
+                         and any((members[i][0], uid) in census_values for uid in value_ids)
+                if stored:
+                    continue
+                if subregion_uids is None:
+                    subregion_uids = [CensusValue.geog_uid_for(subgeog)
+                                      for subgeog in get_composite_subgeogs(geog_record.geog)]
+                fallbacks[time_part_hash][i] = subregion_uids
+        return fallbacks
+
+    @staticmethod
+    def _census_value_array(census_values: dict[tuple[str, str], Optional[float]],
+                            geog_uids: list[str], table_uids: list[str]) -> np.ndarray:
+        """ Returns a (geog × table) array of values from `census_values`, with NaN where there's no value. """
+        return np.array([[census_values.get((geog_uid, table_uid)) for table_uid in table_uids]
+                         for geog_uid in geog_uids], dtype=float).reshape(len(geog_uids), len(table_uids))
 
     # Utils
     def _get_source_for_time_point(self, time_point: timezone.datetime) -> 'CensusSource':
@@ -438,12 +562,15 @@ class CensusVariable(Variable):
             time_coverage_end__gte=time_point,
         )[0]
 
+    def _get_census_variable_source_for_time_part(self, time_part: 'TimeAxis.TimePart') -> 'CensusVariableSource':
+        source = self._get_source_for_time_point(time_part.time_point)
+        return CensusVariableSource.objects.get(variable=self, source=source)
+
     def _get_census_table_record_for_time_part(self, time_part: 'TimeAxis.TimePart') -> QuerySet['CensusTableRecord']:
         """
         Returns a queryset that represents all `CensusTableRecord`s (value and moe tables) related to `time_part`.
         """
-        source = self._get_source_for_time_point(time_part.time_point)
-        return CensusVariableSource.objects.get(variable=self, source=source).census_table_records.all()
+        return self._get_census_variable_source_for_time_part(time_part).census_table_records.all()
 
     def get_census_table_records_for_time_axis(self, time_axis: 'TimeAxis') -> Dict[str, QuerySet['CensusTableRecord']]:
         """
@@ -454,6 +581,32 @@ class CensusVariable(Variable):
             data[time_part.storage_hash] = self._get_census_table_record_for_time_part(time_part)
         return data
 
+    def get_table_uids_for_time_axis(self, time_axis: 'TimeAxis') -> dict[str, tuple[list[str], list[str]]]:
+        """
+        Return a dict mapping time_parts, by hash, to the uids of their value and MOE census tables.
+
+        Compound sources are resolved to their compiled virtual table.  Resolved uids are cached by the
+        variable's generation, which changes along with its census table links.
+        """
+        cache = caches[settings.CENSUS_TABLE_UIDS_CACHE]
+        keys = {self._table_uids_cache_key(tp.storage_hash): tp for tp in time_axis.time_parts}
+        cached: dict[str, tuple[list[str], list[str]]] = cache.get_many(list(keys.keys()))
+
+        results: dict[str, tuple[list[str], list[str]]] = {}
+        new_entries: dict[str, tuple[list[str], list[str]]] = {}
+        for key, time_part in keys.items():
+            if key not in cached:
+                link = self._get_census_variable_source_for_time_part(time_part)
+                cached[key] = new_entries[key] = link.get_table_uids()
+            results[time_part.storage_hash] = cached[key]
+
+        if new_entries:
+            cache.set_many(new_entries, timeout=settings.CENSUS_TABLE_UIDS_CACHE_TTL)
+        return results
+
+    def _table_uids_cache_key(self, time_part_hash: str) -> str:
+        return f'census-table-uids:{self.slug}@{self.generation}:{time_part_hash}'
+
 
 class CKANVariable(Variable):
     sources = models.ManyToManyField(
@@ -466,6 +619,8 @@ class CKANVariable(Variable):
     )
     sql_filter = models.TextField(help_text='SQL clause that will be used to filter data.', null=True, blank=True)
 
+    DATA_FIELDS = Variable.DATA_FIELDS + ('field', 'sql_filter')
+
     _agg_methods = {
         AggregationMethod.NONE: None,
         AggregationMethod.COUNT: 'COUNT',
@@ -487,47 +642,45 @@ class CKANVariable(Variable):
     def _get_values(self,
                     geog_collection: GeogCollection,
                     time_axis: TimeAxis,
-                    use_denom=True,
                     agg_method=None) -> list[Datum]:
         """
         Goes across each geography in the collection and finds its subgeographies and then returns
         values, an aggregate of their subgeogs' values if necessary, for each geog in GeogCollection geogs
 
+        Every time part served by the same source is fetched in a single query, which also collects the data
+        for any sibling variables on the same source when queries are being fused (see `indicators.fusion`).
+
         :returns a flat list of Datums of length len(time_axis) * len(geog_collection)
         """
         results: list[Datum] = []
         parent_geog_lvl: Type['AdminRegion'] = geog_collection.geog_type
         sub_geogs: QuerySet['AdminRegion'] = geog_collection.all_subgeogs
-        print('GETTING')
-        for time_part in time_axis.time_parts:
-            source: CKANSource = self._get_source_for_time_part(time_part)
-            denom_select, denom_data = self._get_denom_data(source, sub_geogs, time_part) if use_denom else (None, None)
-
-            # get the raw data for this geog and time_part from CKAN
-            query = source.get_data_query(
-                self,
-                sub_geogs,
-                time_part,
-                parent_geog_lvl=parent_geog_lvl,
-                denom_select=denom_select
-            )
-
-            # get data from ckan and wrap it in our Datum class
-            raw_data: list[dict] = source.query_datastore(query)
-            var_data: list[Datum] = Datum.from_ckan_response_data(self, raw_data, time_axis.time_part_lookup)
+
+        # the sources' queries are independent, so start them all before waiting on any.
+        # large results are streamed instead, in this thread, once the others are underway
+        pending: list[tuple[CKANSource, Union[Future, Iterator]]] = []
+        for source, time_parts in self._get_time_parts_by_source(time_axis).items():
+            if self._should_stream(source, sub_geogs, time_parts):
+                query = source.get_time_series_query(self, sub_geogs, time_parts, parent_geog_lvl=parent_geog_lvl)
+                pending.append((source, datastore.stream_query(source, query)))
+            else:
+                pending.append((source, self._query_source(source, sub_geogs, time_parts, parent_geog_lvl,
+                                                           geog_collection.subgeog_global_geoids)))
+
+        for source, rows in pending:
+            # get the raw data for these geogs and time_parts from CKAN and wrap it in our Datum class
+            var_data: list[Datum]
+            if isinstance(rows, Future):
+                var_data = Datum.from_ckan_response_data(self, rows.result(), time_axis.time_part_lookup)
+            else:
+                # regional sources aggregate every row below, otherwise only a row per cell is needed
+                var_data = self._consume_stream(rows, time_axis, keep_all=type(source) == CKANRegionalSource)
 
             # for regional sources, we need to aggregate here for now
             if parent_geog_lvl and type(source) == CKANRegionalSource:
                 var_data = self._aggregate_data(var_data, type(sub_geogs[0]), parent_geog_lvl)
-                if denom_data:
-                    denom_data = self._aggregate_data(denom_data, type(sub_geogs[0]), parent_geog_lvl)
 
-            if denom_data:
-                # we need to link the data
-                results += self._join_data(var_data, denom_data)
-            else:
-                # either no denom at all, or denom was in same source, and captured using `denom_select`
-                results += var_data
+            results += var_data
 
         # at this point, results
         return results
@@ -536,13 +689,104 @@ class CKANVariable(Variable):
     def agg_str(self):
         return '' if self.aggregation_method == AggregationMethod.NONE else self.aggregation_method
 
-    # Utils
-    @staticmethod
-    def _join_data(var_data: List[Datum], denom_data: List[Datum]):
-        """ Adds denom value to appropriate datum in response data """
-        denom_lookup: dict[str, Optional[float]] = {f'{d.geog}/{d.time}': d.value for d in denom_data}
-        return [v.with_denom_val(denom_lookup[f'{v.geog}/{v.time}']) for v in var_data]
+    def can_fuse_with(self, other: 'Variable') -> bool:
+        """ Whether this variable's values can be selected in the same query as `other`'s. """
+        return (isinstance(other, CKANVariable)
+                and bool(self.agg_str) == bool(other.agg_str)
+                and self.sql_filter == other.sql_filter)
 
+    def _query_source(self, source: CKANSource, geogs: QuerySet['AdminRegion'], time_parts: list[TimeAxis.TimePart],
+                      parent_geog_lvl: Optional[Type['AdminRegion']], global_geoids: list[str]) -> Future:
+        """
+        Starts fetching the rows for this variable from `source`, along with its fusion partners' rows.
+
+        :param global_geoids: the geoids of `geogs`, to identify the fetch without querying them again
+
+        :return: a future for this variable's rows
+        """
+        fused = fusion.current()
+        partners = self._get_fusion_partners(fused, source, time_parts) if fused else [self]
+        if len(partners) == 1:
+            query = source.get_time_series_query(self, geogs, time_parts, parent_geog_lvl=parent_geog_lvl)
+            return datastore.submit_query(source, query)
+
+        key = fusion.fetch_key(source, global_geoids, time_parts, parent_geog_lvl)
+        existing, partner_futures = fused.claim(self, key, partners)
+        if existing is not None:
+            return existing
+
+        logger.debug(f'Fusing queries for {[partner.slug for partner in partners]} on {source.slug}')
+        own_rows = Future()
+        value_keys = {partner.pk: source.fused_value_key(i) for i, partner in enumerate(partners)}
+
+        def split_rows(fused_rows: Future):
+            """ Hands each partner its column of the fused query """
+            futures = {self.pk: own_rows, **partner_futures}
+            if fused_rows.exception() is not None:
+                for future in futures.values():
+                    future.set_exception(fused_rows.exception())
+                return
+            rows_by_pk = fusion.split_rows(fused_rows.result(), {pk: value_keys[pk] for pk in futures})
+            for pk, future in futures.items():
+                future.set_result(rows_by_pk[pk])
+
+        try:
+            query = source.get_fused_time_series_query(partners, geogs, time_parts, parent_geog_lvl=parent_geog_lvl)
+            datastore.submit_query(source, query).add_done_callback(split_rows)
+        except Exception as e:
+            # partners may already be waiting on this query
+            for future in partner_futures.values():
+                future.set_exception(e)
+            raise
+        return own_rows
+
+    def _consume_stream(self, batches: Iterator[tuple[tuple[str, ...], list[tuple]]], time_axis: TimeAxis,
+                        keep_all: bool) -> list[Datum]:
+        """
+        Builds Datums from streamed batches of rows as they're fetched.
+
+        Unless `keep_all`, only the last Datum for each cell is kept, since it's the one that would be stored,
+        so memory is bounded by the number of cells rather than the number of rows.
+        """
+        with closing(batches):
+            data = Datum.from_ckan_response_batches(self, batches, time_axis.time_part_lookup)
+            if keep_all:
+                return list(data)
+            by_cell: dict[Cell, Datum] = {}
+            for datum in data:
+                by_cell[(datum.geog.global_geoid, datum.time.storage_hash)] = datum
+            return list(by_cell.values())
+
+    def _should_stream(self, source: CKANSource, geogs: QuerySet['AdminRegion'],
+                       time_parts: list[TimeAxis.TimePart]) -> bool:
+        """
+        Whether to stream this variable's rows from `source` rather than fetch them all at once.
+
+        Unaggregated queries return a row per record, so they're always streamed.  Fused queries aren't,
+        since their rows are shared with other variables.
+        """
+        fused = fusion.current()
+        if fused and len(self._get_fusion_partners(fused, source, time_parts)) > 1:
+            return False
+        if not self.agg_str:
+            return True
+        return geogs.count() * len(time_parts) >= settings.DATASTORE_STREAMING_MIN_ROWS
+
+    def _get_fusion_partners(self, fused: 'fusion.FusedQueries', source: CKANSource,
+                             time_parts: list[TimeAxis.TimePart]) -> list['CKANVariable']:
+        """ Returns this variable and any others being fused with it that get `time_parts` from `source` """
+        partners: list[CKANVariable] = [self]
+        for other in fused.variables:
+            if other.pk == self.pk or other in partners or not self.can_fuse_with(other):
+                continue
+            try:
+                if all(other._get_source_for_time_part(time_part) == source for time_part in time_parts):
+                    partners.append(other)
+            except MissingSourceError:
+                continue
+        return partners
+
+    # Utils
     def _aggregate_data(self, data: list[Datum], base_geog_lvl: Type[AdminRegion],
                         parent_geog_lvl: Type[AdminRegion]) -> list[Datum]:
         """ Rolls up data to `parent_geog_lvl` using `self.aggregation_method` """
@@ -603,6 +847,13 @@ class CKANVariable(Variable):
                 results.append(Datum(variable=self, geog=parent_geog, time=time, value=value, denom=denom))
         return results
 
+    def _get_time_parts_by_source(self, time_axis: TimeAxis) -> dict[CKANSource, list[TimeAxis.TimePart]]:
+        """ Groups the time parts in `time_axis` by the source that covers them """
+        time_parts_by_source: dict[CKANSource, list[TimeAxis.TimePart]] = {}
+        for time_part in time_axis.time_parts:
+            time_parts_by_source.setdefault(self._get_source_for_time_part(time_part), []).append(time_part)
+        return time_parts_by_source
+
     def _get_source_for_time_part(self, time_part: TimeAxis.TimePart) -> Optional[CKANSource]:
         """ Return CKAN source that covers the time in `time_point` """
         # fixme: we'll need to come up with a more correct way of doing this: maybe a `through` relationship
@@ -615,37 +866,139 @@ class CKANVariable(Variable):
                 return source
         raise MissingSourceError(f'No source found for `{self.slug}` for time period `{time_part.slug}`.')
 
-    def _get_denom_data(self, source: 'CKANSource', geogs: QuerySet['AdminRegion'],
-                        time_part: 'TimeAxis.TimePart') -> tuple[str, list[Datum]]:
-        # check for denominator and handle
-        denom_var: 'CKANVariable' = self.primary_denominator
-        denom_select = None
-        denom_data: list[Datum] = []
-        time_part_lookup: dict[str, time_part] = {time_part.storage_hash: time_part}
-
-        if denom_var:
-            if len(denom_var.sources.filter(pk=source.pk)):
-                # if denom uses the same source we can simply pass its field select
-                denom_select = f'{denom_var.agg_str}("{denom_var.field}")'
-            else:
-                # if not, keep the denom select null , but fire off a call to collect
-                denom_source = denom_var._get_source_for_time_part(time_part)
-                denom_query = denom_source.get_data_query(denom_var, geogs, time_part)
-                denom_data = Datum.from_ckan_response_data(
-                    denom_var,
-                    source.query_datastore(denom_query),
-                    time_part_lookup
-                )
-
-        return denom_select, denom_data
-
 
 class CensusVariableSource(models.Model):
     """ for linking Census variables to their sources while keeping track of the census formula format for that combo"""
     variable = models.ForeignKey('CensusVariable', on_delete=models.CASCADE, related_name='variable_to_source')
     source = models.ForeignKey('CensusSource', on_delete=models.CASCADE, related_name='source_to_variable')
     census_table_records = models.ManyToManyField('census_data.CensusTableRecord')
+    compiled_table_uid = models.CharField(
+        max_length=100, null=True, blank=True, editable=False,
+        help_text="Virtual table holding the precomputed sum of this link's tables when it has more than one."
+    )
 
     class Meta:
         index_together = ('variable', 'source',)
         unique_together = ('variable', 'source',)
+
+    def get_table_uids(self) -> tuple[list[str], list[str]]:
+        """ Returns the uids of the value and MOE tables whose values are summed to get this link's values. """
+        if self.compiled_table_uid:
+            return [f'{self.compiled_table_uid}E'], [f'{self.compiled_table_uid}M']
+        return CensusTableRecord.get_table_uids(self.census_table_records.all())
+
+    def compile(self, table: Optional[str] = None) -> int:
+        """
+        Precomputes the sum of this link's tables into a virtual table, if it has more than one table.
+
+        :param table: table holding the census values; defaults to `CensusValue`'s table
+        :return: number of values compiled
+        """
+        records = list(self.census_table_records.all())
+        vintages = {(record.dataset, record.year) for record in records}
+        uid, count = None, 0
+        if len(records) > 1 and len(vintages) == 1:
+            dataset, year = vintages.pop()
+            uid = virtual_table_uid(dataset, year, self.pk)
+            count = compile_virtual_table(uid, *CensusTableRecord.get_table_uids(records), table=table)
+
+        if self.compiled_table_uid and self.compiled_table_uid != uid:
+            drop_virtual_table(self.compiled_table_uid)
+        if uid != self.compiled_table_uid:
+            CensusVariableSource.objects.filter(pk=self.pk).update(compiled_table_uid=uid)
+            self.compiled_table_uid = uid
+        return count
+
+    @staticmethod
+    def compile_vintage(dataset: str, year: int, table: Optional[str] = None) -> int:
+        """ Recompiles the virtual tables of every link to the vintage's tables, e.g. after it's reloaded. """
+        links = CensusVariableSource.objects.filter(census_table_records__dataset=dataset,
+                                                    census_table_records__year=year).distinct()
+        return sum(link.compile(table=table) for link in links)
+
+    @staticmethod
+    def invalidate_vintage(dataset: str, year: int):
+        """ Supersedes the cached data of every variable that uses the vintage's tables, e.g. after it's reloaded. """
+        variable_ids = CensusVariableSource.objects.filter(census_table_records__dataset=dataset,
+                                                           census_table_records__year=year).values('variable_id')
+        _bump_generations(Variable.objects.filter(pk__in=variable_ids))
+
+
+# Cache invalidation
+# -*-*-*-*-*-*-*-*-*-
+def _bump_generations(variables: Iterable['Variable']):
+    bumped: set[int] = set()
+    for variable in variables:
+        variable.bump_generation(bumped)
+
+
+# models with `DATA_FIELDS`, whose saves can change the data they provide
+DATA_MODELS = (Variable, CensusVariable, CKANVariable,
+               Source, CensusSource, CKANSource, CKANGeomSource, CKANRegionalSource)
+
+
+def track_data_changes(sender, instance, **kwargs):
+    """ Notes whether a save to a variable or source will change the data it provides. """
+    if instance.pk is None:
+        return
+    try:
+        previous = sender.objects.filter(pk=instance.pk).values(*instance.DATA_FIELDS).get()
+    except sender.DoesNotExist:
+        return
+    instance._data_changed = any(getattr(instance, field) != previous[field] for field in instance.DATA_FIELDS)
+
+
+def invalidate_on_data_change(sender, instance, created=False, **kwargs):
+    if created or not getattr(instance, '_data_changed', False):
+        return
+    instance._data_changed = False
+    if isinstance(instance, Variable):
+        instance.bump_generation()
+    elif isinstance(instance, CensusSource):
+        _bump_generations(instance.census_variables.all())
+    elif isinstance(instance, CKANSource):
+        _bump_generations(instance.ckan_variables.all())
+
+
+for data_model in DATA_MODELS:
+    pre_save.connect(track_data_changes, sender=data_model, dispatch_uid=f'track_data_changes:{data_model.__name__}')
+    post_save.connect(invalidate_on_data_change, sender=data_model,
+                      dispatch_uid=f'invalidate_on_data_change:{data_model.__name__}')
+
+
+@receiver(m2m_changed, sender=Variable.denominators.through, dispatch_uid='invalidate_on_denominator_change')
+@receiver(m2m_changed, sender=CKANVariable.sources.through, dispatch_uid='invalidate_on_ckan_source_change')
+def invalidate_on_variable_link_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    variables = [instance] if isinstance(instance, Variable) else []
+    if pk_set and (reverse or sender is Variable.denominators.through):
+        # the variables on the other side of the link
+        variables += list(Variable.objects.filter(pk__in=pk_set))
+    _bump_generations(variables)
+
+
+@receiver(post_save, sender=CensusVariableSource, dispatch_uid='invalidate_on_census_source_link_save')
+@receiver(post_delete, sender=CensusVariableSource, dispatch_uid='invalidate_on_census_source_link_delete')
+def invalidate_on_census_source_link_change(sender, instance: CensusVariableSource, **kwargs):
+    if kwargs.get('signal') is post_delete:
+        if instance.compiled_table_uid:
+            drop_virtual_table(instance.compiled_table_uid)
+    elif not kwargs.get('raw'):
+        instance.compile()
+    _bump_generations(Variable.objects.filter(pk=instance.variable_id))
+
+
+@receiver(m2m_changed, sender=CensusVariableSource.census_table_records.through,
+          dispatch_uid='invalidate_on_census_table_change')
+def invalidate_on_census_table_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        # changed from the table record's side; `pk_set` holds the affected links
+        links = CensusVariableSource.objects.filter(pk__in=pk_set or [])
+    else:
+        links = [instance]
+    for link in links:
+        link.compile()
+    _bump_generations(Variable.objects.filter(pk__in=[link.variable_id for link in links]))
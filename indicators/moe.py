@@ -0,0 +1,82 @@
+"""
+Margin of error calculations for ACS estimates.
+
+The formulas come from chapter 8 of the ACS General Handbook:
+https://www.census.gov/content/dam/Census/library/publications/2018/acs/acs_general_handbook_2018_ch08.pdf
+
+Everything works on NumPy arrays so whole geog collections are handled at once.  NaN marks a missing
+estimate or MOE.
+"""
+from typing import Optional
+
+import numpy as np
+
+
+def sum_estimates(values: np.ndarray, axis=-1) -> np.ndarray:
+    """ Sums estimates along `axis`, skipping missing ones; NaN where they're all missing. """
+    values = np.asarray(values, dtype=float)
+    return np.where(np.all(np.isnan(values), axis=axis), np.nan, np.nansum(values, axis=axis))
+
+
+def rss(moes: np.ndarray, axis=-1) -> np.ndarray:
+    """
+    MOE of a sum of estimates: the root of the sum of the squared MOEs along `axis`.
+
+    Missing MOEs are skipped; NaN where they're all missing.
+    """
+    moes = np.asarray(moes, dtype=float)
+    return np.where(np.all(np.isnan(moes), axis=axis), np.nan, np.sqrt(np.nansum(np.square(moes), axis=axis)))
+
+
+def aggregate_estimates(values: np.ndarray, membership: np.ndarray) -> np.ndarray:
+    """
+    Sums the estimates of members into their groups.
+
+    :param values: estimates with one row per member
+    :param membership: (group × member) matrix with 1 where the member is part of the group
+    :return: estimates with one row per group; NaN for groups missing an estimate for any member
+    """
+    values = np.asarray(values, dtype=float)
+    missing = membership @ np.isnan(values).astype(float)
+    return np.where(missing > 0, np.nan, membership @ np.nan_to_num(values))
+
+
+def aggregate_moes(moes: np.ndarray, membership: np.ndarray) -> np.ndarray:
+    """
+    MOEs of the sums of member estimates for each group (see `aggregate_estimates`).
+
+    Missing MOEs are skipped; NaN for groups with no MOEs at all.
+    """
+    moes = np.asarray(moes, dtype=float)
+    found = membership @ (~np.isnan(moes)).astype(float)
+    return np.where(found > 0, np.sqrt(membership @ np.square(np.nan_to_num(moes))), np.nan)
+
+
+def ratio_moe(numerator: np.ndarray, numerator_moe: np.ndarray,
+              denominator: np.ndarray, denominator_moe: np.ndarray) -> np.ndarray:
+    """ MOE of `numerator / denominator` when the numerator isn't a subset of the denominator. """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = numerator / denominator
+        return np.sqrt(np.square(numerator_moe) + np.square(ratio) * np.square(denominator_moe)) / denominator
+
+
+def proportion_moe(numerator: np.ndarray, numerator_moe: np.ndarray,
+                   denominator: np.ndarray, denominator_moe: np.ndarray) -> np.ndarray:
+    """
+    MOE of `numerator / denominator` when the numerator is a subset of the denominator.
+
+    Falls back to the ratio formula where the value under the square root would be negative, as the handbook advises.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        proportion = numerator / denominator
+        under_root = np.square(numerator_moe) - np.square(proportion) * np.square(denominator_moe)
+        return np.where(
+            under_root < 0,
+            ratio_moe(numerator, numerator_moe, denominator, denominator_moe),
+            np.sqrt(np.abs(under_root)) / denominator
+        )
+
+
+def to_optional(value: float) -> Optional[float]:
+    """ Converts NaN (and the infinities from dividing by zero) to `None` for storing results in Datums """
+    return None if not np.isfinite(value) else float(value)
@@ -9,7 +9,7 @@ from .source import SourceSerializer
 from .time import TimeAxisPolymorphicSerializer
 from .variable import IndicatorVariablePolymorphicSerializer
 from ..models.indicator import Indicator
-from ..utils import DataResponse
+from ..utils import DataPayload
 
 
 class IndicatorBriefSerializer(serializers.HyperlinkedModelSerializer):
@@ -100,7 +100,7 @@ class IndicatorWithDataSerializer(IndicatorSerializer):
         )
 
     @lru_cache
-    def _get_data_response(self, indicator: Indicator, geog: AdminRegion, across_geogs: bool) -> DataResponse:
+    def _get_data_response(self, indicator: Indicator, geog: AdminRegion, across_geogs: bool) -> DataPayload:
         if self._cached_response:
             return self._cached_response
         return indicator.get_data(geog, across_geogs)
@@ -117,37 +117,37 @@ class IndicatorWithDataSerializer(IndicatorSerializer):
 
         if 'error' in self.context:
             return []
-        data_response: DataResponse = self._get_data_response(
+        data_response: DataPayload = self._get_data_response(
             obj,
             self.context['geography'],
             across_geogs=self.context.get('across_geogs', False)
         )
         print('done')
-        return data_response.data
+        return data_response['data']
 
     def get_dimensions(self, obj: Indicator):
         print('getting dimensions')
         if 'error' in self.context:
             return []
-        data_response: DataResponse = self._get_data_response(
+        data_response: DataPayload = self._get_data_response(
             obj, self.context['geography'],
             across_geogs=self.context.get('across_geogs', False)
         )
         print('done')
-        return data_response.dimensions.response_dict
+        return data_response['dimensions']
 
     def get_map_options(self, obj: Indicator):
         print('getting map options')
         if 'error' in self.context:
             print('done')
             return []
-        data_response: DataResponse = self._get_data_response(
+        data_response: DataPayload = self._get_data_response(
             obj,
             self.context['geography'],
             across_geogs=self.context.get('across_geogs', False)
         )
         print('done')
-        return data_response.map_options
+        return data_response['map_options']
 
     def get_error(self, obj: Indicator):
         print('getting errors')
@@ -159,7 +159,7 @@ class IndicatorWithDataSerializer(IndicatorSerializer):
             obj,
             self.context['geography'],
             across_geogs=self.context.get('across_geogs', False)
-        ).error.as_dict()
+        )['error']
 
     def get_warnings(self, obj: Indicator):
         print('getting warnings')
@@ -170,12 +170,9 @@ class IndicatorWithDataSerializer(IndicatorSerializer):
             obj,
             self.context['geography'],
             across_geogs=self.context.get('across_geogs', False)
-        ).warnings
-        if warnings:
-            print('done')
-            return [warning.as_dict() for warning in warnings]
+        )['warnings']
         print('done')
-        return None
+        return warnings
 
     def get_geogs(self, obj: Indicator):
         primary_geog = self.context['geography']
@@ -0,0 +1,380 @@
+"""
+Utilities for working with the indicator data store (`CachedIndicatorData`).
+
+The store holds one value per (variable, geog, time part) cell.  The helpers here figure out which
+cells a request still needs, how to collect them from sources with as few queries as possible,
+and refresh expired cells in the background while their stale values keep being served.
+
+Cells are stored under their variable's `generation`.  Editing a variable, its sources or its denominators
+bumps the generation, so lookups stop seeing the old cells and a background purge cleans them up.
+
+Frequently requested cells are also kept in a memcached "hot tier" in front of the store.
+"""
+import logging
+import math
+import threading
+import time
+import uuid
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone as dt_timezone
+from typing import TYPE_CHECKING, Iterable, Optional, Type
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+from indicators.data import GeogCollection
+
+if TYPE_CHECKING:
+    from geo.models import AdminRegion
+    from indicators.data import Datum
+    from indicators.models.time import TimeAxis
+    from indicators.models.variable import Variable
+
+logger = logging.getLogger(__name__)
+
+Cell = tuple[str, str]  # (geog global_geoid, time part storage_hash)
+
+# (geog global_geoid, time part storage_hash, value, moe, denom, percent_moe, expiration)
+CellRecord = tuple[str, str, Optional[float], Optional[float], Optional[float], Optional[float], Optional[datetime]]
+
+
+@dataclass
+class CellFetch:
+    """
+    A batch of missing cells that can be collected with one call to a variable's source-specific getter.
+
+    Every geography in `global_geoids` is missing at every time part in `time_parts`.
+    """
+    subgeog_type: Optional[Type['AdminRegion']]
+    global_geoids: frozenset[str]
+    time_parts: list['TimeAxis.TimePart'] = field(default_factory=list)
+
+    @property
+    def cells(self) -> set[Cell]:
+        return {(geoid, tp.storage_hash) for geoid in self.global_geoids for tp in self.time_parts}
+
+    @property
+    def size(self) -> int:
+        return len(self.global_geoids) * len(self.time_parts)
+
+    def geog_collection(self, geog_collection: GeogCollection) -> GeogCollection:
+        """ Returns a copy of `geog_collection` limited to the records for the geogs in this fetch. """
+        return geog_collection.subset(self.global_geoids)
+
+    def time_axis(self) -> 'TimeAxis':
+        from indicators.models.time import TimeAxis
+        return TimeAxis.from_time_parts(self.time_parts)
+
+    def filter_data(self, data: Iterable['Datum']) -> list['Datum']:
+        """ Drops any data returned by a source that falls outside of this fetch's cells. """
+        cells = self.cells
+        return [datum for datum in data if (datum.geog.global_geoid, datum.time.storage_hash) in cells]
+
+
+def cell_records_from_data(data: Iterable['Datum'], expiration: Optional[datetime] = None) -> list[CellRecord]:
+    return [(datum.geog.global_geoid, datum.time.storage_hash, datum.value, datum.moe, datum.denom, datum.percent_moe,
+             expiration) for datum in data]
+
+
+def find_missing_cells(global_geoids: Iterable[str], time_part_hashes: Iterable[str],
+                       records: Iterable[CellRecord]) -> set[Cell]:
+    """
+    Returns the requested cells that aren't covered by `records`.
+
+    `Variable.get_values` passes the hot tier's records plus everything `CachedIndicatorData.get_cell_records`
+    found for the same variable, generation, geogs and time parts, i.e. the rows an anti-join against the store
+    would match, so the difference is the set of cells the store doesn't have without scanning it again.
+    """
+    found: set[Cell] = {(record[0], record[1]) for record in records}
+    time_part_hashes = list(time_part_hashes)
+    return {(geoid, time_part_hash) for geoid in global_geoids for time_part_hash in time_part_hashes} - found
+
+
+def plan_cell_fetches(
+        geog_collection: GeogCollection,
+        global_geoids: Iterable[str],
+        time_parts: Iterable['TimeAxis.TimePart'],
+        missing_cells: Iterable[Cell],
+) -> list[CellFetch]:
+    """
+    Groups the `missing_cells` of a request into the fewest fetches.
+
+    Time parts that are missing the exact same set of geogs are collected together, and geogs are
+    split by the type of subgeography used to describe them, since source queries work on one subgeog type at a time.
+
+    :param geog_collection: the collection of geogs for the full request
+    :param global_geoids: geoids of the geogs in the full request
+    :param time_parts: the time parts in the full request
+    :param missing_cells: (geoid, time_part_hash) pairs that aren't in the store
+    :return: list of fetches that, together, cover exactly the missing cells
+    """
+    requested_geoids = set(global_geoids)
+    time_part_lookup: dict[str, 'TimeAxis.TimePart'] = {tp.storage_hash: tp for tp in time_parts}
+
+    # collect missing geogs for each time part
+    missing_by_time_part: dict[str, set[str]] = {}
+    for geoid, time_part_hash in missing_cells:
+        if geoid not in requested_geoids or time_part_hash not in time_part_lookup:
+            continue
+        missing_by_time_part.setdefault(time_part_hash, set()).add(geoid)
+
+    # time parts missing the same geogs can share queries
+    fetches: dict[tuple[Optional[Type['AdminRegion']], frozenset[str]], CellFetch] = {}
+    for time_part_hash, geoids in missing_by_time_part.items():
+        for subgeog_type, typed_geoids in _split_by_subgeog_type(geog_collection, geoids).items():
+            key = (subgeog_type, typed_geoids)
+            if key not in fetches:
+                fetches[key] = CellFetch(subgeog_type=subgeog_type, global_geoids=typed_geoids)
+            fetches[key].time_parts.append(time_part_lookup[time_part_hash])
+
+    return sorted(fetches.values(), key=lambda f: f.size, reverse=True)
+
+
+def _split_by_subgeog_type(
+        geog_collection: GeogCollection,
+        global_geoids: set[str]
+) -> dict[Optional[Type['AdminRegion']], frozenset[str]]:
+    groups: dict[Optional[Type['AdminRegion']], set[str]] = {}
+    for geoid in global_geoids:
+        record = geog_collection.records.get(geoid)
+        if record is None:
+            continue
+        groups.setdefault(record.subgeog_class, set()).add(geoid)
+    return {subgeog_type: frozenset(geoids) for subgeog_type, geoids in groups.items()}
+
+
+# Background work
+# -*-*-*-*-*-*-*-
+_executor: Optional[ThreadPoolExecutor] = None
+_refresh_lock = threading.Lock()
+_refreshing: set[tuple[str, int, Cell]] = set()  # (variable slug, generation, cell) that are already queued
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _refresh_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.INDICATOR_STORE_REFRESH_WORKERS,
+                thread_name_prefix='indicator-store',
+            )
+    return _executor
+
+
+def queue_refresh(
+        variable: 'Variable',
+        geog_collection: GeogCollection,
+        time_parts: list['TimeAxis.TimePart'],
+        cells: Iterable[Cell],
+        use_denom=True,
+) -> bool:
+    """
+    Schedules expired `cells` of `variable` to be collected again in the background.
+
+    Cells that are already waiting to be refreshed are skipped.
+
+    :return: `True` if anything was scheduled
+    """
+    with _refresh_lock:
+        keys = {(variable.slug, variable.generation, cell) for cell in cells} - _refreshing
+        if not keys:
+            return False
+        _refreshing.update(keys)
+
+    _get_executor().submit(_refresh, variable, geog_collection, time_parts, keys, use_denom)
+    return True
+
+
+def _refresh(
+        variable: 'Variable',
+        geog_collection: GeogCollection,
+        time_parts: list['TimeAxis.TimePart'],
+        keys: set[tuple[str, int, Cell]],
+        use_denom: bool,
+):
+    try:
+        variable.fill_cells(geog_collection, time_parts, [cell for *_, cell in keys], use_denom=use_denom)
+    except Exception as e:
+        logger.exception(f'Failed to refresh {len(keys)} cells for {variable.slug}: {e}')
+    finally:
+        with _refresh_lock:
+            _refreshing.difference_update(keys)
+        # connections are per-thread, so clean up after ourselves
+        connections.close_all()
+
+
+def queue_purge(variable_slug: str, generation: int):
+    """ Schedules removal of the data for generations of `variable_slug` older than `generation`. """
+    _get_executor().submit(_purge, variable_slug, generation)
+
+
+def _purge(variable_slug: str, generation: int):
+    from indicators.models.data import CachedIndicatorData, IndicatorDataBlock
+    try:
+        CachedIndicatorData.objects.filter(variable=variable_slug, generation__lt=generation).delete()
+        IndicatorDataBlock.objects.filter(variable=variable_slug, generation__lt=generation).delete()
+        _rebuild_map_layers(variable_slug)
+    except Exception as e:
+        logger.exception(f'Failed to purge superseded data for {variable_slug}: {e}')
+    finally:
+        connections.close_all()
+
+
+def _rebuild_map_layers(variable_slug: str):
+    """
+    Replaces the map layers made from superseded data for `variable_slug`.
+
+    Layers are rebuilt by requesting the map from an indicator that uses them, which collects data for the
+    current generation.  Layers that no indicator can rebuild are dropped and will be made again on request.
+    """
+    from geo.models import AdminRegion
+    from indicators.models.indicator import Indicator
+    from maps.models import IndicatorLayer
+
+    layer: IndicatorLayer
+    for layer in IndicatorLayer.objects.filter(variable__slug=variable_slug):
+        indicators = [indicator for indicator in
+                      Indicator.objects.filter(vars__slug=variable_slug, time_axis=layer.time_axis).distinct()
+                      if indicator.is_mappable]
+        geog = AdminRegion.find_subclass(layer.geog_type_id).objects.filter(in_extent=True).first()
+        layer.drop()
+        if indicators and geog:
+            logger.info(f'Rebuilding map of {variable_slug} across {layer.geog_type_id}')
+            # skip the response cache, which may hold a response made before the layer was dropped
+            indicators[0]._get_data(geog, across_geogs=True)
+
+
+# Hot tier
+# -*-*-*-*-
+HOT_TIER_HITS_KEY = 'indicator-hot-tier:hits'
+HOT_TIER_MISSES_KEY = 'indicator-hot-tier:misses'
+
+_HOT_TIER_FIELDS = 5  # value, moe, denom, percent_moe, expiration timestamp
+
+# a block's lock is released after this many seconds even if its writer dies
+_HOT_TIER_LOCK_TIMEOUT = 5
+# how many times, and how long apart (in seconds), a writer tries to lock a block before skipping it
+_HOT_TIER_LOCK_ATTEMPTS = 10
+_HOT_TIER_LOCK_WAIT = 0.02
+
+
+def _hot_tier():
+    return caches[settings.INDICATOR_HOT_TIER_CACHE]
+
+
+def hot_block_key(variable_slug: str, generation: int, time_part_hash: str, geog_type_id: str) -> str:
+    # versioned by the layout of its cells
+    return f'indicator-hot-tier:v{_HOT_TIER_FIELDS}:{variable_slug}@{generation}:{time_part_hash}:{geog_type_id}'
+
+
+def _encode_block(cells: dict[str, tuple]) -> tuple[tuple[str, ...], bytes]:
+    """
+    Packs a mapping of geoids to (value, moe, denom, percent_moe, expiration) into a tuple of geoids and
+    a flat array of doubles, using NaN for nulls.
+    """
+    geoids = tuple(cells.keys())
+    packed = array('d')
+    for geoid in geoids:
+        packed.extend(math.nan if item is None else item for item in cells[geoid])
+    return geoids, packed.tobytes()
+
+
+def _decode_block(block: tuple[tuple[str, ...], bytes]) -> dict[str, tuple]:
+    geoids, raw = block
+    packed = array('d')
+    packed.frombytes(raw)
+    results = {}
+    for i, geoid in enumerate(geoids):
+        chunk = packed[i * _HOT_TIER_FIELDS:(i + 1) * _HOT_TIER_FIELDS]
+        results[geoid] = tuple(None if math.isnan(item) else item for item in chunk)
+    return results
+
+
+def read_hot_cells(
+        variable_slug: str,
+        generation: int,
+        geog_type_id: str,
+        global_geoids: Iterable[str],
+        time_part_hashes: Iterable[str],
+) -> list[CellRecord]:
+    """ Returns the records for any of the requested cells that are in the hot tier. """
+    global_geoids = list(global_geoids)
+    keys = {hot_block_key(variable_slug, generation, tph, geog_type_id): tph for tph in time_part_hashes}
+    blocks = _hot_tier().get_many(list(keys.keys()))
+
+    results: list[CellRecord] = []
+    for key, time_part_hash in keys.items():
+        if key not in blocks:
+            continue
+        cells = _decode_block(blocks[key])
+        for geoid in global_geoids:
+            if geoid in cells:
+                value, moe, denom, percent_moe, expiration = cells[geoid]
+                expiration = datetime.fromtimestamp(expiration, tz=dt_timezone.utc) if expiration is not None else None
+                results.append((geoid, time_part_hash, value, moe, denom, percent_moe, expiration))
+
+    _count_hot_tier_access(hits=len(results), misses=len(keys) * len(global_geoids) - len(results))
+    return results
+
+
+def write_hot_cells(variable_slug: str, generation: int, geog_type_id: str, records: Iterable[CellRecord]):
+    """
+    Merges `records` into their blocks in the hot tier.
+
+    Each block is read, updated and written back while holding a lock taken with `cache.add`, so concurrent
+    writers don't drop each other's cells.  Blocks that stay locked are skipped; their cells are still in the
+    store.  Blocks of older generations are left to expire on their own.
+    """
+    updates: dict[str, dict[str, tuple]] = {}
+    for geoid, time_part_hash, value, moe, denom, percent_moe, expiration in records:
+        updates.setdefault(time_part_hash, {})[geoid] = (
+            value, moe, denom, percent_moe, expiration.timestamp() if expiration is not None else None
+        )
+    if not updates:
+        return
+
+    hot_tier = _hot_tier()
+    for time_part_hash, cells_update in updates.items():
+        key = hot_block_key(variable_slug, generation, time_part_hash, geog_type_id)
+        lock_key, token = f'{key}:lock', uuid.uuid4().hex
+        if not _lock_hot_block(hot_tier, lock_key, token):
+            logger.debug(f'Skipped writing {len(cells_update)} cells to locked hot tier block {key}')
+            continue
+        try:
+            block = hot_tier.get(key)
+            cells = _decode_block(block) if block is not None else {}
+            cells.update(cells_update)
+            hot_tier.set(key, _encode_block(cells), timeout=settings.INDICATOR_HOT_TIER_TTL)
+        finally:
+            # don't release a lock that timed out and was taken by another writer
+            if hot_tier.get(lock_key) == token:
+                hot_tier.delete(lock_key)
+
+
+def _lock_hot_block(hot_tier, lock_key: str, token: str) -> bool:
+    for _ in range(_HOT_TIER_LOCK_ATTEMPTS):
+        if hot_tier.add(lock_key, token, timeout=_HOT_TIER_LOCK_TIMEOUT):
+            return True
+        time.sleep(_HOT_TIER_LOCK_WAIT)
+    return False
+
+
+def _count_hot_tier_access(hits: int, misses: int):
+    hot_tier = _hot_tier()
+    for key, count in ((HOT_TIER_HITS_KEY, hits), (HOT_TIER_MISSES_KEY, misses)):
+        if count:
+            hot_tier.add(key, 0, timeout=None)
+            try:
+                hot_tier.incr(key, count)
+            except ValueError:
+                # evicted between `add` and `incr`
+                hot_tier.set(key, count, timeout=None)
+
+
+def hot_tier_stats() -> dict[str, int]:
+    """ Returns the number of cells served from and missed by the hot tier. """
+    counts = _hot_tier().get_many([HOT_TIER_HITS_KEY, HOT_TIER_MISSES_KEY])
+    return {'hits': counts.get(HOT_TIER_HITS_KEY, 0), 'misses': counts.get(HOT_TIER_MISSES_KEY, 0)}
@@ -1,3 +1,357 @@
-from django.test import TestCase
+import threading
 
-# Create your tests here.
+import numpy as np
+from django.contrib.gis.geos import GEOSGeometry
+from django.db import connection
+from django.db.models import F
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from census_data.models import CensusValue
+from geo.models import Tract, Neighborhood
+from indicators.data import Datum, GeogRecord, AggregationMethod
+from indicators import datastore, fusion, moe
+from indicators.datastore_pool import DatastorePool
+from indicators.errors import DatastoreTimeoutError
+from indicators.models import CensusSource, CensusVariable, Indicator, IndicatorVariable, StaticTimeAxis, TimeAxis
+from indicators.models.source import CKANSource
+from indicators.models.data import CachedIndicatorData
+from indicators import store
+from indicators.store import find_missing_cells
+from profiles.settings import GEOG_DKEY, TIME_DKEY, VALUE_DKEY
+
+SQUARE = 'SRID=4326;MULTIPOLYGON(((-80 40, -80 40.1, -79.9 40.1, -79.9 40, -80 40)))'
+
+
+def make_tract(geoid: str) -> Tract:
+    return Tract.objects.create(
+        name=geoid, global_geoid=geoid, geoid=geoid, affgeoid=f'1400000US{geoid}', lsad='CT', aland=1, awater=0,
+        statefp=geoid[:2], countyfp=geoid[2:5], tractce=geoid[5:], geom=GEOSGeometry(SQUARE),
+    )
+
+
+def make_neighborhood(name: str, tracts: list[Tract]) -> Neighborhood:
+    return Neighborhood.objects.create(name=name, global_geoid=name.lower(), geom=GEOSGeometry(SQUARE),
+                                       subregions={Tract.geog_type_id: [tract.global_geoid for tract in tracts]})
+
+
+class CompositeFallbackTests(TestCase):
+    table_uids_by_time_part = {
+        '2019': (['ACS5:2019:B01001_001E'], ['ACS5:2019:B01001_001M']),
+        '2010': (['CEN:2010:P001001E'], []),
+    }
+
+    def setUp(self):
+        self.tracts = [make_tract('42003010300'), make_tract('42003010400')]
+        self.neighborhood = make_neighborhood('Downtown', self.tracts)
+        self.records = [GeogRecord(geog=self.neighborhood, subgeogs=[self.neighborhood]),
+                        GeogRecord(geog=self.tracts[0], subgeogs=[self.tracts[0]])]
+        self.members = [[CensusValue.geog_uid_for(record.geog)] for record in self.records]
+        self.tract_uids = [tract.affgeoid for tract in self.tracts]
+
+    def _fallbacks(self, census_values: dict, aggregation_method=AggregationMethod.SUM):
+        variable = CensusVariable(aggregation_method=aggregation_method)
+        return variable._get_composite_fallbacks(self.records, self.members, census_values,
+                                                 self.table_uids_by_time_part)
+
+    def test_uses_stored_values(self):
+        census_values = {(self.members[0][0], 'ACS5:2019:B01001_001E'): 150.0,
+                         (self.members[0][0], 'CEN:2010:P001001E'): 140.0}
+        self.assertEqual(self._fallbacks(census_values), {'2019': {}, '2010': {}})
+
+    def test_falls_back_for_vintages_without_stored_values(self):
+        census_values = {(self.members[0][0], 'ACS5:2019:B01001_001E'): 150.0}
+        fallbacks = self._fallbacks(census_values)
+        self.assertEqual(fallbacks['2019'], {})
+        self.assertEqual(sorted(fallbacks['2010'][0]), self.tract_uids)
+
+    def test_falls_back_unless_summed(self):
+        census_values = {(self.members[0][0], 'ACS5:2019:B01001_001E'): 150.0,
+                         (self.members[0][0], 'CEN:2010:P001001E'): 140.0}
+        fallbacks = self._fallbacks(census_values, AggregationMethod.MEAN)
+        self.assertEqual(sorted(fallbacks['2019'][0]), self.tract_uids)
+        self.assertEqual(sorted(fallbacks['2010'][0]), self.tract_uids)
+        self.assertNotIn(1, fallbacks['2019'])
+
+
+class ProportionMOETests(SimpleTestCase):
+    def test_proportion(self):
+        # example from the ACS handbook: 2,000 ± 200 of 10,000 ± 500
+        result = moe.proportion_moe(np.array([2000.]), np.array([200.]), np.array([10000.]), np.array([500.]))
+        self.assertAlmostEqual(result[0], np.sqrt(200 ** 2 - 0.2 ** 2 * 500 ** 2) / 10000)
+
+    def test_falls_back_to_ratio(self):
+        result = moe.proportion_moe(np.array([50.]), np.array([10.]), np.array([100.]), np.array([40.]))
+        expected = moe.ratio_moe(np.array([50.]), np.array([10.]), np.array([100.]), np.array([40.]))
+        self.assertAlmostEqual(result[0], expected[0])
+
+    def test_missing_and_zero_denominators_are_none(self):
+        result = moe.proportion_moe(np.array([5., 3.]), np.array([np.nan, 1.]), np.array([10., 0.]), np.array([1., 1.]))
+        self.assertEqual([moe.to_optional(margin) for margin in result], [None, None])
+
+
+class SaveRecordsTests(TestCase):
+    def setUp(self):
+        self.variable = CensusVariable.objects.create(name='Population', slug='population')
+        self.tract = make_tract('42003010300')
+        self.time_part = TimeAxis.TimePart(slug='2019', name='2019', time_point=timezone.datetime(2019, 1, 1),
+                                           time_unit=TimeAxis.YEAR)
+
+    def _records(self) -> list[Datum]:
+        return [Datum(variable=self.variable, geog=self.tract, time=self.time_part, value=10.0, moe=2.0)]
+
+    def test_saves_current_generation(self):
+        self.assertEqual(CachedIndicatorData.save_records(self._records()), 1)
+        self.assertEqual(CachedIndicatorData.get_cell_records('population', 0, [self.tract.global_geoid],
+                                                              [self.time_part.storage_hash]),
+                         [(self.tract.global_geoid, self.time_part.storage_hash, 10.0, 2.0, None, None, None)])
+
+    def test_discards_superseded_generation(self):
+        records = self._records()
+        CensusVariable.objects.filter(pk=self.variable.pk).update(generation=F('generation') + 1)
+        self.assertEqual(CachedIndicatorData.save_records(records), 0)
+        self.assertFalse(CachedIndicatorData.objects.filter(variable='population').exists())
+
+    def test_data_changes_bump_generation(self):
+        self.variable.aggregation_method = AggregationMethod.MEAN
+        self.variable.save()
+        self.variable.refresh_from_db()
+        self.assertEqual(self.variable.generation, 1)
+
+        self.variable.description = 'People'
+        self.variable.save()
+        self.variable.refresh_from_db()
+        self.assertEqual(self.variable.generation, 1)
+
+
+class DataVersionTests(TestCase):
+    def setUp(self):
+        time_axis = StaticTimeAxis.objects.create(name='2019', slug='2019', unit=TimeAxis.YEAR,
+                                                  dates=[timezone.datetime(2019, 1, 1, tzinfo=timezone.utc)])
+        self.variable = CensusVariable.objects.create(name='Population', slug='population')
+        self.indicator = Indicator.objects.create(name='Population', slug='population', time_axis=time_axis)
+        IndicatorVariable.objects.create(indicator=self.indicator, variable=self.variable, order=0)
+
+    def test_reads_links_in_one_query(self):
+        self.indicator.time_axis.time_parts
+        with self.assertNumQueries(1):
+            self.indicator.data_version
+
+    def test_changes_with_variable_generation(self):
+        version = self.indicator.data_version
+        self.variable.bump_generation()
+        self.assertNotEqual(self.indicator.data_version, version)
+
+
+class TimeWindowsTests(SimpleTestCase):
+    time_parts = [
+        TimeAxis.TimePart(slug='2019', name='2019', time_point=timezone.datetime(2019, 1, 1), time_unit=TimeAxis.YEAR),
+        TimeAxis.TimePart(slug='2019-06', name='June 2019', time_point=timezone.datetime(2019, 6, 1),
+                          time_unit=TimeAxis.MONTH),
+    ]
+
+    def test_truncates_source_times_once_per_unit(self):
+        self.assertEqual(
+            CKANSource._get_time_keys_sql('dt."date"', self.time_parts + self.time_parts[:1]),
+            """(VALUES ('month', date_trunc('month', dt."date"::timestamp)), """
+            """('year', date_trunc('year', dt."date"::timestamp))) AS "TK" (unit, key)"""
+        )
+
+    def test_windows_hold_truncated_keys(self):
+        self.assertEqual(
+            CKANSource._get_time_windows_sql(self.time_parts),
+            """(VALUES ('year20190101000000', 'year', date_trunc('year', '2019-01-01 00:00:00'::timestamp)), """
+            """('month20190601000000', 'month', date_trunc('month', '2019-06-01 00:00:00'::timestamp))) """
+            """AS "TP" (hash, unit, key)"""
+        )
+
+
+class FindMissingCellsTests(SimpleTestCase):
+    def test_finds_cells_missing_from_records(self):
+        records = [('a', 'year2019', 1.0, None, None, None, None), ('b', 'year2018', None, None, None, None, None)]
+        self.assertEqual(find_missing_cells(['a', 'b'], ['year2018', 'year2019'], records),
+                         {('a', 'year2018'), ('b', 'year2019')})
+
+    def test_nothing_missing(self):
+        records = [('a', 'year2019', 1.0, None, None, None, None)]
+        self.assertEqual(find_missing_cells(['a'], iter(['year2019']), records), set())
+
+    def test_everything_missing(self):
+        self.assertEqual(find_missing_cells(['a', 'b'], iter(['year2019']), []), {('a', 'year2019'), ('b', 'year2019')})
+
+
+class DatastorePoolTests(TestCase):
+    def make_pool(self, **kwargs) -> DatastorePool:
+        options = dict(min_size=1, max_size=1, max_uses=1000, health_check_age=30, statement_timeout=5000,
+                       itersize=2)
+        pool = DatastorePool(connection.settings_dict, **{**options, **kwargs})
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_waits_when_exhausted(self):
+        pool = self.make_pool()
+        started, finished = threading.Event(), threading.Event()
+        results = []
+
+        def query():
+            started.set()
+            results.append(pool.query('SELECT 1 AS one'))
+            finished.set()
+
+        with pool.checkout():
+            waiting = threading.Thread(target=query)
+            waiting.start()
+            self.assertTrue(started.wait(5))
+            # it can't get a connection until ours is returned
+            self.assertFalse(finished.wait(0.1))
+        self.assertTrue(finished.wait(5))
+        waiting.join()
+        self.assertEqual(results, [[{'one': 1}]])
+        self.assertEqual(pool.stats.count, 2)
+
+    def test_gives_up_waiting_after_checkout_timeout(self):
+        pool = self.make_pool(checkout_timeout=0.05)
+        with pool.checkout():
+            with self.assertRaises(DatastoreTimeoutError):
+                pool.query('SELECT 1 AS one')
+        self.assertEqual(pool.query('SELECT 1 AS one'), [{'one': 1}])
+
+    def test_recycles_after_max_uses(self):
+        pool = self.make_pool(max_uses=2)
+        pids = [pool.query('SELECT pg_backend_pid() AS pid')[0]['pid'] for _ in range(4)]
+        self.assertEqual(pids[0], pids[1])
+        self.assertNotEqual(pids[1], pids[2])
+        # the new connection starts its own count
+        self.assertEqual(pids[2], pids[3])
+
+    def test_replaces_broken_connections(self):
+        pool = self.make_pool(health_check_age=0)
+        pid = pool.query('SELECT pg_backend_pid() AS pid')[0]['pid']
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_terminate_backend(%s)', [pid])
+        self.assertNotEqual(pool.query('SELECT pg_backend_pid() AS pid')[0]['pid'], pid)
+
+    def test_cancels_slow_queries(self):
+        pool = self.make_pool()
+        with self.assertRaises(DatastoreTimeoutError):
+            pool.query('SELECT pg_sleep(1)', timeout=50)
+        with self.assertRaises(DatastoreTimeoutError):
+            list(pool.stream('SELECT pg_sleep(1) FROM generate_series(1, 3)', timeout=50))
+        # the connection is still usable
+        self.assertEqual(pool.query('SELECT 1 AS one'), [{'one': 1}])
+
+    def test_streams_batches(self):
+        pool = self.make_pool()
+        batches = list(pool.stream('SELECT generate_series(1, 5) AS n'))
+        self.assertEqual(batches, [(('n',), [(1,), (2,)]), (('n',), [(3,), (4,)]), (('n',), [(5,)])])
+
+
+class FusionTests(SimpleTestCase):
+    def test_splits_rows_by_variable(self):
+        rows = [{GEOG_DKEY: 'a', TIME_DKEY: 'year2019', 'v0': 1, 'v1': None},
+                {GEOG_DKEY: 'b', TIME_DKEY: 'year2019', 'v0': 2, 'v1': 20}]
+        self.assertEqual(fusion.split_rows(rows, {7: 'v0', 9: 'v1'}), {
+            7: [{GEOG_DKEY: 'a', TIME_DKEY: 'year2019', VALUE_DKEY: 1},
+                {GEOG_DKEY: 'b', TIME_DKEY: 'year2019', VALUE_DKEY: 2}],
+            9: [{GEOG_DKEY: 'a', TIME_DKEY: 'year2019', VALUE_DKEY: None},
+                {GEOG_DKEY: 'b', TIME_DKEY: 'year2019', VALUE_DKEY: 20}],
+        })
+
+    def test_splits_rows_from_iterators(self):
+        rows = iter([{GEOG_DKEY: 'a', TIME_DKEY: 'year2019', 'v0': 1, 'v1': 10}])
+        split = fusion.split_rows(rows, {7: 'v0', 9: 'v1'})
+        self.assertEqual([row[VALUE_DKEY] for row in split[9]], [10])
+
+    def test_partners_reuse_claimed_fetches(self):
+        first, second = CensusVariable(pk=1), CensusVariable(pk=2)
+        fused = fusion.FusedQueries([first, second])
+        existing, partner_futures = fused.claim(first, ('key',), [first, second])
+        self.assertIsNone(existing)
+        self.assertEqual(list(partner_futures), [2])
+
+        existing, others = fused.claim(second, ('key',), [second, first])
+        self.assertIs(existing, partner_futures[2])
+        self.assertEqual(others, {})
+
+    def test_fetch_key_ignores_geoid_order(self):
+        source = CensusSource(pk=3)
+        self.assertEqual(fusion.fetch_key(source, ['b', 'a', 'a'], [], None),
+                         fusion.fetch_key(source, ['a', 'b'], [], None))
+
+
+class StreamQueryTests(SimpleTestCase):
+    class Source:
+        def __init__(self, pk: int, batches: list):
+            self.pk, self.batches, self.closed = pk, batches, False
+
+        def stream_datastore(self, query: str):
+            try:
+                yield from self.batches
+            finally:
+                self.closed = True
+
+    @staticmethod
+    def free_slots(source) -> int:
+        slots = datastore._get_source_slots(source)
+        count = 0
+        while slots.acquire(blocking=False):
+            count += 1
+        for _ in range(count):
+            slots.release()
+        return count
+
+    def test_releases_slot_before_last_batch(self):
+        source = self.Source(1001, [(('n',), [(1,)]), (('n',), [(2,)])])
+        total = self.free_slots(source)
+        batches = datastore.stream_query(source, 'SELECT 1')
+        next(batches)
+        self.assertEqual(self.free_slots(source), total - 1)
+        next(batches)
+        self.assertEqual(self.free_slots(source), total)
+        self.assertTrue(source.closed)
+
+    def test_releases_slot_when_closed(self):
+        source = self.Source(1002, [(('n',), [(1,)]), (('n',), [(2,)]), (('n',), [(3,)])])
+        total = self.free_slots(source)
+        batches = datastore.stream_query(source, 'SELECT 1')
+        next(batches)
+        batches.close()
+        self.assertEqual(self.free_slots(source), total)
+        self.assertTrue(source.closed)
+
+
+@override_settings(INDICATOR_HOT_TIER_CACHE='hot-tier-test',
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                           'hot-tier-test': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                             'LOCATION': 'hot-tier-test'}})
+class HotTierTests(SimpleTestCase):
+    def setUp(self):
+        caches['hot-tier-test'].clear()
+
+    @staticmethod
+    def record(geoid: str, value: float) -> tuple:
+        return geoid, 'year2019', value, None, None, None, None
+
+    def test_writes_merge_into_blocks(self):
+        store.write_hot_cells('population', 0, 'tract', [self.record('a', 1.0)])
+        store.write_hot_cells('population', 0, 'tract', [self.record('b', 2.0)])
+        self.assertEqual(sorted(store.read_hot_cells('population', 0, 'tract', ['a', 'b'], ['year2019'])),
+                         [self.record('a', 1.0), self.record('b', 2.0)])
+
+    def test_concurrent_writers_keep_each_others_cells(self):
+        geoids = [f'g{i}' for i in range(8)]
+        writers = [threading.Thread(target=store.write_hot_cells, args=('population', 0, 'tract', [self.record(geoid, 1.0)]))
+                   for geoid in geoids]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        self.assertEqual(len(store.read_hot_cells('population', 0, 'tract', geoids, ['year2019'])), len(geoids))
+
+    def test_skips_locked_blocks(self):
+        key = store.hot_block_key('population', 0, 'year2019', 'tract')
+        caches['hot-tier-test'].add(f'{key}:lock', 'someone-else')
+        store.write_hot_cells('population', 0, 'tract', [self.record('a', 1.0)])
+        self.assertEqual(store.read_hot_cells('population', 0, 'tract', ['a'], ['year2019']), [])
+        self.assertEqual(caches['hot-tier-test'].get(f'{key}:lock'), 'someone-else')
@@ -1,6 +1,7 @@
 from dataclasses import dataclass, field
+from datetime import datetime
 from enum import Enum
-from typing import Type, Union, Optional, TYPE_CHECKING, Mapping
+from typing import Type, Union, Optional, TYPE_CHECKING, Mapping, TypedDict
 
 from django.contrib.gis.db.models.functions import Centroid
 from django.contrib.gis.geos import Polygon
@@ -54,6 +55,15 @@ class ErrorRecord:
         }
 
 
+class DataPayload(TypedDict):
+    """ The serialized parts of a `DataResponse` that are sent to clients. """
+    data: list
+    dimensions: dict[str, list[str]]
+    map_options: Optional[dict]
+    error: dict
+    warnings: Optional[list[dict]]
+
+
 @dataclass
 class DataResponse:
     data: Optional[Union[list['Datum'], dict]]
@@ -61,6 +71,8 @@ class DataResponse:
     map_options: dict = field(default_factory=dict)
     error: ErrorRecord = ErrorRecord(ErrorLevel.OK)
     warnings: Optional[list[ErrorRecord]] = None
+    # when the earliest of the data in the response needs refreshing; `None` if none of it does
+    expiration: Optional[datetime] = None
 
     def as_dict(self):
         return {
@@ -71,6 +83,16 @@ class DataResponse:
             'warnings': self.warnings
         }
 
+    def as_payload(self) -> DataPayload:
+        """ Serializes the response into plain data that can be cached without pickling any model instances. """
+        return {
+            'data': self.data,
+            'dimensions': self.dimensions.response_dict,
+            'map_options': self.map_options,
+            'error': self.error.as_dict(),
+            'warnings': [warning.as_dict() for warning in self.warnings] if self.warnings else None,
+        }
+
 
 def get_geog_model(geog_type: str) -> Type[AdminRegion]:
     if geog_type in GEOG_MODEL_MAPPING:
@@ -5,6 +5,7 @@ import typing
 import uuid
 from functools import lru_cache
 
+import numpy as np
 import requests
 from ckanapi import RemoteCKAN
 from colorfield.fields import ColorField
@@ -23,6 +24,7 @@ from context.models import WithTags
 from geo.models import AdminRegion
 from indicators.data import GeogCollection
 from indicators.errors import NotAvailableForGeogError
+from indicators.models.data import IndicatorDataBlock
 from profiles.color import color_choices, color_ramps, default_color_options
 from maps.util import store_map_data, refresh_tile_index
 from profiles.abstract_models import Described, TimeStamped
@@ -150,9 +152,7 @@ class IndicatorLayer(Described, TimeStamped):
         # todo: handle custom bucket counts
         try:
             if not self._breaks:
-                # fixme: this seems wasteful, definitely confusing
-                values = [feat['properties']['value'] for feat in self.as_geojson()['features'] if
-                          feat['properties']['value'] is not None]
+                values = self.get_values()
 
                 self._breaks = jenks_breaks(values, nb_class=min(len(values), self.color_scale_buckets - 1))[0:]
             return self._breaks
@@ -161,6 +161,24 @@ class IndicatorLayer(Described, TimeStamped):
                 f'This map is not available for geography Level: {self.geog_content_type.name}.'
             )
 
+    def get_values(self) -> list[float]:
+        """ Returns the non-null values on the map """
+        geog_type = AdminRegion.find_subclass(self.geog_type_id)
+        geoids = geog_type.objects.filter(in_extent=True).values_list('global_geoid', flat=True)
+        blocks = IndicatorDataBlock.objects.filter(
+            variable=self.variable.slug,
+            generation=self.variable.generation,
+            time_part_hash__in=[tp.storage_hash for tp in self.time_axis.time_parts],
+            geog_type=self.geog_type_id,
+        )
+        if not blocks:
+            # fall back to reading the map's view
+            return [feat['properties']['value'] for feat in self.as_geojson()['features'] if
+                    feat['properties']['value'] is not None]
+
+        values = np.concatenate([block.get_map_values(geoids, use_percent=self.use_percent) for block in blocks])
+        return values[~np.isnan(values)].tolist()
+
     def as_geojson(self) -> dict:
         """ Return geojson representation of the map """
         query = f"""SELECT json_build_object(
@@ -231,6 +249,13 @@ class IndicatorLayer(Described, TimeStamped):
     def get_map_options(self):
         return self.source, self.layers, self.interactive_layer_ids, self.legend
 
+    def drop(self):
+        """ Deletes the map along with its view. """
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP VIEW IF EXISTS {self.database_map_view}')
+        self.delete()
+        refresh_tile_index()
+
     def __str__(self):
         return self.name
 
@@ -7,7 +7,7 @@ from django.conf import settings
 from django.db import connection
 
 from indicators.data import GeogCollection
-from indicators.models.data import CachedIndicatorData
+from indicators.models.data import IndicatorDataBlock, GeogIndex
 
 if TYPE_CHECKING:
     from django.db.models.sql import Query
@@ -56,8 +56,20 @@ def store_map_data(
         cursor.execute(f"""DROP VIEW IF EXISTS maps."{map_slug}" """)
 
         base_geography_subquery = as_geometry_query(geog_collection.geog_type.objects.filter(in_extent=True).query)
+        geog_type_id = geog_collection.geog_type.geog_type_id
         time_hashes = ','.join([f"'{tp.storage_hash}'" for tp in time_axis.time_parts])
-        subgeogs = ','.join([f"'{sg.global_geoid}'" for sg in geog_collection.all_subgeogs.all()])
+
+        # the view reads from columnar blocks, so build any that are missing for the variable's generation;
+        # existing ones are kept current as records are saved to the store
+        built_hashes = set(IndicatorDataBlock.objects.filter(
+            variable=variable.slug,
+            generation=variable.generation,
+            geog_type=geog_type_id,
+            time_part_hash__in=[tp.storage_hash for tp in time_axis.time_parts],
+        ).values_list('time_part_hash', flat=True))
+        for time_part in time_axis.time_parts:
+            if time_part.storage_hash not in built_hashes:
+                IndicatorDataBlock.build(variable.slug, variable.generation, time_part.storage_hash, geog_type_id)
 
         # query for data
         cursor.execute(
@@ -78,14 +90,16 @@ def store_map_data(
                    geo.geom as "the_geom", 
                    geo.geom_webmercator      as "the_geom_webmercator", 
                    dat.the_value::float      as "value"
-            FROM (SELECT cid.geog          as geog_global_geoid,
-                         cid.variable      as varaible_slug,
-                         cid.time_part_hash,
-                         {'(cid."value" / cid."denom")' if use_percent else '(cid."value")'} as "the_value"
-                  FROM {CachedIndicatorData._meta.db_table} cid
-                  WHERE variable = '{variable.slug}'
-                    AND time_part_hash IN ({time_hashes})
-                    AND geog IN ({subgeogs})) dat
+            FROM (SELECT cell.geog_global_geoid,
+                         {'(cell."value" / nullif(cell."denom", 0))' if use_percent else '(cell."value")'} as "the_value"
+                  FROM {IndicatorDataBlock._meta.db_table} blk
+                           JOIN {GeogIndex._meta.db_table} gi ON gi.geog_type = blk.geog_type
+                           CROSS JOIN unnest(gi.geoids, blk.values, blk.denoms)
+                               AS cell(geog_global_geoid, "value", "denom")
+                  WHERE blk.variable = '{variable.slug}'
+                    AND blk.generation = {int(variable.generation)}
+                    AND blk.time_part_hash IN ({time_hashes})
+                    AND blk.geog_type = '{geog_type_id}') dat
                      JOIN ({base_geography_subquery}) geo ON dat.geog_global_geoid = geo.global_geoid
             """,
             {
@@ -0,0 +1,96 @@
+"""
+Database helpers that are shared across apps.
+"""
+import io
+import itertools
+from typing import Iterable, Sequence, Optional
+
+from django.db import connections, transaction
+
+DEFAULT_COPY_BATCH_SIZE = 10000
+
+
+def batched(iterable: Iterable, size: int) -> Iterable[list]:
+    """ Yields lists of up to `size` items from `iterable` """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def csv_line(row: Sequence) -> str:
+    """
+    Formats `row` as a line of CSV for `COPY ... (FORMAT csv)`.
+
+    Postgres reads a quoted empty field as an empty string, so NULLs are written as unquoted empty fields
+    and every other value is quoted.
+    """
+    return ','.join('' if value is None else '"' + str(value).replace('"', '""') + '"' for value in row) + '\n'
+
+
+def copy_upsert(
+        table: str,
+        columns: Sequence[str],
+        rows: Iterable[Sequence],
+        conflict_columns: Sequence[str],
+        update_columns: Optional[Sequence[str]] = None,
+        batch_size: int = DEFAULT_COPY_BATCH_SIZE,
+        using: str = 'default',
+) -> int:
+    """
+    Streams `rows` into `table` using `COPY` into a temporary staging table which is then
+    merged into `table` with `INSERT ... ON CONFLICT DO UPDATE`.
+
+    All batches are written in a single transaction, so concurrent writers either see all of the rows or none.
+    If a batch has more than one row for the same conflict key, the last one wins.
+
+    :param table: name of the destination table
+    :param columns: names of the columns in each row, in order
+    :param rows: iterable of row tuples;  `None` is stored as NULL
+    :param conflict_columns: columns of the unique constraint used to detect existing rows
+    :param update_columns: columns to overwrite on conflict; defaults to every non-conflict column
+    :param batch_size: max number of rows sent per `COPY`
+    :param using: database alias
+    :return: number of rows written
+    """
+    if update_columns is None:
+        update_columns = [col for col in columns if col not in conflict_columns]
+
+    staging_table = f'pg_temp."{table}_staging"'
+    column_list = ', '.join(f'"{col}"' for col in columns)
+    conflict_list = ', '.join(f'"{col}"' for col in conflict_columns)
+    if update_columns:
+        on_conflict = 'DO UPDATE SET ' + ', '.join(f'"{col}" = EXCLUDED."{col}"' for col in update_columns)
+    else:
+        on_conflict = 'DO NOTHING'
+
+    count = 0
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            # the staging table is dropped on commit, but may be left from an earlier call in the same transaction.
+            # it's always named with `pg_temp` so a permanent table with the same name is never touched
+            cursor.execute(f'DROP TABLE IF EXISTS {staging_table}')
+            cursor.execute(f'CREATE TEMP TABLE {staging_table} ON COMMIT DROP AS '
+                           f'SELECT {column_list} FROM "{table}" WITH NO DATA')
+            cursor.execute(f'ALTER TABLE {staging_table} ADD COLUMN "__row__" serial')
+
+            for batch in batched(rows, batch_size):
+                buffer = io.StringIO()
+                buffer.writelines(csv_line(row) for row in batch)
+                buffer.seek(0)
+                cursor.copy_expert(f'COPY {staging_table} ({column_list}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+                # `ON CONFLICT DO UPDATE` can't touch the same row twice in one statement, so dedupe first
+                cursor.execute(f"""
+                    INSERT INTO "{table}" ({column_list})
+                    SELECT {column_list}
+                    FROM (SELECT DISTINCT ON ({conflict_list}) {column_list}
+                          FROM {staging_table}
+                          ORDER BY {conflict_list}, "__row__" DESC) deduped
+                    ON CONFLICT ({conflict_list}) {on_conflict}
+                """)
+                cursor.execute(f'TRUNCATE {staging_table}')
+                count += len(batch)
+    return count
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/2.2/ref/settings/
 import json
 import os
 import sys
+from datetime import timedelta
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -103,6 +104,8 @@ DATABASES = {
         'NAME': os.environ.get('NS_DB_NAME', 'simulacrum'),
         'USER': os.environ.get('NS_DB_USER', 'simulacrum_user'),
         'PASSWORD': os.environ.get('NS_DB_PASSWORD', 'p@ssw0rd-4-d3v'),
+        # seconds to keep connections open for reuse, e.g. by the indicator variable workers
+        'CONN_MAX_AGE': int(os.environ.get('NS_DB_CONN_MAX_AGE', 60)),
     },
     # these environment variables must be set and kept secret, even for development
     'datastore': {
@@ -226,6 +229,8 @@ AVAILABLE_GEOG_TYPES = (
 
 SQ_ALIAS = 'dt'
 GEO_ALIAS = '"GEO"'
+TIME_ALIAS = '"TP"'
+TIME_KEY_ALIAS = '"TK"'
 
 ID_DKEY = '__id__'
 GEOG_DKEY = '__geog__'
@@ -239,6 +244,64 @@ LONG_TERM_CACHE_TTL = 0  # 60 * 60 * 24  # 24 hours
 
 USE_LONG_TERM_CACHE = False
 
+# max number of rows sent to the indicator data store in a single `COPY`
+INDICATOR_STORE_BATCH_SIZE = 10000
+
+# default time data from CKAN sources is kept in the indicator data store before it's refreshed
+CKAN_DATA_TTL = timedelta(weeks=1)
+
+# number of background threads used to refresh expired data in the indicator data store
+INDICATOR_STORE_REFRESH_WORKERS = 2
+
+# cache backend and timeout (in seconds) for the hot tier in front of the indicator data store
+INDICATOR_HOT_TIER_CACHE = 'default'
+INDICATOR_HOT_TIER_TTL = 60 * 60 * 6  # 6 hours
+
+# expired data is still served (and refreshed in the background) until it's this old, then it's swept
+INDICATOR_STORE_SWEEP_GRACE = timedelta(days=30)
+
+# number of threads used to run datastore queries, and how many of them can query the same source at once
+DATASTORE_QUERY_WORKERS = 8
+DATASTORE_QUERIES_PER_SOURCE = 3
+
+# size of each process's pool of datastore connections, how many queries a connection serves before it's
+# replaced and how long (in seconds) one can sit idle before it's checked before being used again
+DATASTORE_POOL_MIN_SIZE = 1
+DATASTORE_POOL_SIZE = DATASTORE_QUERY_WORKERS
+DATASTORE_CONNECTION_MAX_USES = 1000
+DATASTORE_CONNECTION_HEALTH_CHECK_AGE = 30
+
+# time limit (in milliseconds) for datastore queries, after which they're cancelled
+DATASTORE_STATEMENT_TIMEOUT = 30_000
+
+# how long (in seconds) to wait for a datastore connection when they're all in use before giving up
+DATASTORE_CHECKOUT_TIMEOUT = 30
+
+# number of rows a CKAN query is expected to return (geogs × time parts) before its results are streamed
+# from a server-side cursor rather than fetched all at once, and how many rows are fetched at a time
+DATASTORE_STREAMING_MIN_ROWS = 5000
+DATASTORE_CURSOR_ITERSIZE = 2000
+
+# number of threads used to collect the variables of an indicator concurrently
+INDICATOR_VARIABLE_WORKERS = 4
+
+# cache backend and timeout (in seconds) for complete indicator data responses
+INDICATOR_RESPONSE_CACHE = 'long_term'
+INDICATOR_RESPONSE_CACHE_TTL = 60 * 60 * 24 * 7  # 1 week
+
+# cache backend and timeout (in seconds) for the census tables resolved for each variable and time part
+CENSUS_TABLE_UIDS_CACHE = 'default'
+CENSUS_TABLE_UIDS_CACHE_TTL = 60 * 60 * 24  # 24 hours
+
+# where census values are read from: 'db' for `CensusValue`, or 'matrix' for memory-mapped matrices
+# materialized per dataset-year into `CENSUS_MATRIX_DIR` (see census_data.matrix)
+CENSUS_VALUE_ENGINE = 'db'
+CENSUS_MATRIX_DIR = os.path.join(BASE_DIR, 'data', 'census_matrix')
+
+# non-census geog types whose census values are summed from their subregions when census data is loaded
+# (see census_data.composites) and then read directly instead of being aggregated on each request
+CENSUS_COMPOSITE_GEOG_TYPES = ('neighborhood',)
+
 APPEND_SLASH = True
 
 SPECTACULAR_SETTINGS = {
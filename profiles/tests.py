@@ -0,0 +1,56 @@
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+
+from profiles.db import copy_upsert, csv_line
+
+
+class CSVLineTests(SimpleTestCase):
+    def test_none_is_unquoted(self):
+        self.assertEqual(csv_line(('a', None, 1.5)), '"a",,"1.5"\n')
+
+    def test_empty_string_is_quoted(self):
+        self.assertEqual(csv_line(('', None)), '"",\n')
+
+    def test_quotes_are_escaped(self):
+        self.assertEqual(csv_line(('say "hi", then go',)), '"say ""hi"", then go"\n')
+
+
+class CopyUpsertTests(TestCase):
+    table = 'copy_upsert_test'
+    columns = ('key', 'label', 'value', 'at')
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'CREATE TABLE "{self.table}" '
+                           f'(key int PRIMARY KEY, label text, value double precision, at timestamptz)')
+
+    def _rows(self) -> list[tuple]:
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT key, label, value, at FROM "{self.table}" ORDER BY key')
+            return cursor.fetchall()
+
+    def test_round_trips_nulls(self):
+        count = copy_upsert(self.table, self.columns, [(1, None, None, None), (2, '', 2.5, None)], ('key',))
+        self.assertEqual(count, 2)
+        self.assertEqual(self._rows(), [(1, None, None, None), (2, '', 2.5, None)])
+
+    def test_updates_existing_rows(self):
+        copy_upsert(self.table, self.columns, [(1, 'old', 1.0, None)], ('key',))
+        copy_upsert(self.table, self.columns, [(1, 'new', None, None)], ('key',))
+        self.assertEqual(self._rows(), [(1, 'new', None, None)])
+
+    def test_last_duplicate_wins(self):
+        copy_upsert(self.table, self.columns, [(1, 'first', 1.0, None), (1, 'second', 2.0, None)], ('key',),
+                    batch_size=10)
+        self.assertEqual(self._rows(), [(1, 'second', 2.0, None)])
+
+    def test_leaves_permanent_staging_tables_alone(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'CREATE TABLE "{self.table}_staging" (key int)')
+            cursor.execute(f'INSERT INTO "{self.table}_staging" VALUES (1)')
+        copy_upsert(self.table, self.columns, [(1, 'a', None, None)], ('key',))
+        copy_upsert(self.table, self.columns, [(2, 'b', None, None)], ('key',))
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT key FROM public."{self.table}_staging"')
+            self.assertEqual(cursor.fetchall(), [(1,)])
+        self.assertEqual([row[0] for row in self._rows()], [1, 2])